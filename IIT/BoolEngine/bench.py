@@ -0,0 +1,67 @@
+""" Benchmarks for the boolean search engine.
+Postings lists are sampled at random from a large synthetic collection, so a
+rare term can be intersected with terms of any document frequency.
+
+To run: `python bench.py [n_docs]`
+"""
+from array import array
+import random
+import sys
+import time
+
+import shared  # puts IIT/common, with the shared modules, on sys.path
+import boolean_search
+import postings
+
+
+def random_postings(n_docs, length, rand):
+    """
+    Return a sorted array of length distinct document ids below n_docs.
+    >>> list(random_postings(10, 3, random.Random(0)))
+    [0, 6, 9]
+    """
+    return array('i', sorted(rand.sample(range(n_docs), length)))
+
+
+def pairwise(lists):
+    """ Intersect lists with a linear merge (see boolean_search.intersect)
+    of each list, in the given order, into the running result. """
+    intersection = lists[0]
+    for doc_ids in lists[1:]:
+        intersection = boolean_search.intersect(intersection, doc_ids)
+    return intersection
+
+
+def lazy(lists):
+    """ Intersect lists with the iterators search runs. """
+    return list(boolean_search.AndIterator([boolean_search.TermIterator(l) for l in lists]))
+
+
+def bench_intersect(n_docs, rare=100, repeat=3, seed=0):
+    """ Time the intersection of a rare term with terms of growing document
+    frequency, with the pairwise merge, the lazy AndIterator that search
+    runs, and the AndIterator over CompressedPostings. The merge grows with the
+    longest list; the others stay close to constant. """
+    rand = random.Random(seed)
+    short = random_postings(n_docs, rare, rand)
+    print('%12s %12s %14s %14s %16s' % ('short', 'long', 'merge msec', 'lazy msec', 'compressed msec'))
+    for length in [1000, 10000, 100000, n_docs // 2]:
+        lists = [short, random_postings(n_docs, length, rand), random_postings(n_docs, length, rand)]
+        packed = [postings.CompressedPostings(doc_ids) for doc_ids in lists]
+        timings = []
+        for intersect, operands in [(pairwise, lists), (lazy, lists), (lazy, packed)]:
+            start = time.time()
+            for _ in range(repeat):
+                result = intersect(operands)
+            timings.append((time.time() - start) * 1e3 / repeat)
+            assert list(result) == list(pairwise(lists))
+        print('%12d %12d %14.2f %14.2f %16.2f' % ((rare, length) + tuple(timings)))
+
+
+def main():
+    n_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    bench_intersect(n_docs)
+
+
+if __name__ == '__main__':
+    main()
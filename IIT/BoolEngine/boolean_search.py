@@ -3,24 +3,33 @@ You will implement a simple in-memory boolean search engine over the jokes
 from http://web.hawkesnest.net/~jthens/laffytaffy/.
 The documents are read from documents.txt.
 The queries to be processed are read from queries.txt.
-Your search engine will only need to support AND queries. A multi-word query
-is assumed to be an AND of the words. E.g., the query "why because" should be
-processed as "why AND because."
+A multi-word query is assumed to be an AND of the words. E.g., the query
+"why because" should be processed as "why AND because." Queries may also use
+OR, NOT, parentheses, "quoted phrases" and "proximity queries"~k (see
+parse_query). Phrases and proximity are checked against a positional index
+(see create_positional_index), when one is given.
 """
+from array import array
 from collections import defaultdict
+import heapq
+import os
 import re
+import string
+
+import shared  # puts IIT/common, with the shared modules, on sys.path
+import analysis
+import postings
+
+PUNCTUATION = str.maketrans(dict.fromkeys(',.?!();:\'-"`', ' '))
+
+# Documents are lowercased before tokenizing, so the analyzer does not
+# lowercase tokens again. Apostrophes are punctuation: they never reach it.
+ANALYZER = analysis.Analyzer(r"[\w']+", string.punctuation.replace('_', ''), lowercase=False)
 
 
 """remove all punctuations"""
 def bye_punctuation(document):
-    doc = []
-    punctuation = [',', '.', '?', '!', '(', ')', ';', ':', '\'', '-', '"', '`']
-    for letter in document:
-        if letter in punctuation:
-            doc.append(' ')
-        else:
-            doc.append(letter.lower())
-    return ''.join(doc)
+    return document.translate(PUNCTUATION).lower()
 
 def tokenize(document):
     """ Convert a string representing one document into a list of
@@ -33,7 +42,7 @@ def tokenize(document):
     >>> tokenize("Hi  there. What's going on?")
     ['hi', 'there', 'what', 's', 'going', 'on']
     """
-    return re.findall(r"[\w']+", bye_punctuation(document))
+    return ANALYZER.analyze(document.lower())
 
 
 # print(tokenize("Hi  there. What's going on?"))
@@ -78,6 +87,120 @@ def create_index(tokens):
 # print(index['b'])
 
 
+def create_positional_index(tokens):
+    """
+    Create a positional index given a list of document tokens: a dict
+    mapping each word to a postings.PositionalPostings, holding the
+    positions of the word in each document that contains it. It is kept
+    apart from the inverted index, so only phrase and proximity queries read
+    it.
+    >>> positions = create_positional_index([['a', 'b', 'a'], ['b']])
+    >>> positions['a'].positions(0), list(positions['b'].doc_ids)
+    ([0, 2], [0, 1])
+    """
+    return postings.positional_index(tokens)
+
+
+def freeze_index(index):
+    """
+    Convert every postings list of an inverted index into an array of
+    document ids. Each entry then takes 4 bytes instead of a pointer to a
+    Python int, and intersect and search work on the arrays unchanged.
+    Params:
+      index...An inverted index (dict mapping words to lists of document ids)
+    Returns:
+      A dict mapping words to array('i') of document ids.
+    >>> index = freeze_index(create_index([['a', 'b'], ['a', 'c']]))
+    >>> index['a']
+    array('i', [0, 1])
+    >>> search(index, 'a b')
+    [0]
+    """
+    return dict((word, array('i', doc_ids)) for word, doc_ids in index.items())
+
+
+def compress_index(index):
+    """
+    Convert every postings list of an inverted index into a
+    postings.CompressedPostings of document ids, variable-byte coded by gaps
+    in blocks that search skips through without decoding.
+    >>> index = compress_index(create_index([['a', 'b'], ['a', 'c']]))
+    >>> len(index['a']), list(index['a'])
+    (2, [0, 1])
+    >>> search(index, 'a b')
+    [0]
+    >>> index = compress_index(create_index([['b'], ['a'], ['a'], ['a']]))
+    >>> search(index, 'a AND NOT b', n_docs=4), search(index, 'NOT b', n_docs=4)
+    ([1, 2, 3], [1, 2, 3])
+    """
+    return dict((word, postings.CompressedPostings(doc_ids)) for word, doc_ids in index.items())
+
+
+def save_index(index, path, positions=None):
+    """
+    Write an inverted index to a binary segment file (see
+    postings.write_segment), with sections for the sorted words and the
+    concatenated postings lists, plus the positional index, if given.
+    Params:
+      index.......An inverted index (dict mapping words to document ids)
+      path........The file to write.
+      positions...The positional index of the same documents (see
+                  create_positional_index), or None.
+    """
+    words, blob, offsets = postings.pack_terms(index.keys())
+    starts = array('q', [0])
+    doc_ids = array('i')
+    for word in words:
+        doc_ids.extend(index[word])
+        starts.append(len(doc_ids))
+    sections = [('terms', blob), ('term_offsets', offsets), ('postings_starts', starts), ('doc_ids', doc_ids)]
+    if positions is not None:
+        sections += postings.positional_sections(positions, words)
+    postings.write_segment(path, {}, sections)
+
+
+def load_index(path):
+    """
+    Memory-map an inverted index written by save_index. Words are looked up
+    by binary search in the mapped file, and each postings list is a view of
+    the mapped document ids, so loading takes the same time whatever the
+    size of the index.
+    Params:
+      path...The file to read.
+    Returns:
+      A read-only mapping from words to sequences of document ids.
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'index.seg')
+    >>> save_index(create_index([['a', 'b'], ['a', 'c'], ['a', 'b']]), path)
+    >>> index = load_index(path)
+    >>> list(index['a']), search(index, 'b a')
+    ([0, 1, 2], [0, 2])
+    """
+    _, sections = postings.read_segment(path)
+    starts = sections['postings_starts']
+    doc_ids = sections['doc_ids']
+    return postings.TermTable(sections['terms'], sections['term_offsets'],
+                              lambda word_id: doc_ids[starts[word_id]:starts[word_id + 1]])
+
+
+def load_positions(path):
+    """
+    Memory-map the positional index saved with an inverted index by
+    save_index, or return None if it was saved without one. Positions are
+    only read from the file when a phrase or proximity query needs them.
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'index.seg')
+    >>> tokens = [['a', 'b'], ['b', 'a'], ['a', 'b']]
+    >>> save_index(create_index(tokens), path, create_positional_index(tokens))
+    >>> search(load_index(path), '"a b"', positions=load_positions(path))
+    [0, 2]
+    """
+    _, sections = postings.read_segment(path)
+    if 'positions_starts' not in sections:
+        return None
+    return postings.positional_table(sections)
+
+
 def intersect(list1, list2):
     """ Return the intersection of two posting lists. Use the optimize
     algorithm of Figure 1.6 of the MRS text. Your implementation should be
@@ -111,6 +234,35 @@ def intersect(list1, list2):
 #print(intersect([1, 2], [3, 4, 5, 10]))
 
 
+def seek(doc_ids, start, doc_id):
+    """
+    Return the first position at or after start in the ascending sequence
+    doc_ids whose value is at least doc_id, or len(doc_ids) if there is none.
+    Uses exponential (galloping) search, so the cost grows with the log of the
+    distance skipped rather than with the length of the list. The AND of a
+    query (see AndIterator) is evaluated this way, skipping through long
+    postings lists to the ids of the most selective one.
+    >>> doc_ids = [1, 4, 6, 9, 12]
+    >>> seek(doc_ids, 0, 6), seek(doc_ids, 1, 7), seek(doc_ids, 3, 13)
+    (2, 3, 5)
+    """
+    step = 1
+    low = start
+    high = start
+    while high < len(doc_ids) and doc_ids[high] < doc_id:
+        low = high + 1
+        high += step
+        step *= 2
+    high = min(high, len(doc_ids))
+    while low < high:
+        mid = (low + high) // 2
+        if doc_ids[mid] < doc_id:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+
 def sort_by_num_postings(words, index):
     """
     Sort the words in increasing order of the length of their postings list in
@@ -120,60 +272,492 @@ def sort_by_num_postings(words, index):
       index....An inverted index; a dict mapping words to lists of document
       ids, sorted in ascending order.
     Returns:
-      A list of words, sorted in ascending order by the number of document ids
-      in the index.
+      A new list of words, sorted in ascending order by the number of document
+      ids in the index. Words missing from the index come first.
     >>> sort_by_num_postings(['a', 'b', 'c'], {'a': [0, 1], 'b': [1, 2, 3], 'c': [4]})
     ['c', 'a', 'b']
+    >>> words = ['b', 'zzz', 'a']
+    >>> sort_by_num_postings(words, {'a': [0, 1], 'b': [1, 2, 3]}), words
+    (['zzz', 'a', 'b'], ['b', 'zzz', 'a'])
+    """
+    return sorted(words, key=lambda word: len(index[word]) if word in index else 0)
+
+
+def doc_frequencies(index):
+    """
+    Return a mapping from each word of index to the length of its postings
+    list, for plan_query. Build it once per index: planning a query then
+    only looks up its own words, whatever the size of the vocabulary. The
+    mapping of a memory-mapped index (see load_index) reads the lengths off
+    the segment on demand.
+    >>> doc_frequencies({'a': [0, 1], 'b': [1, 2, 3]})
+    {'a': 2, 'b': 3}
+    """
+    if isinstance(index, postings.TermTable):
+        return postings.TermTable(index.blob, index.offsets, lambda word_id: len(index.value(word_id)))
+    return dict((word, len(doc_ids)) for word, doc_ids in index.items())
+
+
+def plan_query(query, doc_freqs, n_docs=None):
+    """
+    Reorder a query tree so that it is cheapest to evaluate with run_query.
+    A query tree is a word, ('AND', [subqueries]), ('OR', [subqueries]),
+    ('NOT', subquery), ('PHRASE', [words]) or ('NEAR', (distance, [words])) (see parse_query). The number of matching
+    documents of each subquery is
+    estimated from doc_freqs: the document frequency of a word, the smallest
+    estimate of the operands of an AND, the sum of those of an OR, and the
+    complement of its operand for a NOT. The operands of AND and OR are
+    sorted by increasing estimate, and the NOT operands of an AND are moved
+    after the others, where they filter the intersection, largest first.
+    Params:
+      query.......A query tree.
+      doc_freqs...A mapping from words to document frequencies (see
+                  doc_frequencies). Missing words have frequency 0.
+      n_docs......The number of documents, used to estimate NOT.
+    Returns:
+      A tuple (planned query tree, estimated number of results).
+    >>> doc_freqs = {'a': 50, 'b': 3, 'c': 10, 'd': 20}
+    >>> plan_query(('AND', ['a', ('NOT', 'd'), ('OR', ['d', 'c']), 'b']), doc_freqs, 100)
+    (('AND', ['b', ('OR', ['c', 'd']), 'a', ('NOT', 'd')]), 3)
+    >>> plan_query(('NOT', 'zzz'), doc_freqs, 100)
+    (('NOT', 'zzz'), 100)
     """
-    tmp_lst = []
-    tmp_index = {}
-    for key in index.keys():
-        tmp_index[key] = len(index[key])
-    tmp_lst = sorted(tmp_index, key=tmp_index.__getitem__)
-    tmp_words = words
-    tmp_words.sort(key=lambda x: tmp_lst.index(x))
-    return tmp_words
+    if isinstance(query, str):
+        return query, doc_freqs[query] if query in doc_freqs else 0
+    operator, operands = query
+    if operator in ('PHRASE', 'NEAR'):
+        words = operands if operator == 'PHRASE' else operands[1]
+        return query, min(doc_freqs[word] if word in doc_freqs else 0 for word in words)
+    if operator == 'NOT':
+        operand, estimate = plan_query(operands, doc_freqs, n_docs)
+        return (operator, operand), (n_docs or 0) - estimate
+    planned = [plan_query(operand, doc_freqs, n_docs) for operand in operands]
+    if operator == 'OR':
+        planned.sort(key=lambda p: p[1])
+        estimate = sum(p[1] for p in planned)
+        return (operator, [p[0] for p in planned]), min(estimate, n_docs) if n_docs else estimate
+    positive = sorted((p for p in planned if not is_negation(p[0])), key=lambda p: p[1])
+    negative = sorted((p for p in planned if is_negation(p[0])), key=lambda p: -p[1])
+    estimate = positive[0][1] if positive else min(p[1] for p in negative)
+    return (operator, [p[0] for p in positive + negative]), estimate
 
-# print(sort_by_num_postings(['a', 'b', 'c'], {'a': [0, 1], 'b': [1, 2, 3], 'c': [4]}))
 
-def search(index, query):
+def is_negation(query):
+    return not isinstance(query, str) and query[0] == 'NOT'
+
+
+def run_query(index, query, n_docs=None, documents=None, positions=None):
+    """
+    Evaluate a query tree (see plan_query) and return the list of matching
+    document ids, sorted in ascending order. Operands are evaluated in the
+    order given, so plan the query first. See compile_query for the
+    arguments.
+    >>> index = {'a': [0, 1, 2, 4], 'b': [1, 2, 3], 'c': [4]}
+    >>> run_query(index, ('AND', [('OR', ['b', 'c']), 'a', ('NOT', 'c')]))
+    [1, 2]
+    >>> run_query(index, ('NOT', 'a'), n_docs=6)
+    [3, 5]
+    """
+    return list(compile_query(index, query, n_docs, documents, positions))
+
+
+def compile_query(index, query, n_docs=None, documents=None, positions=None):
+    """
+    Compile a query tree (see plan_query) into a tree of lazy iterators over
+    the postings of index. Nothing is evaluated until document ids are read
+    from the returned iterator, and no intermediate list is built, so results
+    can be paged with itertools.islice at a cost proportional to the page.
+    Params:
+      index.......An inverted index (dict mapping words to document ids)
+      query.......A query tree.
+      n_docs......The number of documents. Only needed when a NOT is not
+                  inside an AND with some other operand.
+      documents...The tokenized documents, to check that the words of a
+                  phrase are adjacent, or close enough for a NEAR.
+      positions...The positional index (see create_positional_index), to
+                  check phrases and NEAR without the documents. If neither
+                  is given, they match the documents containing all of their
+                  words.
+    Returns:
+      A PostingIterator.
+    >>> index = {'a': [0, 1, 2, 4], 'b': [1, 2, 3], 'c': [1, 4]}
+    >>> list(compile_query(index, ('PHRASE', ['a', 'b']), documents=[[], ['a', 'b'], ['b', 'a']]))
+    [1]
+    >>> list(compile_query(index, ('NEAR', (1, ['a', 'b'])), documents=[[], ['a', 'b'], ['b', 'c', 'a']]))
+    [1]
+    """
+    if isinstance(query, str):
+        return TermIterator(index[query] if query in index else [])
+    operator, operands = query
+    if operator == 'NOT':
+        if n_docs is None:
+            raise ValueError('n_docs is needed to evaluate a NOT on its own')
+        return ComplementIterator(compile_query(index, operands, n_docs, documents, positions), n_docs)
+    if operator == 'OR':
+        return OrIterator([compile_query(index, operand, n_docs, documents, positions) for operand in operands])
+    if operator in ('PHRASE', 'NEAR'):
+        distance, words = (None, operands) if operator == 'PHRASE' else operands
+        iterator = AndIterator([compile_query(index, word) for word in words])
+        if documents is None and positions is None:
+            return iterator
+        return PhraseIterator(iterator, words, documents, positions, distance)
+    positive = [operand for operand in operands if not is_negation(operand)]
+    if positive:
+        iterator = AndIterator([compile_query(index, operand, n_docs, documents, positions) for operand in positive])
+    else:
+        iterator = compile_query(index, operands[0], n_docs, documents, positions)
+        operands = operands[1:]
+    for operand in operands:
+        if is_negation(operand):
+            iterator = DifferenceIterator(iterator, compile_query(index, operand[1], n_docs, documents, positions))
+    return iterator
+
+
+class PostingIterator(object):
+    """
+    A lazy, ascending stream of document ids. Subclasses implement advance,
+    which returns the first matching document id at or after doc_id, or None
+    once there are no more. Successive calls must not move backwards.
+    """
+
+    def advance(self, doc_id):
+        raise NotImplementedError
+
+    def __iter__(self):
+        doc_id = self.advance(0)
+        while doc_id is not None:
+            yield doc_id
+            doc_id = self.advance(doc_id + 1)
+
+
+class TermIterator(PostingIterator):
+    """
+    The document ids of one postings list, skipped through with seek, or
+    block by block for a CompressedPostings.
+    >>> list(TermIterator([1, 4, 9]))
+    [1, 4, 9]
+    """
+
+    def __init__(self, doc_ids):
+        self.doc_ids = doc_ids
+        self.position = 0
+        if isinstance(doc_ids, postings.CompressedPostings):
+            self.advance = doc_ids.cursor().advance
+
+    def advance(self, doc_id):
+        self.position = seek(self.doc_ids, self.position, doc_id)
+        if self.position < len(self.doc_ids):
+            return self.doc_ids[self.position]
+        return None
+
+
+class AndIterator(PostingIterator):
+    """
+    The document ids found in every child. Each candidate comes from the
+    first child, which should be the most selective, and the other children
+    are advanced to it; any larger id they land on becomes the next
+    candidate, so long postings lists are skipped through, not scanned.
+    >>> list(AndIterator([TermIterator([2, 9]), TermIterator(range(10)), TermIterator([1, 2, 9, 10])]))
+    [2, 9]
+    """
+
+    def __init__(self, children):
+        self.children = children
+
+    def advance(self, doc_id):
+        while True:
+            for child in self.children:
+                found = child.advance(doc_id)
+                if found is None:
+                    return None
+                if found != doc_id:
+                    doc_id = found
+                    break
+            else:
+                return doc_id
+
+
+class OrIterator(PostingIterator):
+    """
+    The document ids found in any child, merged with a heap holding the
+    current document id of each child.
+    >>> list(OrIterator([TermIterator([1, 5]), TermIterator([2, 5, 9]), TermIterator([])]))
+    [1, 2, 5, 9]
+    """
+
+    def __init__(self, children):
+        self.children = children
+        self.heap = None
+
+    def advance(self, doc_id):
+        if self.heap is None:
+            self.heap = [(child.advance(doc_id), i) for i, child in enumerate(self.children)]
+            self.heap = [entry for entry in self.heap if entry[0] is not None]
+            heapq.heapify(self.heap)
+        while self.heap and self.heap[0][0] < doc_id:
+            _, i = self.heap[0]
+            found = self.children[i].advance(doc_id)
+            if found is None:
+                heapq.heappop(self.heap)
+            else:
+                heapq.heapreplace(self.heap, (found, i))
+        return self.heap[0][0] if self.heap else None
+
+
+class DifferenceIterator(PostingIterator):
+    """
+    The document ids of positive that are not in negative.
+    >>> list(DifferenceIterator(TermIterator([1, 2, 5, 9]), TermIterator([2, 3, 9])))
+    [1, 5]
+    """
+
+    def __init__(self, positive, negative):
+        self.positive = positive
+        self.negative = negative
+
+    def advance(self, doc_id):
+        doc_id = self.positive.advance(doc_id)
+        while doc_id is not None and self.negative.advance(doc_id) == doc_id:
+            doc_id = self.positive.advance(doc_id + 1)
+        return doc_id
+
+
+class ComplementIterator(PostingIterator):
+    """
+    The document ids in range(n_docs) that child does not match.
+    >>> list(ComplementIterator(TermIterator([0, 2, 3]), 6))
+    [1, 4, 5]
+    """
+
+    def __init__(self, child, n_docs):
+        self.child = child
+        self.n_docs = n_docs
+
+    def advance(self, doc_id):
+        while doc_id < self.n_docs and self.child.advance(doc_id) == doc_id:
+            doc_id += 1
+        return doc_id if doc_id < self.n_docs else None
+
+
+class PhraseIterator(PostingIterator):
+    """
+    The document ids of candidates that contain words in sequence or, if
+    distance is given, within a window of distance + 1 positions, in any
+    order (see postings.min_span). Positions are read from the positional
+    index if given, or else found in the tokenized documents.
+    >>> positions = create_positional_index([['a', 'b'], ['b', 'a'], ['a', 'c', 'b']])
+    >>> candidates = TermIterator([0, 1, 2])
+    >>> list(PhraseIterator(candidates, ['a', 'b'], positions=positions))
+    [0]
+    >>> list(PhraseIterator(TermIterator([0, 1, 2]), ['a', 'b'], positions=positions, distance=1))
+    [0, 1]
+    """
+
+    def __init__(self, candidates, words, documents=None, positions=None, distance=None):
+        self.candidates = candidates
+        self.words = words
+        self.documents = documents
+        self.positions = positions
+        self.distance = distance
+
+    def contains_phrase(self, doc_id):
+        if self.positions is not None:
+            position_lists = [self.positions[word].positions(doc_id) for word in self.words]
+        else:
+            tokens = self.documents[doc_id]
+            position_lists = [[i for i, token in enumerate(tokens) if token == word] for word in self.words]
+        if self.distance is None:
+            return bool(postings.phrase_starts(position_lists))
+        span = postings.min_span(position_lists)
+        return span is not None and span <= self.distance
+
+    def advance(self, doc_id):
+        doc_id = self.candidates.advance(doc_id)
+        while doc_id is not None and not self.contains_phrase(doc_id):
+            doc_id = self.candidates.advance(doc_id + 1)
+        return doc_id
+
+
+def parse_query(query):
+    """
+    Parse a query string into a query tree (see plan_query). The language
+    has the operators AND, OR and NOT (in capitals), parentheses,
+    double-quoted phrases and proximity queries: "a b"~k matches the
+    documents where a and b are at most k positions apart, in any order,
+    i.e. ('NEAR', (k, ['a', 'b'])). AND binds tighter than OR, and words next
+    to each other are joined by an implicit AND. Words are tokenized like documents,
+    so a word that tokenizes into several words matches all of them.
+    Raises ValueError on unbalanced parentheses or a missing operand.
+    Returns:
+      A query tree, or None if the query has no words.
+    >>> parse_query('cat OR (dog AND NOT "hot dog") bird')
+    ('OR', ['cat', ('AND', ['dog', ('NOT', ('PHRASE', ['hot', 'dog'])), 'bird'])])
+    >>> parse_query("What's up")
+    ('AND', ['what', 's', 'up'])
+    >>> parse_query('"ngo dinh diem"~3 OR kennedy')
+    ('OR', [('NEAR', (3, ['ngo', 'dinh', 'diem'])), 'kennedy'])
+    >>> parse_query('(a OR b')
+    Traceback (most recent call last):
+    ...
+    ValueError: missing ) in query: '(a OR b'
+    """
+    tokens = re.findall(r'"[^"]*"?(?:~\d+)?|[()]|[^\s()"]+', query)
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        position[0] += 1
+        return tokens[position[0] - 1]
+
+    def combine(operator, operands):
+        flat = []
+        for operand in operands:
+            if operand is None:
+                continue
+            if not isinstance(operand, str) and operand[0] == operator:
+                flat.extend(operand[1])
+            else:
+                flat.append(operand)
+        if not flat:
+            return None
+        return flat[0] if len(flat) == 1 else (operator, flat)
+
+    def parse_or():
+        operands = [parse_and()]
+        while peek() == 'OR':
+            take()
+            operands.append(parse_and())
+        return combine('OR', operands)
+
+    def parse_and():
+        operands = [parse_not()]
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                take()
+            operands.append(parse_not())
+        return combine('AND', operands)
+
+    def parse_not():
+        if peek() == 'NOT':
+            take()
+            operand = parse_not()
+            return None if operand is None else ('NOT', operand)
+        return parse_atom()
+
+    def parse_atom():
+        token = peek()
+        if token in (None, 'AND', 'OR', ')'):
+            raise ValueError('missing operand in query: %r' % query)
+        take()
+        if token == '(':
+            operand = parse_or()
+            if peek() != ')':
+                raise ValueError('missing ) in query: %r' % query)
+            take()
+            return operand
+        distance = re.search(r'"~(\d+)$', token) if token.startswith('"') else None
+        if distance:
+            token = token[:distance.start() + 1]
+        words = tokenize(token.strip('"'))
+        if distance and len(words) > 1:
+            return ('NEAR', (int(distance.group(1)), words))
+        if token.startswith('"') and len(words) > 1:
+            return ('PHRASE', words)
+        return combine('AND', words)
+
+    if not tokens:
+        return None
+    tree = parse_or()
+    if peek() is not None:
+        raise ValueError('unexpected %s in query: %r' % (peek(), query))
+    return tree
+
+
+def search(index, query, doc_freqs=None, n_docs=None, documents=None, positions=None):
     """ Return the document ids for documents matching the query. Assume that
     query is a single string, possibly containing multiple words. The steps
     are to:
-    1. tokenize the query
-    2. Sort the query words by the length of their postings list
-    3. Intersect the postings list of each word in the query.
-    If a query term is not in the index, then an empty list should be returned.
+    1. parse the query (see parse_query); words next to each other are
+       ANDed
+    2. Sort the operands by the length of their postings list (see
+       plan_query)
+    3. Intersect, merge or subtract the postings lists (see compile_query).
+    If a query term is not in the index, it matches no document.
     Params:
-      index...An inverted index (dict mapping words to document ids)
-      query...A string that may contain multiple search terms. We assume the
-      query is the AND of those terms by default.
+      index.......An inverted index (dict mapping words to document ids)
+      query.......A string that may contain multiple search terms. We assume
+                  the query is the AND of those terms by default.
+      doc_freqs...The doc_frequencies of index, when searching it repeatedly.
+                  If None, the postings of the query words are measured.
+      n_docs......The number of documents, needed for queries like 'NOT a'.
+      documents...The tokenized documents, to match phrases exactly.
+      positions...The positional index, to match phrases exactly without
+                  the documents (see create_positional_index).
     E.g., below we search for documents containing 'a' and 'b':
     >>> search({'a': [0, 1], 'b': [1, 2, 3], 'c': [4]}, 'a b')
     [1]
+    >>> search({'a': [0, 1], 'b': [1, 2, 3], 'c': [4]}, 'zzz a')
+    []
+    >>> search({'a': [0, 1], 'b': [1, 2, 3], 'c': [4]}, '(a OR c) AND NOT b')
+    [0, 4]
     """
-    token_value = tokenize(query)
-    sorted_list = sort_by_num_postings(token_value,index)
-    intersection_list = []
-    if(len(sorted_list) > 0):
-        intersection_list = index[sorted_list[0]]
-    i = 1
-    while(i < len(sorted_list)):
-        intersection_list = intersect(intersection_list,index[sorted_list[i]])
-        i+=1
-    return intersection_list
+    return list(iter_search(index, query, doc_freqs, n_docs, documents, positions))
 
 
+def iter_search(index, query, doc_freqs=None, n_docs=None, documents=None, positions=None):
+    """ Like search, but return a lazy iterator over the matching document
+    ids, so that only the results that are read are computed.
+    >>> import itertools
+    >>> list(itertools.islice(iter_search({'a': range(0, 10 ** 9, 2)}, 'a'), 2, 4))
+    [4, 6]
+    """
+    tree = parse_query(query)
+    if tree is None:
+        return iter([])
+    if doc_freqs is None:
+        doc_freqs = dict((word, len(index[word])) for word in query_words(tree) if word in index)
+    planned, _ = plan_query(tree, doc_freqs, n_docs)
+    return iter(compile_query(index, planned, n_docs, documents, positions))
+
+
+def query_words(query):
+    """ Return the words of a query tree.
+    >>> query_words(('OR', ['a', ('NOT', ('PHRASE', ['b', 'c'])), ('NEAR', (2, ['d', 'e']))]))
+    ['a', 'b', 'c', 'd', 'e']
+    """
+    if isinstance(query, str):
+        return [query]
+    operator, operands = query
+    if operator == 'NOT':
+        return query_words(operands)
+    if operator == 'NEAR':
+        return list(operands[1])
+    return [word for operand in operands for word in query_words(operand)]
 
 
 def main():
-    """ Main method. You should not modify this. """
+    """ Main method. You should not modify this.
+    The index is saved to index.seg and memory-mapped from there on later
+    runs, unless documents.txt has changed since or the segment is in an
+    older layout (see postings.segment_is_current); the documents are only
+    tokenized to build it. Phrases are matched with the positional index.
+    A malformed query is reported, and the next one is run. """
     documents = open('documents.txt').readlines()
-    tokens = [tokenize(d) for d in documents]
-    index = create_index(tokens)
+    if not postings.segment_is_current('index.seg', 'documents.txt'):
+        tokens = [tokenize(d) for d in documents]
+        save_index(create_index(tokens), 'index.seg', create_positional_index(tokens))
+    index = load_index('index.seg')
+    positions = load_positions('index.seg')
+    doc_freqs = doc_frequencies(index)
     queries = open('queries.txt').readlines()
     for query in queries:
-        results = search(index, query)
+        try:
+            results = search(index, query, doc_freqs, len(documents), positions=positions)
+        except ValueError as error:
+            print('\n\nQUERY:%s\nERROR: %s' % (query, error))
+            continue
         print('\n\nQUERY:%s\nRESULTS:\n%s' % (query, '\n'.join(documents[r] for r in results)))
 
 
@@ -6,45 +6,508 @@ The search method will sort documents by the cosine similarity between the
 query and the document (normalized only by the document length, not the query
 length, as in the examples in class).
 The search method also supports a use_champion parameter, which will use a
-champion list (with threshold 10) to perform the search.
+champion list (with threshold 10) to perform the search. The champion lists
+are the first tier of a tiered index: a top-k search falls back to the next
+tiers, and finally to the full index, until it has k results.
+With lazy_idf, the index stores only the (1 + log10(tf)) part of each weight
+and applies idf at query time, so documents can be added without
+recomputing the weights of the existing postings.
 """
-from collections import defaultdict
+from array import array
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+import copy
 from datetime import datetime
 import codecs
-import gzip
+import heapq
+import itertools
 import math
-import re
+import multiprocessing
+import os
+import threading
+
+import shared  # puts IIT/common, with the shared modules, on sys.path
+import analysis
+import cache
+import dictionary
+import postings
+import readers
+
+# Number of documents tokenized and counted by a worker process at a time
+# (see Index.build_parallel).
+SHARD_SIZE = 10000
+
+# Evaluation strategies of Index.search: term at a time, document at a time,
+# and document at a time with MaxScore skipping.
+STRATEGIES = ('taat', 'daat', 'maxscore')
+
+
+def snapshot_attribute(name):
+    """ Return a property reading and writing the attribute name of the
+    Snapshot of an Index. Writing is for an index being built or loaded:
+    updates and merges install a new snapshot instead. """
+    return property(lambda self: getattr(self.snapshot, name),
+                    lambda self, value: setattr(self.snapshot, name, value))
 
 
 class Index(object):
+    index = snapshot_attribute('index')
+    champion_index = snapshot_attribute('champion_index')
+    lower_tiers = snapshot_attribute('lower_tiers')
+    doc_freqs = snapshot_attribute('doc_freqs')
+    doc_lengths = snapshot_attribute('doc_lengths')
+    max_scores = snapshot_attribute('max_scores')
+    n_docs = snapshot_attribute('n_docs')
+    deleted = snapshot_attribute('deleted')
+    version = snapshot_attribute('version')
+    segments = snapshot_attribute('segments')
+    kgrams = snapshot_attribute('kgrams')
 
-    def __init__(self, filename=None, champion_threshold=10):
+    def __init__(self, filename=None, champion_threshold=10, processes=1, compress=False, lazy_idf=False,
+                 tier_sizes=None, analyzer=None):
         """
         Create a new index by parsing the given file containing documents,
-        one per line. """
+        one per line. The file is read one document at a time (see
+        read_lines) and the documents are not kept. If processes is more than 1, the documents are
+        tokenized, counted, merged and weighted by a pool of worker processes
+        (see build_parallel). If compress is true, postings and champion lists are
+        stored as CompressedPostings with quantized weights (see the postings
+        module): this saves memory at the cost of a small error in each
+        tf-idf weight, so scores are approximate. Once built, the terms are
+        kept in a front-coded dictionary (see the dictionary module) rather
+        than in dicts. Set fuzzy_distance to correct misspelled query terms
+        (see query_to_vector). If lazy_idf is true, the postings and champion
+        lists store (1 + log10(tf)) weights, idf is applied at query time and
+        the document lengths are kept as NormSums; add_documents,
+        delete_documents and merge are only supported by such an index, and
+        deleted holds the ids of the deleted documents. The postings, tiers,
+        document frequencies and lengths, and the values cached from them,
+        are attributes of a Snapshot, which updates and merges replace as a
+        whole; a search reads a single snapshot throughout (see pin).
+        Without a filename, the index starts empty, with n_docs 0, and
+        documents can then be added to it (with lazy_idf). tier_sizes maps the
+        document frequency of a term to the sizes of its tiers (see
+        create_tiered_index); it defaults to default_tier_sizes. Set cache to
+        a cache.ResultCache to reuse the results of search; version counts
+        the updates of the index. Documents and queries are turned into
+        terms by analyzer (see analysis.Analyzer), which defaults to the
+        tokenize rules below and is saved with the index. """
+        self.analyzer = analyzer or analysis.Analyzer()
+        self.snapshot = Snapshot()
+        self.fuzzy_distance = 0
+        self.champion_threshold = champion_threshold
+        self.compress = compress
+        self.lazy_idf = lazy_idf
+        self.tier_sizes = tier_sizes or self.default_tier_sizes
+        self.lock = threading.Lock()
+        self.cache = None
         if filename:  # filename may be None for testing purposes.
-            t1 = datetime.now()
-            self.documents = self.read_lines(filename)
-            t2 = datetime.now() - t1
-            print("documents read completed, consuming " + str(t2))
-
-            t3 = datetime.now()
-            toked_docs = [self.tokenize(d) for d in self.documents]
-            t4 = datetime.now() - t3
-            print("docs tokenlization completed, consuming " + str(t4))
-
             t5 = datetime.now()
-            self.doc_freqs = self.count_doc_frequencies(toked_docs)
+            documents = readers.CountingIterator(self.read_lines(filename))
+            if processes > 1:
+                self.doc_freqs, self.index, self.doc_lengths = self.build_parallel(documents, processes, lazy_idf)
+                self.n_docs = documents.n
+            else:
+                counts = self.count_terms(self.analyzer.analyze_batch(documents))
+                self.n_docs = documents.n
+                if lazy_idf:
+                    self.doc_freqs, self.index = counts
+                    self.doc_lengths = NormSums(self.snapshot, self.index, self.doc_freqs)
+                else:
+                    self.doc_freqs, self.index, self.doc_lengths = self.finish_index(*counts, n_docs=self.n_docs)
             t6 = datetime.now() - t5
-            print("doc_frequency completed, consuming " + str(t6))
+            print("index built completed, consuming " + str(t6))
+
+            tiers = [self.freeze_postings(tier) for tier in self.create_tiered_index(self.index, self.tier_sizes)]
+            self.index = self.freeze_postings(self.index)
+            terms = dictionary.FrontCodedDictionary(self.index)
+            if lazy_idf:
+                # Lengths change with N, so these are computed on demand (see max_score).
+                self.max_scores = {}
+            else:
+                # Computed from the stored weights, which compression may round up.
+                self.max_scores = dictionary.compact(self.compute_max_scores(self.index, self.doc_lengths),
+                                                     terms, 'd')
+            self.index = dictionary.compact(self.index, terms)
+            self.champion_index = dictionary.compact(tiers[0], terms)
+            self.lower_tiers = [dictionary.compact(tier, terms) for tier in tiers[1:]]
+            self.doc_freqs = dictionary.compact(self.doc_freqs, terms, 'q')
+
+    def freeze_postings(self, index):
+        """ Return index with its postings lists frozen, or compressed with
+        quantized weights if the index is compressed. """
+        if self.compress:
+            return postings.compress_index(index, quantize=True)
+        return postings.freeze_index(index)
+
+    def add_documents(self, documents):
+        """
+        Add documents, given as strings, to an index built with lazy_idf.
+        Their postings go to an in-memory delta segment, read together with
+        the main segment until the next merge (see Segments and
+        LivePostings): only the postings of their terms are rebuilt, and the
+        tiers and the lengths follow on first use. New terms are not in the
+        front-coded dictionary (see terms) until the next merge.
+        Returns:
+          The list of ids given to the new documents.
+        >>> idx = Index(lazy_idf=True)
+        >>> idx.add_documents(['a b a', 'a c'])
+        [0, 1]
+        >>> idx.add_documents(['c d'])
+        [2]
+        >>> idx.search('c a')  # doctest:+ELLIPSIS
+        [(1, 0.249...), (0, 0.076...), (2, 0.060...)]
+        """
+        if not self.lazy_idf:
+            raise ValueError('documents can only be added to an index built with lazy_idf')
+        with self.lock:
+            first_doc_id = self.n_docs + len(self.deleted)
+            doc_freqs, index = self.count_terms(self.analyzer.analyze_batch(documents), first_doc_id)
+            self.install(self.current_segments().with_documents(index), self.n_docs + len(documents),
+                         self.deleted)
+            return list(range(first_doc_id, first_doc_id + len(documents)))
+
+    def delete_documents(self, doc_ids):
+        """
+        Delete documents from an index built with lazy_idf. Their ids are
+        kept in deleted, and are not given to documents added later. They are
+        recorded as tombstones, and their postings are skipped until the next
+        merge drops them, so a deletion does not depend on the size of the
+        index. The lengths of the documents sharing terms with them are
+        recomputed on first use (see LiveLengths).
+        >>> idx = Index(lazy_idf=True)
+        >>> _ = idx.add_documents(['a b a', 'a c', 'c d', 'e'])
+        >>> idx.delete_documents([1, 3, 9])
+        >>> idx.n_docs, idx.doc_freqs['c'], idx.search('c a e')  # doctest:+ELLIPSIS
+        (2, 1, [(0, 0.238...), (2, 0.212...)])
+        >>> idx.add_documents(['a'])
+        [4]
+        >>> idx = Index(lazy_idf=True)
+        >>> _ = idx.add_documents(['a b', 'a c', 'b c'])
+        >>> idx.delete_documents([1, 2])
+        >>> [idx.search('a', k=1, strategy=s) for s in STRATEGIES], idx.search('a')
+        ([[(0, 0.0)], [(0, 0.0)], [(0, 0.0)]], [(0, 0.0)])
+        """
+        if not self.lazy_idf:
+            raise ValueError('documents can only be deleted from an index built with lazy_idf')
+        with self.lock:
+            doc_ids = set(doc_id for doc_id in doc_ids if 0 <= doc_id < self.n_docs + len(self.deleted)) - self.deleted
+            if not doc_ids:
+                return
+            self.install(self.current_segments().without_documents(doc_ids), self.n_docs - len(doc_ids),
+                         self.deleted | doc_ids)
 
-            t7 = datetime.now()
-            self.index = self.create_tfidf_index(toked_docs, self.doc_freqs)
-            t8 = datetime.now() - t7
-            print("index built completed, consuming " + str(t8))
+    def current_segments(self):
+        """ Return the Segments of the index, or new Segments with the
+        current index as their main segment and no updates yet. """
+        if self.segments is not None:
+            return self.segments
+        if self.index is None:
+            return Segments({}, [{} for _ in self.tier_sizes(1)], NormSums(self.snapshot, {}, {}))
+        return Segments(self.index, [self.champion_index] + self.lower_tiers, self.doc_lengths)
 
-            self.doc_lengths = self.compute_doc_lengths(self.index)
-            self.champion_index = self.create_champion_index(self.index, champion_threshold)
+    def install(self, segments, n_docs, deleted):
+        """ Replace the snapshot, with a single assignment, by one reading
+        the postings, tiers, document frequencies and lengths through views
+        of segments, with the given number of documents and deleted ids. The
+        tiers have as many levels as those of a term in every document. The
+        lengths start from those of the current snapshot if a search has
+        computed them already (see LiveLengths). """
+        live = LivePostings(segments, self.freeze_postings)
+        levels = max(len(segments.main_tiers), len(self.tier_sizes(n_docs + len(deleted))))
+        tiers = LiveTiers(live, levels, self)
+        snapshot = Snapshot(live, LiveTier(tiers, 0), [LiveTier(tiers, level) for level in range(1, levels)],
+                            LiveFreqs(live), None, n_docs, frozenset(deleted), self.version + 1, segments)
+        previous = self.doc_lengths
+        if not isinstance(previous, LiveLengths) or previous.norm_sums is None:
+            previous = None
+        snapshot.doc_lengths = LiveLengths(snapshot, live, previous)
+        snapshot.kgrams = self.kgrams
+        self.snapshot = snapshot
+
+    def pin(self):
+        """
+        Return a copy of the index that reads the current snapshot only, so
+        that every value a search computes (idfs, lengths, bounds) comes from
+        the same state of the index, whatever updates are installed
+        meanwhile. The copy is for reading: update the index itself.
+        >>> idx = Index(lazy_idf=True)
+        >>> _ = idx.add_documents(['a b', 'b c'])
+        >>> pinned = idx.pin()
+        >>> idx.add_documents(['a'])
+        [2]
+        >>> pinned.n_docs, pinned.search('a'), idx.n_docs  # doctest:+ELLIPSIS
+        (2, [(0, 0.301...)], 3)
+        """
+        pinned = copy.copy(self)
+        pinned.snapshot = self.snapshot
+        return pinned
+
+    def merge(self, background=False):
+        """
+        Fold the delta segment and the tombstones into a new front-coded
+        dictionary, as the index is built: deleted postings are dropped,
+        terms left without postings too, and the terms of added documents
+        become visible to wildcards and spelling suggestions (see terms). Ids
+        and deleted are kept. Searches keep using the old snapshot until the
+        merged one is installed, with a single assignment. If background is
+        true, the merge runs in a thread, which is returned; updates made
+        meanwhile wait for it to finish.
+        >>> idx = Index(lazy_idf=True)
+        >>> _ = idx.add_documents(['a b a', 'a c', 'c d'])
+        >>> idx.delete_documents([2])
+        >>> before = idx.search('c a')
+        >>> idx.merge()
+        >>> list(idx.terms()), idx.search('c a') == before, idx.suggest('dd'), idx.expand_wildcards(['*'])
+        (['a', 'b', 'c'], True, [], ['a', 'b', 'c'])
+        >>> _ = idx.add_documents(['d'])
+        >>> idx.merge(background=True).join()
+        >>> idx.segments, list(idx.terms()), idx.search('c a') == before
+        (None, ['a', 'b', 'c', 'd'], False)
+        """
+        if not background:
+            return self.merge_segments()
+        thread = threading.Thread(target=self.merge_segments)
+        thread.start()
+        return thread
+
+    def merge_segments(self):
+        """ Run the merge described in merge. The merged snapshot is built
+        from the current one: the postings and tiers of the terms no update
+        touched are read from the main segment in term order (see
+        term_items), and its lengths are those of the current snapshot. """
+        with self.lock:
+            snapshot = self.snapshot
+            if snapshot.segments is None:
+                return
+            index = dict(snapshot.index.live_items())
+            terms = dictionary.FrontCodedDictionary(index)
+            empty = self.freeze_postings({'': []})['']
+            tiers = []
+            for tier in [snapshot.champion_index] + snapshot.lower_tiers:
+                tier_items = dict(tier.live_items())
+                tiers.append(dictionary.compact(dict((term, tier_items.get(term, empty)) for term in terms), terms))
+            merged = Snapshot(dictionary.compact(index, terms), tiers[0], tiers[1:],
+                              dictionary.compact(dict((term, len(pairs)) for term, pairs in index.items()), terms, 'q'),
+                              None, snapshot.n_docs, snapshot.deleted, snapshot.version + 1)
+            merged.doc_lengths = snapshot.doc_lengths.current().copy(merged)
+            self.snapshot = merged
+
+    def create_index(self, docs):
+        """
+        Build the document frequencies, the tf-idf index and the document
+        lengths together. Term frequencies are counted once per document and
+        the postings are filled in the same pass, storing the (1 + log10(tf))
+        part of each weight; once every document has been seen the idf factor
+        is known, so a single walk over the postings finishes the weights and
+        accumulates the lengths.
+        Parameters:
+        docs...list of lists, where each sublist contains the tokens for one document.
+        Returns:
+          A tuple (doc_freqs, index, doc_lengths), equal to the outputs of
+          count_doc_frequencies, create_tfidf_index and compute_doc_lengths.
+        >>> doc_freqs, index, lengths = Index().create_index([['a', 'b', 'a'], ['a'], ['a', 'b', 'a']])
+        >>> doc_freqs['a'], doc_freqs['b']
+        (3, 2)
+        >>> index['b']  # doctest:+ELLIPSIS
+        [[0, 0.176...], [2, 0.176...]]
+        >>> lengths[2]  # doctest:+ELLIPSIS
+        0.176...
+        """
+        return self.finish_index(*self.count_terms(docs), n_docs=len(docs))
+
+    def count_terms(self, docs, first_doc_id=0):
+        """
+        Count term frequencies once per document and fill the document
+        frequencies and the postings in the same pass, storing the
+        (1 + log10(tf)) part of each weight.
+        Parameters:
+        docs...........iterable of lists of tokens, one per document.
+        first_doc_id...the id of the first document.
+        Returns:
+          A tuple (doc_freqs, index).
+        >>> Index().count_terms([['a', 'b', 'a'], ['b']], 3)[1]['b']
+        [[3, 1.0], [4, 1.0]]
+        """
+        doc_freqs = defaultdict(int)
+        index = defaultdict(list)
+        for doc_id, doc in enumerate(docs, first_doc_id):
+            for term, tf in Counter(doc).items():
+                doc_freqs[term] += 1
+                index[term].append([doc_id, 1. + math.log(tf, 10)])
+        return dict(doc_freqs), dict(index)
+
+    def build_parallel(self, documents, processes, lazy_idf=False, shard_size=SHARD_SIZE):
+        """
+        Build the postings of the raw documents, any iterable, with a pool of
+        worker processes, in two rounds. First, contiguous shards of
+        shard_size documents are tokenized and counted (see count_shard), one
+        round of processes shards at a time, so only that many documents are
+        held at once, and the counts of each shard are split into processes
+        partitions of the terms (see postings.split_by_term). Then each
+        worker owns one partition: it merges the postings of its terms in
+        document order and computes their share of the document lengths,
+        weighting the postings by idf first unless lazy_idf is true (see
+        finish_partition). The partitions share no term, so the parent only
+        joins them and adds up the shares of each document.
+        Returns:
+          A tuple (doc_freqs, index, doc_lengths), as finish_index returns
+          over count_terms of all the tokenized documents, up to the
+          rounding of the lengths; with lazy_idf, index holds the weights of
+          count_terms and doc_lengths is a NormSums.
+        >>> doc_freqs, index, lengths = Index().build_parallel(['a b a', 'b c', 'a'], 2, shard_size=2)
+        >>> serial = Index().create_index([['a', 'b', 'a'], ['b', 'c'], ['a']])
+        >>> (doc_freqs, index) == serial[:2], all(abs(lengths[d] - serial[2][d]) < 1e-12 for d in serial[2])
+        (True, True)
+        """
+        shards = readers.shards(documents, shard_size)
+        partitions = [[] for _ in range(processes)]
+        n_docs = 0
+        pool = multiprocessing.Pool(processes)
+        try:
+            while True:
+                round_shards = [(shard, first_doc_id, self.analyzer, processes)
+                                for shard, first_doc_id in itertools.islice(shards, processes)]
+                results = pool.map(count_shard, round_shards, chunksize=1)
+                if not results:
+                    break
+                for shard_partitions in results:
+                    for partition, counts in zip(partitions, shard_partitions):
+                        partition.append(counts)
+                n_docs += sum(len(shard) for shard, _, _, _ in round_shards)
+            finished = pool.map(finish_partition, [(partition, n_docs, lazy_idf) for partition in partitions],
+                                chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        doc_freqs, index = {}, {}
+        if lazy_idf:
+            doc_lengths = NormSums(self.snapshot, {}, {})
+            doc_lengths.resize(n_docs)
+        else:
+            doc_lengths = defaultdict(float)
+        for partition_freqs, partition_index, partition_lengths in finished:
+            doc_freqs.update(partition_freqs)
+            index.update(partition_index)
+            if lazy_idf:
+                doc_lengths.add(partition_lengths)
+            else:
+                for doc_id, square in partition_lengths.items():
+                    doc_lengths[doc_id] += square
+        if not lazy_idf:
+            doc_lengths = dict((doc_id, math.sqrt(square)) for doc_id, square in doc_lengths.items())
+        return doc_freqs, index, doc_lengths
+
+    def finish_index(self, doc_freqs, index, n_docs):
+        """
+        Multiply the weights stored by count_terms by the idf of their term,
+        which is only known once every document has been counted, and
+        accumulate the document lengths in the same walk over the postings
+        (see finish_weights).
+        Returns:
+          A tuple (doc_freqs, index, doc_lengths).
+        """
+        doc_lengths = self.finish_weights(doc_freqs, index, n_docs)
+        for doc_id in doc_lengths:
+            doc_lengths[doc_id] = math.sqrt(doc_lengths[doc_id])
+        return doc_freqs, index, dict(doc_lengths)
+
+    def finish_weights(self, doc_freqs, index, n_docs):
+        """ Multiply the weights of index by the idf of their term, in place,
+        and return a dict mapping each document id to the sum of its squared
+        weights. """
+        squares = defaultdict(float)
+        for term, postings in index.items():
+            idf = math.log(n_docs / doc_freqs[term], 10)
+            for posting in postings:
+                posting[1] *= idf
+                squares[posting[0]] += posting[1] ** 2
+        return squares
+
+    def save(self, path):
+        """
+        Write the index to a binary segment file (see postings.write_segment):
+        the sorted term dictionary with document frequencies and maximum
+        scores, the postings and the tiers, and the document lengths (with
+        lazy_idf, their sums and the ids of the deleted documents).
+        """
+        terms, blob, offsets = postings.pack_terms(self.index.keys())
+        sections = [('terms', blob),
+                    ('term_offsets', offsets),
+                    ('doc_freqs', array('q', [self.doc_freqs[term] for term in terms]))]
+        if not self.lazy_idf:
+            sections.append(('max_scores', array('d', [self.max_scores[term] for term in terms])))
+        tiers = [('champions', self.champion_index)] + [('tier%d' % i, tier) for i, tier in enumerate(self.lower_tiers, 1)]
+        for name, index in [('postings', self.index)] + tiers:
+            starts = array('q', [0])
+            doc_ids = array('i')
+            weights = array('d')
+            for term in terms:
+                term_doc_ids, term_weights = postings.columns(index.get(term, ()))
+                doc_ids.extend(term_doc_ids)
+                weights.extend(term_weights)
+                starts.append(len(doc_ids))
+            sections += [(name + '_starts', starts), (name + '_doc_ids', doc_ids), (name + '_weights', weights)]
+        if self.lazy_idf:
+            sections += [('length_' + name, array('d', sums)) for name, sums in self.doc_lengths.sums()]
+            sections.append(('deleted', array('q', sorted(self.deleted))))
+        else:
+            sections.append(('doc_lengths', postings.dense(self.doc_lengths, self.n_docs)))
+        postings.write_segment(path, {'n_docs': self.n_docs, 'lazy_idf': self.lazy_idf, 'n_tiers': len(tiers),
+                                      'analyzer': self.analyzer.config()}, sections)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Open an index saved with save. The segment is memory-mapped, so
+        loading takes the same time whatever the size of the index; terms
+        are looked up by binary search in the mapped dictionary and postings
+        are views into the mapped file.
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'index.seg')
+        >>> idx = Index()
+        >>> idx.n_docs = 2
+        >>> idx.doc_freqs, idx.index, idx.doc_lengths = idx.create_index([['a', 'b', 'a'], ['a', 'c']])
+        >>> idx.champion_index = idx.create_champion_index(idx.index, 1)
+        >>> idx.max_scores = idx.compute_max_scores(idx.index, idx.doc_lengths)
+        >>> idx.save(path)
+        >>> loaded = Index.load(path)
+        >>> loaded.search('b a')  # doctest:+ELLIPSIS
+        [(0, 0.301...), (1, 0.0)]
+        >>> loaded.doc_freqs['a'], list(loaded.champion_index['a'])
+        (2, [(0, 0.0)])
+        """
+        metadata, sections = postings.read_segment(path)
+        idx = cls()
+        idx.n_docs = metadata['n_docs']
+        idx.analyzer = analysis.Analyzer(**metadata.get('analyzer', {}))
+        idx.lazy_idf = metadata.get('lazy_idf', False)
+        terms, offsets = sections['terms'], sections['term_offsets']
+        idx.doc_freqs = postings.TermTable(terms, offsets, sections['doc_freqs'].__getitem__)
+        idx.index = cls.postings_table(sections, 'postings')
+        idx.champion_index = cls.postings_table(sections, 'champions')
+        idx.lower_tiers = [cls.postings_table(sections, 'tier%d' % i) for i in range(1, metadata.get('n_tiers', 1))]
+        if idx.lazy_idf:
+            idx.max_scores = {}
+            idx.deleted = frozenset(sections['deleted']) if 'deleted' in sections else frozenset()
+            idx.doc_lengths = NormSums(idx.snapshot, {}, {})
+            idx.doc_lengths.squares, idx.doc_lengths.log_dfs, idx.doc_lengths.log_dfs2 = (
+                array('d', sections['length_' + name]) for name in ('squares', 'log_dfs', 'log_dfs2'))
+        else:
+            idx.max_scores = postings.TermTable(terms, offsets, sections['max_scores'].__getitem__)
+            idx.doc_lengths = postings.DenseMap(sections['doc_lengths'])
+        return idx
+
+    @staticmethod
+    def postings_table(sections, name):
+        """ Return a TermTable over the postings stored under name in the
+        sections of a segment. """
+        starts = sections[name + '_starts']
+        doc_ids = sections[name + '_doc_ids']
+        weights = sections[name + '_weights']
+        return postings.TermTable(sections['terms'], sections['term_offsets'], lambda term_id: (
+            postings.Postings.from_arrays(doc_ids[starts[term_id]:starts[term_id + 1]],
+                                          weights[starts[term_id]:starts[term_id + 1]])))
 
     def compute_doc_lengths(self, index):
         """
@@ -70,11 +533,40 @@ class Index(object):
             length_dict[key] = math.sqrt(length_dict[key])
         return length_dict
 
+    def compute_max_scores(self, index, doc_lengths):
+        """
+        Return a dict mapping each term to the largest length-normalized
+        weight (tf-idf weight / document length) in its postings list. The
+        contribution of a term with query weight q to any cosine score is at
+        most q times this value; the bound also holds for the champion index,
+        whose postings are a subset of the full index.
+        >>> Index().compute_max_scores({'a': [[0, 3], [1, 2]], 'b': [[0, 4]]}, {0: 5., 1: 2.})
+        {'a': 1.0, 'b': 0.8}
+        """
+        max_scores = {}
+        for term, postings in index.items():
+            max_scores[term] = max(w / doc_lengths[doc_id] if doc_lengths[doc_id] else 0.
+                                   for doc_id, w in postings)
+        return max_scores
+
+    def max_score(self, term):
+        """ Return the maximum score of term for the top-k search of an index
+        built with lazy_idf: the largest (1 + log10(tf)) weight divided by
+        the document length, computed on first use after each update. """
+        if term not in self.max_scores:
+            self.max_scores[term] = self.compute_max_scores({term: self.index[term]}, self.doc_lengths)[term]
+        return self.max_scores[term]
+
+    def idf(self, term):
+        """ Return log10(N / df) for a term of the index. """
+        return math.log(1.0 * self.n_docs / self.doc_freqs[term], 10)
+
     def create_champion_index(self, index, threshold=10):
         """
         Create an index mapping each term to its champion list, defined as the
         documents with the K highest tf-idf values for that term (the
-        threshold parameter determines K).
+        threshold parameter determines K). Each champion list is kept in
+        increasing doc_id order, like the postings lists.
         In the example below, the champion list for term 'a' contains
         documents 1 and 2; the champion list for term 'b' contains documents 0
         and 1.
@@ -84,9 +576,45 @@ class Index(object):
         """
         champs = {}
         for term in index:
-            champs[term] = sorted(index[term], key=lambda f: f[1], reverse=True)[0:threshold]
+            champs[term] = sorted(heapq.nlargest(threshold, index[term], key=lambda f: f[1]))
         return champs
 
+    def create_tiered_index(self, index, tier_sizes):
+        """
+        Split each postings list into tiers by decreasing weight: the first
+        tier is the champion list, each following tier holds the next best
+        postings. tier_sizes maps the document frequency of a term to the
+        sizes of its tiers; postings past the last tier are only in the full
+        index. The best postings are selected with heapq.nlargest, which
+        keeps the order of sorted on ties, rather than with a full sort.
+        Returns:
+          A list of indexes, one per tier, each with every term of index and
+          its postings kept in increasing doc_id order.
+        >>> tiers = Index().create_tiered_index({'a': [[0, 10], [1, 20], [2, 15], [3, 5]], 'b': [[4, 1]]},
+        ...                                     lambda df: [1, 2])
+        >>> tiers
+        [{'a': [[1, 20]], 'b': [[4, 1]]}, {'a': [[0, 10], [2, 15]], 'b': []}]
+        """
+        sizes = dict((term, tier_sizes(len(pairs))) for term, pairs in index.items())
+        tiers = [{} for _ in range(max([len(term_sizes) for term_sizes in sizes.values()] or [0]))]
+        for term, pairs in index.items():
+            best = heapq.nlargest(sum(sizes[term]), pairs, key=lambda f: f[1])
+            start = 0
+            for tier, size in zip(tiers, sizes[term] + [0] * len(tiers)):
+                tier[term] = sorted(best[start:start + size])
+                start += size
+        return tiers
+
+    def default_tier_sizes(self, df):
+        """
+        Return the tier sizes of a term with document frequency df: the
+        champion list, then a tier with the next tenth of the postings (at
+        least champion_threshold). Rare terms fit in the champion list.
+        >>> Index().default_tier_sizes(500)
+        [10, 50]
+        """
+        return [self.champion_threshold, max(self.champion_threshold, df // 10)]
+
     def create_termdoc_index(self,docs):
         """ Create a dict with
             key:term, value:[doc_1,doc_2...]
@@ -124,13 +652,14 @@ class Index(object):
         [[0, 0.301...]]
         """
         index = {}
-        for doc in docs:
-            for term in list(set(doc)):
-                w_td = (1.0+math.log(doc.count(term),10)) * (1.0*math.log(len(docs)/doc_freqs[term],10))
+        n_docs = len(docs)
+        for doc_id, doc in enumerate(docs):
+            for term, tf in Counter(doc).items():
+                w_td = (1.0 + math.log(tf, 10)) * math.log(n_docs / doc_freqs[term], 10)
                 if term in index:
-                    index[term].append([docs.index(doc),w_td])
+                    index[term].append([doc_id, w_td])
                 else:
-                    index[term] = [[docs.index(doc),w_td]]
+                    index[term] = [[doc_id, w_td]]
         return index
 
     def count_doc_frequencies(self, docs):
@@ -143,20 +672,19 @@ class Index(object):
         >>> res['c']
         1
         """
-        dic = {}
+        dic = Counter()
         for doc in docs:
-            for t in set(doc):
-                if t in dic:
-                    dic[t] += 1
-                else:
-                    dic[t] = 1
-        return dic
+            dic.update(set(doc))
+        return dict(dic)
 
     def query_to_vector(self, query_terms):
         """ Convert a list of query terms into a dict mapping term to inverse document frequency (IDF).
         Compute IDF of term T as log10(N / (document frequency of T)), where N is the total number of documents.
         You may need to use the instance variables of the Index object to compute this. Do not modify the method signature.
-        If a query term is not in the index, simply omit it from the result.
+        If a query term is not in the index, or has no postings left after
+        delete_documents, simply omit it from the result,
+        unless fuzzy_distance is set: the term is then replaced with its
+        closest terms in the index (see suggest).
         Parameters:
           query_terms....list of terms
         Returns:
@@ -164,8 +692,11 @@ class Index(object):
         """
         q_vector = {}
         for term in list(set(query_terms)):
-            if term in self.doc_freqs:
-                q_vector[term] = math.log(1.0 * len(self.documents) / self.doc_freqs[term], 10)
+            if self.doc_freqs.get(term):
+                q_vector[term] = math.log(1.0 * self.n_docs / self.doc_freqs[term], 10)
+            elif self.fuzzy_distance:
+                for match in self.suggest(term, self.fuzzy_distance):
+                    q_vector[match] = math.log(1.0 * self.n_docs / self.doc_freqs[match], 10)
         return q_vector
 
     def search_by_cosine(self, query_vector, index, doc_lengths):
@@ -174,7 +705,9 @@ class Index(object):
         cosine similarity between the query_vector and the document. The
         document length should be used in the denominator, but not the query
         length (as discussed in class). You can use the built-in sorted method
-        (rather than a priority queue) to sort the results.
+        (rather than a priority queue) to sort the results. They are sorted by
+        descending score rounded to 6 decimal places, then by ascending
+        doc_id, the order of every search strategy (see search).
         The parameters are:
 
         query_vector.....dict from term to weight from the query
@@ -188,23 +721,87 @@ class Index(object):
         [(1, 2.0), (0, 1.0)]
         """
         cache_dict = {}
-        for term in query_vector.keys():
+        for term, term_weight in query_vector.items():
             for doc_pair in index[term]:
-                if doc_pair[0] in cache_dict.keys():
-                    cache_dict[doc_pair[0]] += query_vector[term] * doc_pair[1]
+                if doc_pair[0] in cache_dict:
+                    cache_dict[doc_pair[0]] += term_weight * doc_pair[1]
                 else:
-                    cache_dict[doc_pair[0]] = query_vector[term] * doc_pair[1]
+                    cache_dict[doc_pair[0]] = term_weight * doc_pair[1]
 
         cos_sim = []
 
-        for doc_id in cache_dict.keys():
-            cache_dict[doc_id] /= doc_lengths[doc_id]
-            cos_sim.append((doc_id, cache_dict[doc_id]))
+        normalize = self.normalizer(doc_lengths)
+        for doc_id, score in cache_dict.items():
+            cos_sim.append((doc_id, normalize(doc_id, score)))
 
-        cos_sim.sort(key=lambda key: key[1], reverse=True)
+        cos_sim.sort(key=lambda key: (-round(key[1], 6), key[0]))
         return cos_sim
 
-    def search(self, query, use_champions=False):
+    def search_top_k_by_cosine(self, query_vector, index, doc_lengths, max_scores, k):
+        """
+        Return the k (doc_id, score) pairs with the highest cosine similarity,
+        as computed by search_by_cosine, in the order of search_by_cosine. The
+        postings are traversed document at a time with the MaxScore strategy
+        (see postings.maxscore): once k documents have been found, query terms whose combined maximum
+        contribution cannot beat the k-th best score are only probed for
+        documents found through the other terms, and probing stops as soon as
+        a document can no longer enter the top k.
+        The parameters are those of search_by_cosine, plus:
+
+        max_scores.......dict from term to maximum normalized weight (output of compute_max_scores)
+        k................the number of results to return
+
+        >>> Index().search_top_k_by_cosine({'a': 1, 'b': 2}, {'a': [[0, 1], [1, 2], [2, 4]], 'b': [[1, 1], [3, 3]]},
+        ...                                {0: 1, 1: 1, 2: 2, 3: 3}, {'a': 2., 'b': 1.}, 2)
+        [(1, 4.0), (2, 2.0)]
+        """
+        terms = sorted((query_vector[term] * max_scores[term], term) for term in query_vector)
+        return postings.maxscore([postings.Cursor(index[term]) for _, term in terms],
+                                 [self.term_scorer(query_vector[term]) for _, term in terms],
+                                 [bound for bound, _ in terms], k, self.normalizer(doc_lengths))
+
+    def search_daat_by_cosine(self, query_vector, index, doc_lengths, k=None):
+        """
+        Return the k (doc_id, score) pairs with the highest cosine similarity,
+        or all of them if k is None, in the order of search_top_k_by_cosine.
+        The postings lists of the query terms are merged by doc_id through a
+        heap of cursors (see postings.daat), so each document is scored
+        completely when it is reached and only the k best so far are kept:
+        unlike search_by_cosine, memory does not grow with the number of
+        matching documents. Every posting is visited.
+        The parameters are those of search_by_cosine, plus:
+
+        k................the number of results to return, or None for all
+
+        >>> Index().search_daat_by_cosine({'a': 1, 'b': 2}, {'a': [[0, 1], [1, 2], [2, 4]], 'b': [[1, 1], [3, 3]]},
+        ...                               {0: 1, 1: 1, 2: 2, 3: 3}, 2)
+        [(1, 4.0), (2, 2.0)]
+        """
+        return postings.daat([postings.Cursor(index[term]) for term in query_vector],
+                             [self.term_scorer(weight) for weight in query_vector.values()], k,
+                             self.normalizer(doc_lengths))
+
+    @staticmethod
+    def term_scorer(query_weight):
+        """ Return the function adding a posting of a query term, of the
+        given weight, to the cosine numerator of its document. """
+        return lambda doc_id, weight: query_weight * weight
+
+    @staticmethod
+    def normalizer(doc_lengths):
+        """
+        Return the function dividing the cosine numerator of a document by
+        its length. A document of length 0, whose terms all occur in every
+        document, scores 0, as in compute_max_scores.
+        >>> Index().normalizer({0: 2., 1: 0.})(0, 1.), Index().normalizer({0: 2., 1: 0.})(1, 0.)
+        (0.5, 0.0)
+        """
+        def normalize(doc_id, score):
+            length = doc_lengths[doc_id]
+            return score / length if length else 0.
+        return normalize
+
+    def search(self, query, use_champions=False, k=None, strategy=None):
         """ Return the document ids for documents matching the query. Assume that
         query is a single string, possible containing multiple words. Assume
         queries with multiple words are AND queries. The steps are to:
@@ -213,57 +810,571 @@ class Index(object):
         3. Compute cosine similarity between query vector and each document (calling search_by_cosine).
         Parameters:
         query...........raw query string, possibly containing multiple terms (though boolean operators do not need to be supported)
-        use_champions...If True, Step 4 above will use only the champion index to perform the search.
+        use_champions...If True, Step 4 above will use only the champion index to perform the search,
+                        or the tiers needed for k results if k is given (calling search_tiers).
+        k...............If given, only the k best matches are returned (calling search_top_k_by_cosine).
+        strategy........How Step 3 is evaluated (see STRATEGIES): 'taat' scores every match term at a time
+                        (search_by_cosine), 'daat' document at a time keeping only the k best
+                        (search_daat_by_cosine), and 'maxscore' also skips the documents that cannot make the
+                        top k (search_top_k_by_cosine; without k, it is 'daat'). By default, 'maxscore' is
+                        used when k is given and 'taat' otherwise. The tiers of use_champions with k are
+                        searched the same way whatever the strategy.
+        Words containing * are replaced with the terms they match (see expand_wildcards).
+        With lazy_idf, each query weight is multiplied by the idf of its term,
+        which the stored weights lack, so scores are the same as without.
+        If the index has a cache (see cache.ResultCache), the results are
+        looked up there first, keyed by the set of query tokens,
+        use_champions, k and fuzzy_distance, and stored with the version of
+        the snapshot they were ranked with (see pin).
         """
 
-        tokens = self.tokenize(query)
-        idf_vector = self.query_to_vector(tokens)
+        pinned = self.pin()
+        query, patterns = dictionary.split_wildcards(query)
+        tokens = pinned.tokenize(query) + pinned.expand_wildcards(patterns)
+        if pinned.cache is None:
+            return pinned.rank(tokens, use_champions, k, strategy)
+        key = cache.query_key(tokens, use_champions, k, pinned.fuzzy_distance)
+        result = pinned.cache.get(key, pinned.version)
+        if result is None:
+            result = pinned.rank(tokens, use_champions, k, strategy)
+            pinned.cache.put(key, result, pinned.version)
+        return list(result)
 
-        if use_champions:
-            return self.search_by_cosine(idf_vector, self.champion_index, self.doc_lengths)
-        else:
-            return self.search_by_cosine(idf_vector, self.index, self.doc_lengths)
+    def rank(self, tokens, use_champions=False, k=None, strategy=None):
+        """ Return the (doc_id, score) pairs for a tokenized query, as
+        described in search, ranked against one snapshot of the index (see
+        pin).
+        >>> idx = Index(lazy_idf=True)
+        >>> _ = idx.add_documents(['a b a', 'a c', 'c d'])
+        >>> [[doc_id for doc_id, _ in idx.rank(['c', 'a'], k=2, strategy=s)] for s in STRATEGIES]
+        [[1, 0], [1, 0], [1, 0]]
+        >>> [idx.rank(['c', 'a'], k=0, strategy=s) for s in STRATEGIES], idx.rank(['c', 'a'], True, 0)
+        ([[], [], []], [])
+        >>> _ = idx.add_documents(['a c', 'b', 'c a'])
+        >>> [idx.rank(['c', 'a'], strategy=s) for s in STRATEGIES] == 3 * [idx.rank(['c', 'a'])]
+        True
+        >>> [doc_id for doc_id, _ in idx.rank(['c', 'a'])]
+        [1, 3, 5, 0, 2]
+        """
+        if strategy is None:
+            strategy = 'taat' if k is None else 'maxscore'
+        if strategy not in STRATEGIES:
+            raise ValueError('unknown strategy %r, expected one of %s' % (strategy, ', '.join(STRATEGIES)))
+        pinned = self.pin()
+        idf_vector = pinned.query_to_vector(tokens)
+        index = pinned.champion_index if use_champions else pinned.index
+        max_scores = pinned.max_scores
+        if pinned.lazy_idf:
+            # The stored weights lack their idf factor, so it moves to the query side.
+            idf_vector = dict((term, weight * pinned.idf(term)) for term, weight in idf_vector.items())
+            max_scores = dict((term, pinned.max_score(term)) for term in idf_vector)
+
+        if k is not None and use_champions:
+            return pinned.search_tiers(idf_vector, max_scores, k)
+        if k is not None and strategy == 'maxscore':
+            return pinned.search_top_k_by_cosine(idf_vector, index, pinned.doc_lengths, max_scores, k)
+        if strategy != 'taat':
+            return pinned.search_daat_by_cosine(idf_vector, index, pinned.doc_lengths, k)
+        if k is not None:
+            return heapq.nlargest(k, pinned.search_by_cosine(idf_vector, index, pinned.doc_lengths),
+                                  key=lambda f: (round(f[1], 6), -f[0]))
+        return pinned.search_by_cosine(idf_vector, index, pinned.doc_lengths)
+
+    def search_tiers(self, query_vector, max_scores, k):
+        """
+        Return the k best (doc_id, score) pairs, scoring the champion lists
+        first and then adding each lower tier until at least k documents have
+        a score; scores only count the postings of the tiers used. If all
+        tiers together match fewer than k documents, the full index is
+        searched (see search_top_k_by_cosine), so that the answer is always
+        complete.
+        >>> idx = Index()
+        >>> idx.n_docs = 4
+        >>> idx.doc_freqs, idx.index, idx.doc_lengths = idx.create_index([['a', 'b'], ['a', 'c'], ['a'], ['b', 'a']])
+        >>> tiers = idx.create_tiered_index(idx.index, lambda df: [1, 1])
+        >>> idx.champion_index, idx.lower_tiers = tiers[0], tiers[1:]
+        >>> idx.search_tiers({'b': 1.}, {}, 1)
+        [(0, 1.0)]
+        >>> [doc_id for doc_id, _ in idx.search_tiers({'b': 1., 'c': 1.}, {'b': .3, 'c': .6}, 3)]
+        [0, 1, 3]
+        """
+        scores = defaultdict(float)
+        normalize = self.normalizer(self.doc_lengths)
+        for tier in [self.champion_index] + self.lower_tiers:
+            for term, weight in query_vector.items():
+                for doc_id, w in tier.get(term, ()):
+                    scores[doc_id] += weight * w
+            if len(scores) >= k:
+                return heapq.nlargest(k, [(doc_id, normalize(doc_id, score))
+                                          for doc_id, score in scores.items()], key=lambda f: (round(f[1], 6), -f[0]))
+        return self.search_top_k_by_cosine(query_vector, self.index, self.doc_lengths, max_scores, k)
+
+    def expand_wildcards(self, patterns):
+        """
+        Return the terms of the index matching each pattern, where * stands
+        for any sequence of characters (see dictionary.expand_wildcard).
+        """
+        terms = []
+        for pattern in patterns:
+            kgrams = self.kgram_index() if not pattern.split('*')[0] else self.kgrams
+            terms.extend(dictionary.expand_wildcard(self.terms(), pattern, kgrams))
+        return terms
+
+    def suggest(self, term, max_distance=2, budget=.001):
+        """
+        Return the terms of the index closest to term, if any are within
+        max_distance edits (see dictionary.fuzzy_matches), most frequent
+        first. The search for candidates stops after budget seconds.
+        """
+        matches = [(distance, match) for distance, match in
+                   dictionary.fuzzy_matches(self.terms(), self.kgram_index(), term, max_distance, budget)
+                   if self.doc_freqs.get(match)]
+        closest = [match for distance, match in matches if distance == matches[0][0]]
+        return sorted(closest, key=lambda match: (-self.doc_freqs[match], match))
+
+    def kgram_index(self):
+        """ Return the k-gram index of the terms, building it on first use. """
+        if self.kgrams is None:
+            self.kgrams = dictionary.KGramIndex(self.terms())
+        return self.kgrams
+
+    def terms(self):
+        """ Return the term dictionary the index was built, loaded or merged with.
+        Terms first seen in documents added since are not in it until the
+        next merge, so wildcards and spelling suggestions do not see them.
+        """
+        return self.segments.main if self.segments is not None else self.index
 
     def read_lines(self, filename):
-        """ DO NOT MODIFY.
-        Read a gzipped file to a list of strings.
         """
-        return [l.strip() for l in gzip.open(filename, 'rt').readlines()]
+        Yield the lines of a gzipped (or plain) file one at a time, stripped
+        (see readers.read_lines).
+        """
+        return readers.read_lines(filename)
 
     def tokenize(self, document):
-        """ DO NOT MODIFY.
+        """
         Convert a string representing one document into a list of
         words. Retain hyphens and apostrophes inside words. Remove all other
-        punctuation and convert to lowercase.
+        punctuation and convert to lowercase. Stopwords and stemming, if the
+        analyzer has them, apply too.
         >>> Index().tokenize("Hi there. What's going on? first-class")
         ['hi', 'there', "what's", 'going', 'on', 'first-class']
         """
-        return [t.lower() for t in re.findall(r"\w+(?:[-']\w+)*", document)]
+        return self.analyzer.analyze(document)
 
     def stem(self, tokens):
-        """ DO NOT MODIFY.
+        """
         Given a list of tokens, collapse 'did' and 'does' into the term 'do'.
+        An index built with analysis.Analyzer(stemmer='do') stems its terms
+        this way.
         >>> Index().stem(['did', 'does', 'do', "doesn't", 'splendid'])
         ['do', 'do', 'do', "doesn't", 'splendid']
         """
-        return [re.sub('^(did|does)$', 'do', t) for t in tokens]
+        return [analysis.do_stem(t) for t in tokens]
+
+
+class Snapshot(object):
+    """
+    The searchable state of an Index: its postings, champion lists and lower
+    tiers, document frequencies and lengths, the number of documents, the
+    ids of the deleted documents, the number of updates and merges it
+    results from (its version), the Segments it is read through while the
+    index is being updated (None otherwise), and the values cached from
+    them. A snapshot is not changed once installed, except to fill its
+    caches: updates and merges build a new one and install it with a single
+    assignment (see Index.install and merge_segments), so a search holding a
+    snapshot (see Index.pin) reads the complete old state or the complete
+    new one, never a mix of both.
+    """
+    __slots__ = ('index', 'champion_index', 'lower_tiers', 'doc_freqs', 'doc_lengths', 'n_docs', 'deleted',
+                 'version', 'segments', 'max_scores', 'kgrams')
+
+    def __init__(self, index=None, champion_index=None, lower_tiers=(), doc_freqs=None, doc_lengths=None,
+                 n_docs=0, deleted=frozenset(), version=0, segments=None):
+        self.index = index
+        self.champion_index = champion_index
+        self.lower_tiers = list(lower_tiers)
+        self.doc_freqs = doc_freqs
+        self.doc_lengths = doc_lengths
+        self.n_docs = n_docs
+        self.deleted = deleted
+        self.version = version
+        self.segments = segments
+        self.max_scores = {}
+        self.kgrams = None
+
+
+class Segments(object):
+    """ The main segment of an Index built with lazy_idf being updated (its
+    postings, tiers and NormSums), with the updates
+    made since: the postings of added documents (the delta segment) and the
+    ids of the documents deleted since (tombstones). Segments are not changed
+    once made: an update returns new Segments, which share the main segment
+    and copy the delta (see with_documents and without_documents). """
+
+    def __init__(self, main, main_tiers, main_lengths):
+        self.main = main
+        self.main_tiers = main_tiers
+        self.main_lengths = main_lengths
+        self.delta = {}
+        self.deleted = frozenset()
+
+    def with_documents(self, index):
+        """ Return new Segments with the postings of added documents (from
+        count_terms) appended to the delta segment. Only the postings lists
+        of the terms of index are rebuilt. """
+        segments = copy.copy(self)
+        segments.delta = dict(self.delta)
+        for term, pairs in index.items():
+            segments.delta[term] = self.delta.get(term, ()) + tuple(pairs)
+        return segments
+
+    def without_documents(self, doc_ids):
+        """ Return new Segments with the documents doc_ids deleted. """
+        segments = copy.copy(self)
+        segments.deleted = self.deleted | frozenset(doc_ids)
+        return segments
+
+    def changed_terms(self, previous=None):
+        """ Return the set of the terms whose postings differ from those of
+        previous Segments with the same main segment, or from those of the
+        main segment by default: the terms of documents added since, and
+        those of documents deleted since, found with a walk over the
+        postings. """
+        old_delta = previous.delta if previous is not None else {}
+        old_deleted = previous.deleted if previous is not None else frozenset()
+        changed = set(term for term, pairs in self.delta.items() if old_delta.get(term) is not pairs)
+        deleted = self.deleted - old_deleted
+        if deleted:
+            changed.update(term for term, pairs in itertools.chain(term_items(self.main), old_delta.items())
+                           if any(doc_id in deleted for doc_id, _ in pairs))
+        return changed
+
+
+class LivePostings(Mapping):
+    """
+    The postings of the live documents of a Segments: those of the main
+    segment without the deleted documents, followed by those of the delta
+    segment, frozen with freeze (see Index.freeze_postings). Terms without
+    live postings are absent.
+    >>> segments = Segments({'a': postings.Postings([[0, 2.], [1, 1.]])}, [{}], {})
+    >>> updated = segments.with_documents({'a': [[2, 1.]]}).without_documents([0])
+    >>> dict(LivePostings(updated, postings.freeze_index)), dict(LivePostings(segments, postings.freeze_index))
+    ({'a': Postings([(1, 1.0), (2, 1.0)])}, {'a': Postings([(0, 2.0), (1, 1.0)])})
+    """
+
+    def __init__(self, segments, freeze):
+        self.segments = segments
+        self.freeze = freeze
+        self.cache = {}
+        self.changed = set()
+
+    def live(self, term, main):
+        """ Return the live postings of term, given its postings in the main
+        segment: main itself if no update changed them. """
+        delta = self.segments.delta.get(term, ())
+        deleted = self.segments.deleted
+        if not delta and not (deleted and any(doc_id in deleted for doc_id, _ in main)):
+            return main
+        self.changed.add(term)
+        pairs = [list(pair) for pair in itertools.chain(main, delta) if pair[0] not in deleted]
+        return self.freeze({term: pairs})[term]
+
+    def live_items(self):
+        """ Yield the (term, postings) pairs of the live terms, those of the
+        main segment first, read in term order (see term_items). """
+        for term, pairs in term_items(self.segments.main):
+            pairs = self.live(term, pairs)
+            if pairs:
+                yield term, pairs
+        for term in self.segments.delta:
+            if term not in self.segments.main and term in self:
+                yield term, self[term]
+
+    def __getitem__(self, term):
+        if term not in self.cache:
+            self.cache[term] = self.live(term, self.segments.main.get(term, ()))
+        if not self.cache[term]:
+            raise KeyError(term)
+        return self.cache[term]
+
+    def __iter__(self):
+        return (term for term, _ in self.live_items())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class LiveFreqs(Mapping):
+    """ The document frequencies of a LivePostings. """
+
+    def __init__(self, live_postings):
+        self.postings = live_postings
+
+    def __getitem__(self, term):
+        return len(self.postings[term])
+
+    def __iter__(self):
+        return iter(self.postings)
+
+    def __len__(self):
+        return len(self.postings)
+
+
+class LiveTiers(object):
+    """ The levels tiers of a LivePostings of idx (see
+    Index.create_tiered_index): those of the main segment for the terms no
+    update changed, made again from the live postings on first use for the
+    others. """
+
+    def __init__(self, live_postings, levels, idx):
+        self.postings = live_postings
+        self.levels = levels
+        self.idx = idx
+        self.cache = {}
+        self.empty = idx.freeze_postings({'': []})['']
+
+    def tiers(self, term):
+        """ Return the list of the tiers of a live term. """
+        if term not in self.cache:
+            pairs = self.postings[term]
+            if term in self.postings.changed:
+                tiers = [self.idx.freeze_postings(tier)[term]
+                         for tier in self.idx.create_tiered_index({term: list(pairs)}, self.idx.tier_sizes)]
+            else:
+                tiers = [tier.get(term, self.empty) for tier in self.postings.segments.main_tiers]
+            self.cache[term] = (tiers + [self.empty] * self.levels)[:self.levels]
+        return self.cache[term]
+
+
+class LiveTier(Mapping):
+    """ One level of a LiveTiers, 0 for the champion lists. """
+
+    def __init__(self, live_tiers, level):
+        self.tiers = live_tiers
+        self.level = level
+
+    def live_items(self):
+        """ Yield the (term, postings) pairs of the tier for the live terms
+        with postings in it, those the updates did not change read from the
+        main segment in term order (see term_items). """
+        segments = self.tiers.postings.segments
+        changed = segments.changed_terms()
+        if self.level < len(segments.main_tiers):
+            for term, pairs in term_items(segments.main_tiers[self.level]):
+                if term not in changed:
+                    yield term, pairs
+        for term in changed:
+            if term in self:
+                yield term, self[term]
+
+    def __getitem__(self, term):
+        return self.tiers.tiers(term)[self.level]
+
+    def __iter__(self):
+        return iter(self.tiers.postings)
+
+    def __len__(self):
+        return len(self.tiers.postings)
+
+
+class LiveLengths(Mapping):
+    """ The NormSums of the live documents of the LivePostings of a
+    Snapshot, computed on first use rather than by each update. The sums of
+    the previous LiveLengths, if they were computed, or else of the main
+    segment are copied, and only the documents containing a term whose
+    postings changed since (see Segments.changed_terms) are moved to its new
+    document frequency; the number of documents costs nothing. """
+
+    def __init__(self, snapshot, live_postings, previous=None):
+        self.snapshot = snapshot
+        self.postings = live_postings
+        self.previous = previous
+        self.norm_sums = None
+
+    def current(self):
+        """ Return the NormSums, computing them on first use. """
+        if self.norm_sums is None:
+            segments = self.postings.segments
+            if self.previous is None:
+                sums = segments.main_lengths.copy(self.snapshot)
+                old_postings, terms = segments.main, segments.changed_terms()
+            else:
+                sums = self.previous.current().copy(self.snapshot)
+                old_postings = self.previous.postings
+                terms = segments.changed_terms(old_postings.segments)
+            sums.resize(self.snapshot.n_docs + len(self.snapshot.deleted))
+            for term in terms:
+                old = old_postings.get(term, ())
+                for doc_id, weight in old:
+                    sums.move(doc_id, weight, len(old), 0)
+                new = self.postings.get(term, ())
+                for doc_id, weight in new:
+                    sums.move(doc_id, weight, 0, len(new))
+            sums.remove(segments.deleted)
+            self.norm_sums = sums
+            self.previous = None
+        return self.norm_sums
+
+    def sums(self):
+        return self.current().sums()
+
+    def __getitem__(self, doc_id):
+        return self.current()[doc_id]
+
+    def __iter__(self):
+        return iter(self.current())
+
+    def __len__(self):
+        return len(self.current())
+
+
+class NormSums(Mapping):
+    """
+    The document lengths of an index storing (1 + log10(tf)) weights w, as
+    three sums per document: S = sum(w**2), B = sum(w**2 * log10(df)) and
+    C = sum(w**2 * log10(df)**2), over the terms of the document. Since
+    idf = L - log10(df), with L = log10(N), the squared length
+    sum((w * idf)**2) is S * L**2 - 2 * B * L + C: a change of N costs
+    nothing, and a change of the df of a term only updates the documents
+    containing it (see move). idx is the Snapshot (or Index) whose n_docs is
+    read; the sums have room for its deleted documents too.
+    >>> idx = Index()
+    >>> idx.n_docs = 2
+    >>> lengths = NormSums(idx, {'a': [[0, 1.], [1, 1.]], 'b': [[0, 2.]]}, {'a': 2, 'b': 1})
+    >>> lengths[0], 1 in lengths  # doctest:+ELLIPSIS
+    (0.602..., True)
+    >>> idx.n_docs = 4
+    >>> lengths[1]  # doctest:+ELLIPSIS
+    0.301...
+    """
+
+    def __init__(self, idx, index, doc_freqs):
+        self.idx = idx
+        self.squares = array('d')
+        self.log_dfs = array('d')
+        self.log_dfs2 = array('d')
+        self.resize(idx.n_docs + len(idx.deleted))
+        for term, pairs in index.items():
+            for doc_id, weight in pairs:
+                self.move(doc_id, weight, 0, doc_freqs[term])
+
+    def resize(self, n_docs):
+        """ Make room for the sums of documents up to n_docs - 1. """
+        for sums in (self.squares, self.log_dfs, self.log_dfs2):
+            sums.extend([0.] * (n_docs - len(sums)))
+
+    def add(self, sums):
+        """ Add the (name, array) pairs of the sums of another NormSums (see
+        sums), over the same documents, to these sums. """
+        for (_, values), (_, other) in zip(self.sums(), sums):
+            for doc_id, value in enumerate(other):
+                if value:
+                    values[doc_id] += value
+
+    def copy(self, idx):
+        """ Return a copy of the sums, reading the n_docs of idx. """
+        sums = NormSums(Snapshot(), {}, {})
+        sums.idx = idx
+        sums.squares, sums.log_dfs, sums.log_dfs2 = (array('d', values) for _, values in self.sums())
+        return sums
+
+    def move(self, doc_id, weight, old_df, df):
+        """ Update the sums of doc_id for a term of weight w whose document
+        frequency changes from old_df (0 if the term is new to the
+        document) to df (0 if the term leaves the document). """
+        square = weight * weight
+        log_df = math.log(df, 10) if df else 0.
+        old_log_df = math.log(old_df, 10) if old_df else 0.
+        if not old_df:
+            self.squares[doc_id] += square
+        if not df:
+            self.squares[doc_id] -= square
+        self.log_dfs[doc_id] += square * (log_df - old_log_df)
+        self.log_dfs2[doc_id] += square * (log_df * log_df - old_log_df * old_log_df)
+
+    def remove(self, doc_ids):
+        """ Clear the sums of deleted documents. """
+        for sums in (self.squares, self.log_dfs, self.log_dfs2):
+            for doc_id in doc_ids:
+                sums[doc_id] = 0.
+
+    def sums(self):
+        """ Return the (name, array) pairs of the three sums. """
+        return [('squares', self.squares), ('log_dfs', self.log_dfs), ('log_dfs2', self.log_dfs2)]
+
+    def __getitem__(self, doc_id):
+        if not 0 <= doc_id < len(self.squares) or not self.squares[doc_id]:
+            raise KeyError(doc_id)
+        log_n = math.log(self.idx.n_docs, 10)
+        return math.sqrt(max(0., (self.squares[doc_id] * log_n - 2 * self.log_dfs[doc_id]) * log_n
+                             + self.log_dfs2[doc_id]))
+
+    def __iter__(self):
+        return (doc_id for doc_id, square in enumerate(self.squares) if square)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def term_items(mapping):
+    """
+    Return the (term, value) pairs of a mapping of an index in term order.
+    A mapping the index was built, loaded or merged with is read through its
+    value function (see dictionary.FrontCodedDictionary and
+    postings.TermTable) rather than by looking up each of its terms.
+    >>> list(term_items(dictionary.compact({'b': 2, 'a': 1})))
+    [('a', 1), ('b', 2)]
+    """
+    if isinstance(mapping, dict):
+        return mapping.items()
+    return zip(mapping, map(mapping.value, itertools.count()))
+
+
+def count_shard(shard):
+    """ Tokenize and count one shard of documents, given as a tuple
+    (documents, id of the first document, analyzer, number of partitions),
+    and return its counts as a list of (doc_freqs, index) pairs, one per
+    term partition. Run in worker processes by Index.build_parallel. """
+    documents, first_doc_id, analyzer, n_partitions = shard
+    counts = Index(analyzer=analyzer).count_terms(analyzer.analyze_batch(documents), first_doc_id)
+    return postings.split_by_term(counts, n_partitions)
+
+
+def finish_partition(partition):
+    """ Merge the counts of the shards for one partition of the terms, given
+    as a tuple (list of (doc_freqs, index) pairs in document order, number of
+    documents, lazy_idf), and compute their share of the document lengths:
+    the sums of a NormSums with lazy_idf, or else the squared lengths after
+    weighting the postings by idf (see Index.finish_weights). Run in worker
+    processes by Index.build_parallel.
+    Returns:
+      A tuple (doc_freqs, index, lengths). """
+    pieces, n_docs, lazy_idf = partition
+    doc_freqs, index = postings.merge_counts(pieces)
+    if lazy_idf:
+        return doc_freqs, index, NormSums(Snapshot(n_docs=n_docs), index, doc_freqs).sums()
+    return doc_freqs, index, dict(Index().finish_weights(doc_freqs, index, n_docs))
 
 
 def main():
     """
-    Main method. Constructs an Index object and runs a sample query. """
-    indexer = Index('documents.txt.gz')
+    Main method. Constructs an Index object and runs a sample query.
+    The index is saved to index.seg and memory-mapped from there on later
+    runs, unless documents.txt.gz has changed since or the segment is in an
+    older layout (see postings.segment_is_current). """
+    if not postings.segment_is_current('index.seg', 'documents.txt.gz'):
+        Index('documents.txt.gz').save('index.seg')
+    indexer = Index.load('index.seg')
     for query in ['pop love song', 'chinese american', 'city']:
         print('\n\nQUERY=%s' % query)
-        print('\n'.join(['%d\t%e' % (doc_id, score) for doc_id, score in indexer.search(query)[:10]]))
+        print('\n'.join(['%d\t%e' % (doc_id, score) for doc_id, score in indexer.search(query, k=10)]))
         print('\n\nQUERY=%s Using Champion List' % query)
-        print('\n'.join(['%d\t%e' % (doc_id, score) for doc_id, score in indexer.search(query, True)[:10]]))
-
-# if __name__ == '__main__':
-#     main()
-
+        print('\n'.join(['%d\t%e' % (doc_id, score) for doc_id, score in indexer.search(query, True, k=10)]))
 
-main()
+if __name__ == '__main__':
+    main()
 
 #print(Index().search_by_cosine({'a': 1}, {'a': [[0, 1], [1, 2]]}, {0: 1, 1: 1}))
 
@@ -0,0 +1,312 @@
+""" Benchmarks for the RankEngine2 index and scorers.
+Synthetic collections are sampled from the TIME.ALL vocabulary, so they keep
+its term distribution while growing to any number of documents.
+
+To run: `python bench.py [n_docs ...]`
+"""
+from collections import Counter
+import random
+import contextlib
+import functools
+import gzip
+import io
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import shared  # puts IIT/common, with the shared modules, on sys.path
+import analysis
+import cache
+import dictionary
+import evaluate
+import index
+import main as time_collection
+import postings
+import readers
+import score
+
+
+def synthetic_corpus(docs, n_docs, doc_length=50, seed=0):
+    """
+    Generate n_docs documents of doc_length words each, drawing words with
+    the frequencies they have in docs.
+    >>> corpus = list(synthetic_corpus(['a a b'], 3, doc_length=4))
+    >>> len(corpus), len(corpus[0].split())
+    (3, 4)
+    """
+    counts = Counter(w for d in docs for w in index.Index().tokenize(d))
+    words = list(counts.keys())
+    weights = list(counts.values())
+    rand = random.Random(seed)
+    for _ in range(n_docs):
+        yield ' '.join(rand.choices(words, weights, k=doc_length))
+
+
+def bench_analysis(docs, n_docs, stopwords):
+    """ Time the analysis of a synthetic collection into terms, and into
+    term ids, with and without stopwords and stemming, against a regular
+    expression search per document and lowercasing per token. Each analyzer
+    is warmed up on the collection first, as it would be after its first
+    documents. """
+    corpus = list(synthetic_corpus(docs, n_docs))
+    plain = analysis.Analyzer()
+    stemmed = analysis.Analyzer(stopwords=stopwords, stemmer='s')
+    runs = [('regex', lambda texts: ([t.lower() for t in re.findall(analysis.WORD, text)] for text in texts))]
+    for name, analyzer in [('analyzer', plain), ('stopwords+stem', stemmed)]:
+        for _ in analyzer.analyze_batch(corpus):
+            pass
+        runs.append((name, analyzer.analyze_batch))
+        runs.append((name + ' ids', functools.partial(analyzer.analyze_batch, ids=True)))
+    print('%-20s %10s %16s' % ('analysis', 'seconds', 'Mtokens/second'))
+    for name, analyze in runs:
+        start = time.time()
+        n_tokens = sum(len(tokens) for tokens in analyze(corpus))
+        elapsed = time.time() - start
+        print('%-20s %10.2f %16.2f' % (name, elapsed, n_tokens / elapsed / 1e6))
+
+
+def bench_build(docs, sizes):
+    """ Time index construction over the TIME documents and synthetic
+    collections of the given sizes. Linear construction shows a constant
+    time per document across all sizes. """
+    print('%10s %10s %14s' % ('documents', 'seconds', 'usec/document'))
+    for n_docs in [len(docs)] + sizes:
+        corpus = docs if n_docs == len(docs) else list(synthetic_corpus(docs, n_docs))
+        start = time.time()
+        index.Index(corpus)
+        elapsed = time.time() - start
+        print('%10d %10.2f %14.1f' % (n_docs, elapsed, elapsed * 1e6 / n_docs))
+
+
+def bench_parallel(docs, n_docs):
+    """ Time a serial build and a process pool build of a synthetic
+    collection, with one process per CPU. """
+    corpus = list(synthetic_corpus(docs, n_docs))
+    print('%10s %10s' % ('processes', 'seconds'))
+    for processes in sorted(set([1, multiprocessing.cpu_count()])):
+        start = time.time()
+        index.Index(corpus, processes=processes)
+        print('%10d %10.2f' % (processes, time.time() - start))
+
+
+def bench_memory(docs, n_docs):
+    """ Compare the memory held by the postings of a synthetic collection as
+    lists of [doc_id, tf] pairs and frozen into Postings arrays. """
+    tokenized = [index.Index().tokenize(d) for d in synthetic_corpus(docs, n_docs)]
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    lists = index.Index().create_tf_index(tokenized, None)
+    as_lists = tracemalloc.get_traced_memory()[0] - base
+    frozen = postings.freeze_index(lists, 'f')
+    del lists
+    as_arrays = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    n_postings = sum(len(p) for p in frozen.values())
+    print('%d documents, %d postings' % (n_docs, n_postings))
+    print('%-10s %12s %16s' % ('postings', 'MB', 'bytes/posting'))
+    for name, size in [('lists', as_lists), ('arrays', as_arrays)]:
+        print('%-10s %12.1f %16.1f' % (name, size / 1e6, size * 1. / n_postings))
+
+
+def bench_ingest(docs, n_docs):
+    """ Compare the peak memory of building the index of a synthetic
+    collection, written as a gzipped TREC-style file, from the list of its
+    documents and from documents streamed from the file. """
+    path = os.path.join(tempfile.mkdtemp(), 'synthetic.all.gz')
+    with gzip.open(path, 'wt') as f:
+        for doc_id, doc in enumerate(synthetic_corpus(docs, n_docs), 1):
+            f.write('*TEXT %d\n\n%s\n\n' % (doc_id, doc))
+        f.write('*STOP\n')
+    print('%-10s %10s %10s' % ('documents', 'seconds', 'peak MB'))
+    for name, read in [('list', time_collection.read_documents), ('stream', time_collection.iter_documents)]:
+        tracemalloc.start()
+        start = time.time()
+        index.Index(read(path))
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-10s %10.2f %10.1f' % (name, elapsed, peak / 1e6))
+    os.remove(path)
+
+
+def bench_compression(docs, n_docs):
+    """ Compare the bytes per posting of Postings arrays and of
+    CompressedPostings for a synthetic collection, and the rate at which
+    each is decoded into (doc_id, tf) pairs. """
+    tokenized = [index.Index().tokenize(d) for d in synthetic_corpus(docs, n_docs)]
+    lists = index.Index().create_tf_index(tokenized, None)
+    n_postings = sum(len(p) for p in lists.values())
+    print('%-12s %14s %18s' % ('postings', 'bytes/posting', 'Mpostings/second'))
+    for name, frozen in [('arrays', postings.freeze_index(lists, 'f')), ('compressed', postings.compress_index(lists))]:
+        size = sum(p.nbytes if name == 'compressed' else len(p) * 8 for p in frozen.values())
+        start = time.time()
+        for p in frozen.values():
+            for _ in p:
+                pass
+        elapsed = time.time() - start
+        print('%-12s %14.2f %18.2f' % (name, size * 1. / n_postings, n_postings / elapsed / 1e6))
+
+
+def misspell(word, rand):
+    """ Apply one random insertion, deletion or substitution to word. """
+    i = rand.randrange(len(word))
+    letter = rand.choice('abcdefghijklmnopqrstuvwxyz')
+    return rand.choice([word[:i] + letter + word[i:], word[:i] + word[i + 1:], word[:i] + letter + word[i + 1:]])
+
+
+def bench_fuzzy(docs, n_terms, n_queries=200, seed=0):
+    """ Time the correction of misspelled TIME terms against a vocabulary
+    of n_terms, padded with misspelled variants of TIME terms, and report
+    how often the original term is among the closest matches. """
+    rand = random.Random(seed)
+    vocabulary = set(t for d in docs for t in index.Index().tokenize(d))
+    words = sorted(w for w in vocabulary if len(w) >= 5)
+    while len(vocabulary) < n_terms:
+        vocabulary.add(misspell(misspell(rand.choice(words), rand), rand))
+    start = time.time()
+    terms = dictionary.FrontCodedDictionary(vocabulary)
+    kgrams = dictionary.KGramIndex(terms)
+    built = time.time() - start
+    queries = []
+    while len(queries) < n_queries:
+        word = rand.choice(words)
+        typo = misspell(word, rand)
+        if typo not in vocabulary:
+            queries.append((word, typo))
+    start = time.time()
+    found = 0
+    for word, typo in queries:
+        matches = dictionary.fuzzy_matches(terms, kgrams, typo, 2)
+        found += word in [match for distance, match in matches if distance == matches[0][0]]
+    elapsed = time.time() - start
+    print('%10s %12s %12s %10s' % ('terms', 'build sec', 'msec/term', 'found'))
+    print('%10d %12.2f %12.3f %10.2f' % (len(terms), built, elapsed * 1e3 / n_queries, found * 1. / n_queries))
+
+
+def bench_updates(docs, n_docs, batch=100):
+    """ Time adding a batch of documents to an index of a synthetic
+    collection and deleting as many, against rebuilding the index from
+    scratch, then time the first search after the updates (which recomputes
+    the norms) and the merge. """
+    corpus = list(synthetic_corpus(docs, n_docs + batch))
+    idx = index.Index(corpus[:n_docs])
+    timings = []
+    start = time.time()
+    idx.add_documents(corpus[n_docs:])
+    timings.append(('add %d' % batch, time.time() - start))
+    start = time.time()
+    idx.delete_documents(range(1, batch + 1))
+    timings.append(('delete %d' % batch, time.time() - start))
+    query = idx.query_to_vector(idx.tokenize(corpus[0])[:5])
+    start = time.time()
+    score.Cosine().score(query, idx)
+    timings.append(('first search', time.time() - start))
+    start = time.time()
+    idx.merge()
+    timings.append(('merge', time.time() - start))
+    start = time.time()
+    index.Index(corpus[batch:])
+    timings.append(('rebuild', time.time() - start))
+    print('%14s %10s' % ('operation', 'seconds'))
+    for name, elapsed in timings:
+        print('%14s %10.3f' % (name, elapsed))
+
+
+def bench_search(queries, idx, scorers, k=10):
+    """ Time every TIME query against idx for each scorer, ranking all
+    matches and selecting only the top k. """
+    print('%-18s %14s %14s' % ('scorer', 'msec/query', 'top-%d msec' % k))
+    for scorer in scorers:
+        start = time.time()
+        for qtext in queries.values():
+            time_collection.search(qtext, scorer, idx)
+        full = time.time() - start
+        start = time.time()
+        for qtext in queries.values():
+            time_collection.search(qtext, scorer, idx, k)
+        top = time.time() - start
+        print('%-18s %14.3f %14.3f' % (scorer, full * 1e3 / len(queries), top * 1e3 / len(queries)))
+
+
+def bench_strategies(queries, idx, scorers, k=10):
+    """ Time the TIME queries for each scorer and evaluation strategy of
+    main.search, selecting the top k, and measure the peak memory a query
+    allocates with tracemalloc (in a second pass, as tracing slows Python
+    down). """
+    print('%-18s %10s %12s %14s' % ('scorer', 'strategy', 'msec/query', 'peak KB/query'))
+    for scorer in scorers:
+        for strategy in time_collection.STRATEGIES:
+            start = time.time()
+            for qtext in queries.values():
+                time_collection.search(qtext, scorer, idx, k, strategy)
+            elapsed = time.time() - start
+            peaks = []
+            tracemalloc.start()
+            for qtext in queries.values():
+                tracemalloc.reset_peak()
+                time_collection.search(qtext, scorer, idx, k, strategy)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            print('%-18s %10s %12.3f %14.1f' % (scorer, strategy, elapsed * 1e3 / len(queries),
+                                                 sum(peaks) / len(peaks) / 1024))
+
+
+def bench_cache(queries, idx, scorers, n_queries=5000, k=10, seed=0):
+    """ Time a stream of TIME queries drawn with Zipf-like frequencies (the
+    i-th most popular query is drawn with weight 1 / i), like skewed
+    production traffic, without and with a cache.ResultCache. """
+    rand = random.Random(seed)
+    texts = list(queries.values())
+    stream = rand.choices(texts, [1. / (i + 1) for i in range(len(texts))], k=n_queries)
+    print('%-18s %12s %12s %10s' % ('scorer', 'uncached sec', 'cached sec', 'hit rate'))
+    for scorer in scorers:
+        timings = []
+        for result_cache in [None, cache.ResultCache()]:
+            idx.cache = result_cache
+            start = time.time()
+            for qtext in stream:
+                time_collection.search(qtext, scorer, idx, k)
+            timings.append(time.time() - start)
+        print('%-18s %12.2f %12.2f %10.3f' % (scorer, timings[0], timings[1], result_cache.hit_rate()))
+    idx.cache = None
+
+
+def bench_batch(queries, relevances, docs, idx, scorers):
+    """ Time the evaluation loop of main.main query by query (run_all)
+    and as sparse matrix products (run_all_batch). """
+    evaluators = [evaluate.Precision(), evaluate.Recall(), evaluate.F1(), evaluate.MAP()]
+    print('%-14s %10s' % ('evaluation', 'seconds'))
+    for run in [time_collection.run_all, time_collection.run_all_batch]:
+        start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            run(queries, relevances, docs, idx, scorers, evaluators, 10)
+        print('%-14s %10.2f' % (run.__name__, time.time() - start))
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    docs = time_collection.read_documents('TIME.ALL')
+    queries = time_collection.read_queries('TIME.QUE')
+    relevances = time_collection.read_relevances('TIME.REL')
+    idx = index.Index(docs)
+    scorers = [score.Cosine(), score.RSV()] + [score.BM25(k=k, b=b) for k in (1, 2) for b in (.5, 1)]
+    bench_analysis(docs, sizes[0], analysis.read_stopwords(readers.read_lines('TIME.STP')))
+    bench_build(docs, sizes)
+    bench_parallel(docs, sizes[-1])
+    bench_memory(docs, sizes[0])
+    bench_ingest(docs, sizes[0])
+    bench_compression(docs, sizes[0])
+    bench_fuzzy(docs, sizes[-1])
+    bench_updates(docs, sizes[0])
+    bench_search(queries, idx, scorers[:3])
+    bench_strategies(queries, idx, scorers[:3])
+    bench_cache(queries, idx, scorers[:3])
+    bench_batch(queries, relevances, docs, idx, scorers)
+
+
+if __name__ == '__main__':
+    main()
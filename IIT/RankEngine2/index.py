@@ -1,25 +1,435 @@
 """ Assignment 2
 """
-from collections import Counter, defaultdict
+from array import array
+from collections import ChainMap, Counter, defaultdict
+import copy
+import itertools
 import math
-import re
+from collections.abc import Mapping
+import multiprocessing
+import threading
 
 import numpy as np
 
+import shared  # puts IIT/common, with the shared modules, on sys.path
+import analysis
+import dictionary
+import postings
+import readers
+
+# Number of documents tokenized and counted by a worker process at a time
+# (see Index.build_parallel).
+SHARD_SIZE = 10000
+
+
+def snapshot_attribute(name):
+    """ Return a property reading the attribute name of the Snapshot of an
+    Index. """
+    return property(lambda self: getattr(self.snapshot, name))
+
 
 class Index(object):
+    index = snapshot_attribute('index')
+    doc_freqs = snapshot_attribute('doc_freqs')
+    doc_lengths = snapshot_attribute('doc_lengths')
+    mean_doc_length = snapshot_attribute('mean_doc_length')
+    doc_norms = snapshot_attribute('doc_norms')
+    n_docs = snapshot_attribute('n_docs')
+    max_doc_id = snapshot_attribute('max_doc_id')
+    version = snapshot_attribute('version')
+    segments = snapshot_attribute('segments')
+    positions = snapshot_attribute('positions')
+    max_scores = snapshot_attribute('max_scores')
+    idfs = snapshot_attribute('idfs')
+    length_norms = snapshot_attribute('length_norms')
+    kgrams = snapshot_attribute('kgrams')
 
-    def __init__(self, docs=None):
-        """ Do not modify.
-        Create a new index by parsing the given file containing documents,
-        one per line."""
-        self.documents = docs
+    def __init__(self, docs=None, processes=1, compress=False, positional=False, analyzer=None):
+        """
+        Create a new index from docs, an iterable of strings, one per
+        document. The documents are read once, one at a time, and are not
+        kept: a generator (see main.iter_documents) is indexed without ever
+        holding the whole collection in memory.
+        If processes is more than 1, the documents are tokenized, counted,
+        merged and normalized by a pool of worker processes (see
+        build_parallel).
+        If compress is true, postings are stored as CompressedPostings (see
+        the postings module); term frequencies are kept exactly.
+        Once built, the terms are kept in a front-coded dictionary (see the
+        dictionary module) rather than in dicts.
+        Set fuzzy_distance to correct misspelled query terms (see
+        query_to_vector), and cache to a cache.ResultCache to reuse the
+        results of main.search. version counts the updates of the index.
+        Scorers accumulate document scores in a per-thread Accumulator (see
+        accumulator), indexed by document id.
+        If positional is true, the positions of each term in each document
+        are kept too, in positions (see postings.PositionalPostings), for
+        score.ProximityBoost.
+        Documents and queries are turned into terms by analyzer (see
+        analysis.Analyzer, e.g. with the TIME.STP stopwords), which defaults
+        to the tokenize rules below and is saved with the index.
+        The postings, document frequencies, lengths and norms, the number of
+        documents, and the values cached from them, are attributes of a
+        Snapshot, which updates and merges replace as a whole; a search reads
+        a single snapshot throughout (see pin).
+        >>> Index(['a b a', 'b c'], compress=True).index['a']
+        CompressedPostings([(1, 2.0)])
+        """
+        self.analyzer = analyzer or analysis.Analyzer()
+        self.snapshot = Snapshot(None, None, None, 0., None, 0, 0)
+        self.fuzzy_distance = 0
+        self.compress = compress
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.cache = None
         if docs:
-            self.documents = [self.tokenize(d) for d in self.documents]
-            self.doc_freqs = self.count_doc_frequencies(self.documents)
-            self.index = self.create_tf_index(self.documents, self.doc_freqs)
-            self.doc_lengths, self.mean_doc_length = self.compute_doc_lengths(self.index)
-            self.doc_norms = self.compute_doc_norms(self.index, len(self.documents), self.doc_freqs)
+            docs = readers.CountingIterator(docs)
+            collector = postings.PositionCollector(1) if positional else None
+            if processes > 1:
+                built = self.build_parallel(collector.tap(docs, self.tokenize) if collector else docs, processes)
+            else:
+                tokenized = self.analyzer.analyze_batch(docs)
+                counts = self.count_terms(collector.tap(tokenized) if collector else tokenized)
+                built = self.finish_index(*counts, n_docs=docs.n)
+            self.freeze(*built, n_docs=docs.n, max_doc_id=docs.n)
+            if collector:
+                self.snapshot.positions = dictionary.compact(collector.index(), self.index)
+
+    def freeze(self, doc_freqs, index, doc_lengths, mean_doc_length, doc_norms, n_docs, max_doc_id,
+               positions=None, version=0):
+        """ Install the output of finish_index as the main segment of the
+        index, with its postings frozen (or compressed) and its terms in a
+        front-coded dictionary, as a new snapshot of the given version. """
+        if self.compress:
+            index = postings.compress_index(index)
+        else:
+            index = postings.freeze_index(index, 'f')
+        terms = dictionary.FrontCodedDictionary(index)
+        self.snapshot = Snapshot(dictionary.compact(index, terms), dictionary.compact(doc_freqs, terms, 'd'),
+                                 doc_lengths, mean_doc_length, doc_norms, n_docs, max_doc_id,
+                                 positions=positions, version=version)
+
+    def current_segments(self):
+        """ Return the Segments of the index, or new Segments with the
+        current index as their main segment and no updates yet. """
+        if self.segments is None:
+            return Segments(self.index, self.doc_lengths)
+        return self.segments
+
+    def install(self, segments, n_docs, max_doc_id, positions):
+        """ Replace the snapshot, with a single assignment, by one reading
+        the postings, document frequencies, lengths and norms through views
+        of segments, and count the update. The norms are recomputed lazily,
+        on first use; the other cached values start empty, but the k-gram
+        index of the main segment is kept. The version of the new snapshot
+        is one more than that of the current one. """
+        live = LivePostings(segments)
+        mean_doc_length = segments.total_length / segments.n_lengths if segments.n_lengths else 0.
+        snapshot = Snapshot(live, LiveFreqs(live), LiveLengths(segments), mean_doc_length,
+                            LiveNorms(live, n_docs), n_docs, max_doc_id, segments, positions,
+                            self.version + 1)
+        snapshot.kgrams = self.kgrams
+        self.snapshot = snapshot
+
+    def pin(self):
+        """
+        Return a copy of the index that reads the current snapshot only, so
+        that every value a search computes (idfs, norms, bounds, the size of
+        the accumulator) comes from the same state of the index, whatever
+        updates are installed meanwhile. The copy is for reading: update the
+        index itself.
+        >>> idx = Index(['a b', 'b c'])
+        >>> pinned = idx.pin()
+        >>> idx.add_documents(['a'])
+        [3]
+        >>> pinned.n_docs, pinned.idf('a') == Index(['a b', 'b c']).idf('a'), idx.n_docs
+        (2, True, 3)
+        """
+        pinned = copy.copy(self)
+        pinned.snapshot = self.snapshot
+        return pinned
+
+    def add_documents(self, docs):
+        """
+        Add documents to the index without rebuilding it. Their postings go
+        to an in-memory delta segment, read together with the main segment
+        until the next merge.
+        Params:
+          docs...A list of strings, one per document.
+        Returns:
+          The list of ids given to the new documents.
+        >>> idx = Index(['a b', 'b c'])
+        >>> idx.add_documents(['c d', 'a a'])
+        [3, 4]
+        >>> idx.n_docs, list(idx.index['a']), idx.doc_freqs['c'], idx.mean_doc_length
+        (4, [(1, 1.0), (4, 2.0)], 2.0, 2.0)
+        """
+        with self.lock:
+            tokenized = list(self.analyzer.analyze_batch(docs))
+            first_doc_id = self.max_doc_id + 1
+            doc_freqs, index, doc_lengths = self.count_terms(tokenized, first_doc_id)
+            positions = self.positions
+            if positions is not None:
+                positions = self.added_positions(tokenized, first_doc_id)
+            self.install(self.current_segments().with_documents(index, doc_lengths),
+                         self.n_docs + len(docs), self.max_doc_id + len(docs), positions)
+            return list(range(first_doc_id, self.max_doc_id + 1))
+
+    def added_positions(self, docs, first_doc_id):
+        """ Return the positions of the index with those of tokenized
+        documents numbered from first_doc_id added, in front of the positions
+        the index was built with. The positions of the index are not
+        changed. """
+        if isinstance(self.positions, ChainMap):
+            positions = ChainMap(dict(self.positions.maps[0]), self.positions.maps[1])
+        else:
+            positions = ChainMap({}, self.positions)
+        for term, new in postings.positional_index(docs, first_doc_id).items():
+            pairs = list(positions.get(term, ())) + list(new)
+            positions[term] = postings.PositionalPostings(*zip(*pairs))
+        return positions
+
+    def delete_documents(self, doc_ids):
+        """
+        Delete documents from the index without rebuilding it. Their ids are
+        recorded as tombstones, and their postings are skipped until the next
+        merge drops them.
+        >>> idx = Index(['a b', 'b c', 'c c'])
+        >>> idx.delete_documents([2])
+        >>> idx.n_docs, list(idx.index['b']), idx.doc_freqs['c'], 2 in idx.doc_lengths
+        (2, [(1, 1.0)], 1.0, False)
+        """
+        with self.lock:
+            segments = self.current_segments()
+            doc_ids = set(doc_id for doc_id in doc_ids
+                          if 1 <= doc_id <= self.max_doc_id and doc_id not in segments.deleted)
+            lengths = [self.doc_lengths[doc_id] for doc_id in doc_ids if doc_id in self.doc_lengths]
+            self.install(segments.without_documents(doc_ids, lengths),
+                         self.n_docs - len(doc_ids), self.max_doc_id, self.positions)
+
+    def merge(self, background=False):
+        """
+        Fold the delta segment and the tombstones into a new main segment,
+        as if the index had been built from the remaining documents (ids are
+        kept). Searches keep using the old segments until the new one is
+        installed. If background is true, the merge runs in a thread, which
+        is returned; updates made meanwhile wait for it to finish.
+        >>> idx = Index(['a b', 'b c', 'c c'])
+        >>> idx.add_documents(['a d'])
+        [4]
+        >>> idx.delete_documents([1])
+        >>> before = idx.snapshot
+        >>> idx.merge()
+        >>> idx.segments, list(idx.index['a']), sorted(idx.doc_norms), idx.n_docs, idx.max_doc_id
+        (None, [(4, 1.0)], [2, 3, 4], 3, 4)
+        >>> before.doc_norms == idx.doc_norms, list(before.index['a'])
+        (True, [(4, 1.0)])
+        """
+        if not background:
+            return self.merge_segments()
+        thread = threading.Thread(target=self.merge_segments)
+        thread.start()
+        return thread
+
+    def merge_segments(self):
+        """ Run the merge described in merge. The merged segment is built
+        from the current snapshot, and installed by freeze as a new snapshot,
+        with a single assignment. """
+        with self.lock:
+            snapshot = self.snapshot
+            if snapshot.segments is None:
+                return
+            index = dict((term, [list(pair) for pair in pairs]) for term, pairs in snapshot.index.items())
+            doc_freqs = dict((term, len(pairs) * 1.) for term, pairs in index.items())
+            doc_lengths = dict(snapshot.doc_lengths.items())
+            self.freeze(*self.finish_index(doc_freqs, index, doc_lengths, snapshot.n_docs),
+                        n_docs=snapshot.n_docs, max_doc_id=snapshot.max_doc_id, positions=snapshot.positions,
+                        version=snapshot.version + 1)
+
+    def create_index(self, docs):
+        """
+        Build the postings, document frequencies, document lengths, mean
+        document length and tf-idf norms in one streaming pass over the
+        tokenized documents (see count_terms and finish_index).
+        Params:
+          docs...A list of lists of tokens, one per document.
+        Returns:
+          A tuple (doc_freqs, index, doc_lengths, mean_doc_length, doc_norms),
+          equal to the outputs of count_doc_frequencies, create_tf_index,
+          compute_doc_lengths and compute_doc_norms.
+        >>> doc_freqs, index, lengths, mean, norms = Index().create_index([['a', 'b', 'a'], ['b', 'c']])
+        >>> index['a']
+        [[1, 2.0]]
+        >>> doc_freqs['b'], lengths[2], mean
+        (2.0, 2.0, 2.5)
+        >>> norms[1]  # doctest:+ELLIPSIS
+        0.3916...
+        """
+        return self.finish_index(*self.count_terms(docs), n_docs=len(docs))
+
+    def count_terms(self, docs, first_doc_id=1):
+        """
+        Count term frequencies once per document and fill the postings,
+        document frequencies and document lengths in a single pass.
+        Params:
+          docs...........An iterable of lists of tokens, one per document.
+          first_doc_id...The id of the first document.
+        Returns:
+          A tuple (doc_freqs, index, doc_lengths).
+        >>> doc_freqs, index, lengths = Index().count_terms([['a', 'b', 'a'], [], ['b']], 5)
+        >>> index['b'], lengths
+        ([[5, 1.0], [7, 1.0]], {5: 3.0, 7: 1.0})
+        """
+        doc_freqs = defaultdict(float)
+        index = defaultdict(list)
+        doc_lengths = {}
+        for doc_id, doc in enumerate(docs, first_doc_id):
+            counts = Counter(doc)
+            for term, tf in counts.items():
+                doc_freqs[term] += 1.
+                index[term].append([doc_id, tf * 1.])
+            if counts:
+                doc_lengths[doc_id] = len(doc) * 1.
+        return dict(doc_freqs), dict(index), doc_lengths
+
+    def build_parallel(self, docs, processes, shard_size=SHARD_SIZE):
+        """
+        Build the index of the iterable docs with a pool of worker processes,
+        in two rounds. First, contiguous shards of shard_size documents are
+        tokenized and counted (see count_shard), one round of processes
+        shards at a time, so only that many documents are held at once, and
+        the counts of each shard are split into processes partitions of the
+        terms (see postings.split_by_term). Then each worker owns one
+        partition: it merges the postings of its terms in document order
+        and adds up their contributions to the tf-idf norms (see
+        finish_partition). The partitions share no term, so the parent only
+        joins them and adds up the norms of each document.
+        Returns:
+          The output of finish_index over count_terms of all the tokenized
+          documents, up to the rounding of the norms.
+        >>> built = Index().build_parallel(['a b a', 'b c', 'a'], 2, 2)
+        >>> serial = Index().create_index([['a', 'b', 'a'], ['b', 'c'], ['a']])
+        >>> built[:4] == serial[:4], all(abs(built[4][d] - serial[4][d]) < 1e-12 for d in serial[4])
+        (True, True)
+        """
+        shards = readers.shards(docs, shard_size, 1)
+        partitions = [[] for _ in range(processes)]
+        doc_lengths = {}
+        n_docs = 0
+        pool = multiprocessing.Pool(processes)
+        try:
+            while True:
+                round_shards = [(shard, first_doc_id, self.analyzer, processes)
+                                for shard, first_doc_id in itertools.islice(shards, processes)]
+                results = pool.map(count_shard, round_shards, chunksize=1)
+                if not results:
+                    break
+                for shard_partitions, shard_lengths in results:
+                    for partition, counts in zip(partitions, shard_partitions):
+                        partition.append(counts)
+                    doc_lengths.update(shard_lengths)
+                n_docs += sum(len(shard) for shard, _, _, _ in round_shards)
+            finished = pool.map(finish_partition, [(partition, n_docs) for partition in partitions], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        doc_freqs, index, norm_squares = {}, {}, defaultdict(float)
+        for partition_freqs, partition_index, partition_squares in finished:
+            doc_freqs.update(partition_freqs)
+            index.update(partition_index)
+            for doc_id, square in partition_squares.items():
+                norm_squares[doc_id] += square
+        return self.finish_index(doc_freqs, index, doc_lengths, n_docs, norm_squares)
+
+    def finish_index(self, doc_freqs, index, doc_lengths, n_docs, norm_squares=None):
+        """
+        Compute the mean document length and the tf-idf norms from the output
+        of count_terms. The norms need the final document frequencies, so they
+        are computed with a single walk over the postings rather than a second
+        pass over the corpus (see norm_squares), unless their squares are
+        given (see build_parallel).
+        Returns:
+          A tuple (doc_freqs, index, doc_lengths, mean_doc_length, doc_norms).
+        """
+        if norm_squares is None:
+            norm_squares = self.norm_squares(doc_freqs, index, n_docs)
+        doc_norms = dict((doc_id, math.sqrt(square)) for doc_id, square in norm_squares.items())
+        mean_doc_length = sum(doc_lengths.values()) / len(doc_lengths) if doc_lengths else 0.
+        return doc_freqs, index, doc_lengths, mean_doc_length, doc_norms
+
+    def norm_squares(self, doc_freqs, index, n_docs):
+        """ Return a dict mapping each document id of the postings of index
+        to the sum of the squared tf-idf weights of its terms in index. """
+        squares = defaultdict(float)
+        for term, pairs in index.items():
+            idf = math.log(n_docs * 1. / doc_freqs[term], 10)
+            for doc_id, tf in pairs:
+                squares[doc_id] += ((1 + math.log(tf, 10)) * idf) ** 2
+        return squares
+
+    def save(self, path):
+        """
+        Write the index to a binary segment file (see postings.write_segment),
+        with sections for the sorted term dictionary, document frequencies,
+        postings and per-document lengths and norms, plus the positions of a
+        positional index.
+        """
+        terms, blob, offsets = postings.pack_terms(self.index.keys())
+        starts = array('q', [0])
+        doc_ids = array('i')
+        tfs = array('f')
+        for term in terms:
+            term_doc_ids, term_tfs = postings.columns(self.index[term])
+            doc_ids.extend(term_doc_ids)
+            tfs.extend(term_tfs if getattr(term_tfs, 'typecode', 'f') == 'f' else array('f', term_tfs))
+            starts.append(len(doc_ids))
+        postings.write_segment(path, {'n_docs': self.n_docs, 'max_doc_id': self.max_doc_id,
+                                      'mean_doc_length': self.mean_doc_length,
+                                      'analyzer': self.analyzer.config()}, [
+            ('terms', blob),
+            ('term_offsets', offsets),
+            ('doc_freqs', array('d', [self.doc_freqs[term] for term in terms])),
+            ('postings_starts', starts),
+            ('doc_ids', doc_ids),
+            ('tfs', tfs),
+            ('doc_lengths', postings.dense(self.doc_lengths, self.max_doc_id + 1)),
+            ('doc_norms', postings.dense(self.doc_norms, self.max_doc_id + 1))] +
+            (postings.positional_sections(self.positions, terms) if self.positions is not None else []))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Open an index saved with save. The segment is memory-mapped: terms
+        are looked up by binary search in the mapped dictionary and postings
+        are views into the mapped file, so loading does not depend on the
+        size of the index.
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'index.seg')
+        >>> Index(['a b c', 'b c', 'd']).save(path)
+        >>> idx = Index.load(path)
+        >>> idx.n_docs, idx.doc_freqs['b'], list(idx.index['b'])
+        (3, 2.0, [(1, 1.0), (2, 1.0)])
+        >>> idx.query_to_vector(['a', 'e']) # doctest:+ELLIPSIS
+        {'a': 0.477...}
+        """
+        metadata, sections = postings.read_segment(path)
+        idx = cls()
+        idx.analyzer = analysis.Analyzer(**metadata.get('analyzer', {}))
+        starts = sections['postings_starts']
+        doc_ids = sections['doc_ids']
+        tfs = sections['tfs']
+        idx.snapshot = Snapshot(
+            postings.TermTable(sections['terms'], sections['term_offsets'], lambda term_id: (
+                postings.Postings.from_arrays(doc_ids[starts[term_id]:starts[term_id + 1]],
+                                              tfs[starts[term_id]:starts[term_id + 1]]))),
+            postings.TermTable(sections['terms'], sections['term_offsets'], sections['doc_freqs'].__getitem__),
+            postings.DenseMap(sections['doc_lengths']),
+            metadata['mean_doc_length'],
+            postings.DenseMap(sections['doc_norms']),
+            metadata['n_docs'],
+            metadata.get('max_doc_id', metadata['n_docs']),
+            positions=postings.positional_table(sections) if 'positions_starts' in sections else None)
+        return idx
 
     def compute_doc_norms(self, index, n_docs, doc_freqs):
         """
@@ -108,13 +518,12 @@ class Index(object):
         [[1, 2.0], [2, 1.0]]
         """
         index = {}
-        for doc in docs:
-            for term in list(set(doc)):
-                frequency = doc.count(term)*1.
+        for doc_id, doc in enumerate(docs, 1):
+            for term, tf in Counter(doc).items():
                 if term in index:
-                    index[term].append([docs.index(doc)+1, frequency])
+                    index[term].append([doc_id, tf * 1.])
                 else:
-                    index[term] = [[docs.index(doc)+1, frequency]]
+                    index[term] = [[doc_id, tf * 1.]]
         return index
 
     def count_doc_frequencies(self, docs):
@@ -132,14 +541,11 @@ class Index(object):
         >>> res['c']
         1.0
         """
-        dic = {}
+        dic = defaultdict(float)
         for doc in docs:
             for t in set(doc):
-                if t in dic:
-                    dic[t] += 1.
-                else:
-                    dic[t] = 1.
-        return dic
+                dic[t] += 1.
+        return dict(dic)
 
     def query_to_vector(self, query_terms):
         """ Convert a list of query terms into a dict mapping each term to its
@@ -147,7 +553,9 @@ class Index(object):
         where N is the total number of documents.  You may need to use the
         instance variables of the Index object to compute this. Do not modify
         the method signature.
-        If a query term is not in the index, simply omit it from the result.
+        If a query term is not in the index, simply omit it from the result,
+        unless fuzzy_distance is set: the term is then replaced with its
+        closest terms in the index (see suggest).
         The frequency of a term in the query does not affect the result.
         Parameters:
           query_terms....list of terms
@@ -167,15 +575,371 @@ class Index(object):
         q_vector = {}
         for term in list(set(query_terms)):
             if term in self.doc_freqs:
-                q_vector[term] = math.log(1.0 * len(self.documents) / self.doc_freqs[term], 10)
+                q_vector[term] = self.idf(term)
+            elif self.fuzzy_distance:
+                for match in self.suggest(term, self.fuzzy_distance):
+                    q_vector[match] = self.idf(match)
         return q_vector
 
+    def idf(self, term):
+        """
+        Return the inverse document frequency log10(N / df) of a term of the
+        index, or 0 for an empty index. Values are cached in idfs until the
+        next update.
+        >>> idx = Index(['a b', 'b c', 'c'])
+        >>> idx.idf('a'), idx.idfs  # doctest:+ELLIPSIS
+        (0.477..., {'a': 0.477...})
+        """
+        if term not in self.idfs:
+            df = self.doc_freqs[term]
+            self.idfs[term] = math.log(1.0 * self.n_docs / df, 10) if df and self.n_docs else 0
+        return self.idfs[term]
+
+    def bm25_norms(self, k, b):
+        """
+        Return an array mapping each document id to the BM25 length
+        normalization k * (1 - b + b * length / mean_doc_length) of the
+        document (NaN for ids without a document). Arrays are cached in
+        length_norms per (k, b) until the next update.
+        >>> Index(['a b', 'b c d e']).bm25_norms(1, .5)
+        array('d', [nan, 0.8333333333333333, 1.1666666666666665])
+        """
+        if (k, b) not in self.length_norms:
+            lengths = postings.dense(self.doc_lengths, self.max_doc_id + 1)
+            mean = self.mean_doc_length or 1.
+            self.length_norms[(k, b)] = array('d', [k * (1 - b + b * length / mean)
+                                                    for length in lengths])
+        return self.length_norms[(k, b)]
+
+    def cosine_norms(self):
+        """
+        Return a numpy array mapping each document id to its tf-idf norm
+        (NaN for ids without a document), cached in length_norms until the
+        next update. Norms of 0 are stored as inf, so that dividing by them
+        gives a score of 0, as for any document sharing no term with the
+        query.
+        >>> Index(['a b', 'b c', 'b']).cosine_norms().tolist()  # doctest:+ELLIPSIS
+        [nan, 0.477..., 0.477..., inf]
+        """
+        if 'cosine' not in self.length_norms:
+            norms = np.frombuffer(postings.dense(self.doc_norms, self.max_doc_id + 1))
+            self.length_norms['cosine'] = np.where(norms == 0., np.inf, norms)
+        return self.length_norms['cosine']
+
+    def columns(self, term):
+        """
+        Return the document ids and the term frequencies of the postings of
+        a term of the index as numpy arrays, the ids as views of the postings
+        where possible.
+        >>> Index(['a b a', 'b']).columns('b')
+        (array([1, 2], dtype=int32), array([1., 1.]))
+        """
+        doc_ids, tfs = postings.columns(self.index[term])
+        return np.asarray(doc_ids, dtype=np.int32), np.asarray(tfs, dtype=np.float64)
+
+    def accumulator(self):
+        """ Return the Accumulator of the current thread, sized for the
+        document ids of the index. It is reused by every query. """
+        accumulator = getattr(self.local, 'accumulator', None)
+        if accumulator is None or len(accumulator.scores) != self.max_doc_id + 1:
+            accumulator = self.local.accumulator = Accumulator(self.max_doc_id + 1)
+        return accumulator
+
+    def expand_wildcards(self, patterns):
+        """
+        Return the terms of the index matching each pattern, where * stands
+        for any sequence of characters (see dictionary.expand_wildcard).
+        >>> Index(['pop song', 'popular songs', 'the song']).expand_wildcards(['pop*', '*ng'])
+        ['pop', 'popular', 'song']
+        """
+        terms = []
+        for pattern in patterns:
+            kgrams = self.kgram_index() if not pattern.split('*')[0] else self.kgrams
+            terms.extend(term for term in dictionary.expand_wildcard(self.terms(), pattern, kgrams)
+                         if term in self.index)
+        return terms
+
+    def suggest(self, term, max_distance=2, budget=.001):
+        """
+        Return the terms of the index closest to term, if any are within
+        max_distance edits (see dictionary.fuzzy_matches), most frequent
+        first. The search for candidates stops after budget seconds.
+        >>> Index(['nuclear test', 'unclear', 'nuclear', 'nucleus']).suggest('nucelar')
+        ['nuclear']
+        """
+        matches = dictionary.fuzzy_matches(self.terms(), self.kgram_index(), term, max_distance, budget)
+        matches = [(distance, match) for distance, match in matches if match in self.index]
+        closest = [match for distance, match in matches if distance == matches[0][0]]
+        return sorted(closest, key=lambda match: (-self.doc_freqs[match], match))
+
+    def kgram_index(self):
+        """ Return the k-gram index of the terms, building it on first use. """
+        if self.kgrams is None:
+            self.snapshot.kgrams = dictionary.KGramIndex(self.terms())
+        return self.kgrams
+
+    def terms(self):
+        """ Return the term dictionary of the main segment. Terms that only
+        occur in added documents are not in it until the next merge, so
+        wildcards and spelling suggestions do not see them yet. """
+        return self.segments.main if self.segments is not None else self.index
+
     def tokenize(self, document):
-        """ DO NOT MODIFY.
+        """
         Convert a string representing one document into a list of
         words. Retain hyphens and apostrophes inside words. Remove all other
-        punctuation and convert to lowercase.
+        punctuation and convert to lowercase. Stopwords and stemming, if the
+        analyzer has them, apply too.
         >>> Index().tokenize("Hi there. What's going on? first-class")
         ['hi', 'there', "what's", 'going', 'on', 'first-class']
         """
-        return [t.lower() for t in re.findall(r"\w+(?:[-']\w+)*", document)]
\ No newline at end of file
+        return self.analyzer.analyze(document)
+
+
+class Accumulator(object):
+    """
+    The scores of a query, in an array indexed by document id that is
+    allocated once and reset after each query, with a mask of the documents
+    scored so far. The contributions of a term are added for its whole
+    postings list at once. Document ids index the arrays directly, from 1,
+    so they never need to be mapped to and from 0..N-1.
+    >>> scores = Accumulator(4)
+    >>> scores.add(np.array([1, 3]), 2.)
+    >>> scores.add(np.array([3]), np.array([.5]))
+    >>> scores.pop()
+    {1: 2.0, 3: 2.5}
+    >>> scores.add(np.array([2]), 1.)
+    >>> scores.pop(np.array([0., 4., 4., 4.]))
+    {2: 0.25}
+    >>> bool(scores.scores.any() or scores.scored.any())
+    False
+    """
+
+    def __init__(self, size):
+        self.scores = np.zeros(size)
+        self.scored = np.zeros(size, dtype=bool)
+
+    def add(self, doc_ids, values):
+        """ Add values (an array, or one value for all) to the scores of
+        doc_ids, which must be distinct. """
+        self.scores[doc_ids] += values
+        self.scored[doc_ids] = True
+
+    def pop(self, divisors=None):
+        """ Return a dict from each scored document id to its score,
+        divided by divisors[doc_id] if divisors are given, by increasing id;
+        then reset the scores. """
+        doc_ids = np.flatnonzero(self.scored)
+        scores = self.scores[doc_ids]
+        if divisors is not None:
+            scores /= divisors[doc_ids]
+        self.scores[doc_ids] = 0.
+        self.scored[doc_ids] = False
+        return dict(zip(doc_ids.tolist(), scores.tolist()))
+
+
+class Snapshot(object):
+    """
+    The searchable state of an Index: its postings, document frequencies,
+    document lengths, mean document length and norms, the number of
+    documents and the largest document id, the number of updates and merges
+    it results from (its version), the Segments they are read
+    through while the index is being updated (None otherwise), the positions
+    of a positional index, and the values cached from them. A snapshot is
+    not changed once installed, except to fill its caches: updates and
+    merges build a new one and install it with a single assignment (see
+    Index.freeze and install), so a search holding a snapshot (see
+    Index.pin) reads the complete old state or the complete new one, never a
+    mix of both, and caches only values computed from it.
+    """
+    __slots__ = ('index', 'doc_freqs', 'doc_lengths', 'mean_doc_length', 'doc_norms', 'n_docs', 'max_doc_id',
+                 'version', 'segments', 'positions', 'max_scores', 'idfs', 'length_norms', 'kgrams')
+
+    def __init__(self, index, doc_freqs, doc_lengths, mean_doc_length, doc_norms, n_docs, max_doc_id,
+                 segments=None, positions=None, version=0):
+        self.index = index
+        self.doc_freqs = doc_freqs
+        self.doc_lengths = doc_lengths
+        self.mean_doc_length = mean_doc_length
+        self.doc_norms = doc_norms
+        self.n_docs = n_docs
+        self.max_doc_id = max_doc_id
+        self.version = version
+        self.segments = segments
+        self.positions = positions
+        self.max_scores = {}
+        self.idfs = {}
+        self.length_norms = {}
+        self.kgrams = None
+
+
+class Segments(object):
+    """ The main segment of an Index being updated, with the updates made
+    since it was built: the postings and lengths of added documents (the
+    delta segment) and the ids of deleted documents (tombstones). Segments
+    are not changed once made: an update returns new Segments, which share
+    the main segment and copy the delta (see with_documents and
+    without_documents). """
+
+    def __init__(self, main, main_lengths):
+        self.main = main
+        self.main_lengths = main_lengths
+        self.delta = {}
+        self.delta_lengths = {}
+        self.deleted = frozenset()
+        self.total_length = sum(main_lengths.values())
+        self.n_lengths = len(main_lengths)
+
+    def with_documents(self, index, doc_lengths):
+        """ Return new Segments with the postings (from count_terms) and
+        lengths of added documents appended to the delta segment. Only the
+        postings lists of the terms of index are rebuilt. """
+        segments = copy.copy(self)
+        segments.delta = dict(self.delta)
+        for term, pairs in index.items():
+            segments.delta[term] = self.delta.get(term, ()) + tuple(pairs)
+        segments.delta_lengths = dict(self.delta_lengths)
+        segments.delta_lengths.update(doc_lengths)
+        segments.total_length += sum(doc_lengths.values())
+        segments.n_lengths += len(doc_lengths)
+        return segments
+
+    def without_documents(self, doc_ids, lengths):
+        """ Return new Segments with the live documents doc_ids, of the given
+        lengths (one per document that has a length), deleted. """
+        segments = copy.copy(self)
+        segments.deleted = self.deleted | frozenset(doc_ids)
+        segments.total_length -= sum(lengths)
+        segments.n_lengths -= len(lengths)
+        return segments
+
+
+class LivePostings(Mapping):
+    """
+    The postings of the live documents of a Segments: those of the main
+    segment without the deleted documents, followed by those of the delta
+    segment. Terms without live postings are absent.
+    >>> segments = Segments({'a': postings.Postings([[1, 2.], [2, 1.]], 'f')}, {1: 2., 2: 1.})
+    >>> updated = segments.with_documents({'a': [[3, 1.]]}, {3: 1.}).without_documents([1], [2.])
+    >>> dict(LivePostings(updated)), dict(LivePostings(segments))
+    ({'a': Postings([(2, 1.0), (3, 1.0)])}, {'a': Postings([(1, 2.0), (2, 1.0)])})
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.cache = {}
+
+    def __getitem__(self, term):
+        if term not in self.cache:
+            main = self.segments.main.get(term, ())
+            delta = self.segments.delta.get(term, ())
+            if not delta and not self.segments.deleted:
+                self.cache[term] = main
+            else:
+                deleted = self.segments.deleted
+                self.cache[term] = postings.Postings(
+                    [pair for pair in list(main) + list(delta) if pair[0] not in deleted], 'f')
+        if not self.cache[term]:
+            raise KeyError(term)
+        return self.cache[term]
+
+    def __iter__(self):
+        for term in self.segments.main:
+            if term in self:
+                yield term
+        for term in self.segments.delta:
+            if term not in self.segments.main and term in self:
+                yield term
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class LiveFreqs(Mapping):
+    """ The document frequencies of a LivePostings. """
+
+    def __init__(self, live_postings):
+        self.postings = live_postings
+
+    def __getitem__(self, term):
+        return len(self.postings[term]) * 1.
+
+    def __iter__(self):
+        return iter(self.postings)
+
+    def __len__(self):
+        return len(self.postings)
+
+
+class LiveLengths(Mapping):
+    """ The lengths of the live documents of a Segments. """
+
+    def __init__(self, segments):
+        self.segments = segments
+
+    def __getitem__(self, doc_id):
+        if doc_id in self.segments.deleted:
+            raise KeyError(doc_id)
+        if doc_id in self.segments.delta_lengths:
+            return self.segments.delta_lengths[doc_id]
+        return self.segments.main_lengths[doc_id]
+
+    def __iter__(self):
+        for lengths in (self.segments.main_lengths, self.segments.delta_lengths):
+            for doc_id in lengths:
+                if doc_id not in self.segments.deleted:
+                    yield doc_id
+
+    def __len__(self):
+        return self.segments.n_lengths
+
+
+class LiveNorms(Mapping):
+    """ The tf-idf norms of the n_docs live documents of a LivePostings.
+    Every update changes n_docs and possibly document frequencies, so the
+    norms are computed from the live postings on first use of the snapshot
+    of an update, rather than by each update. """
+
+    def __init__(self, live_postings, n_docs):
+        self.postings = live_postings
+        self.doc_freqs = LiveFreqs(live_postings)
+        self.n_docs = n_docs
+        self.norms = None
+
+    def current(self):
+        if self.norms is None:
+            self.norms = Index().finish_index(self.doc_freqs, self.postings, {}, self.n_docs)[4]
+        return self.norms
+
+    def __getitem__(self, doc_id):
+        return self.current()[doc_id]
+
+    def __iter__(self):
+        return iter(self.current())
+
+    def __len__(self):
+        return len(self.current())
+
+
+def count_shard(shard):
+    """ Tokenize and count one shard of documents, given as a tuple
+    (documents, id of the first document, analyzer, number of partitions).
+    Run in worker processes by Index.build_parallel.
+    Returns:
+      A tuple (list of (doc_freqs, index) pairs, one per term partition,
+      doc_lengths). """
+    docs, first_doc_id, analyzer, n_partitions = shard
+    doc_freqs, index, doc_lengths = Index(analyzer=analyzer).count_terms(analyzer.analyze_batch(docs), first_doc_id)
+    return postings.split_by_term((doc_freqs, index), n_partitions), doc_lengths
+
+
+def finish_partition(partition):
+    """ Merge the counts of the shards for one partition of the terms, given
+    as a tuple (list of (doc_freqs, index) pairs in document order, number of
+    documents), and compute their contributions to the squared norms. Run in
+    worker processes by Index.build_parallel.
+    Returns:
+      A tuple (doc_freqs, index, norm_squares). """
+    pieces, n_docs = partition
+    doc_freqs, index = postings.merge_counts(pieces)
+    return doc_freqs, index, dict(Index().norm_squares(doc_freqs, index, n_docs))
@@ -0,0 +1,108 @@
+""" Batch scoring with a sparse term-document matrix.
+The postings of an Index are copied into a CSR matrix with one row per term
+and one column per document. A scorer turns the raw term frequencies into a
+weight matrix with vectorized transforms (see ScoringFunction.weight_matrix),
+and a whole batch of queries is then scored with one sparse matrix product.
+"""
+import numpy as np
+from scipy import sparse
+
+import shared  # puts IIT/common, with the shared modules, on sys.path
+import postings
+
+
+class TermDocMatrix(object):
+    """
+    The term frequencies of an Index as a sparse matrix, plus the per-term
+    and per-document statistics the scorers need, as NumPy arrays. Column j
+    holds the document with id j + 1; columns of deleted documents are empty.
+    >>> import index
+    >>> m = TermDocMatrix(index.Index(['a a b c', 'c d e', 'c e f']))
+    >>> m.tf.shape
+    (6, 3)
+    >>> m.tf[m.term_ids['a']].toarray()
+    array([[2., 0., 0.]])
+    >>> m.doc_lengths
+    array([4., 3., 3.])
+    """
+
+    def __init__(self, index):
+        self.terms = list(index.index.keys())
+        self.term_ids = dict((term, i) for i, term in enumerate(self.terms))
+        self.n_docs = index.n_docs
+        n_columns = index.max_doc_id
+        columns = [postings.columns(index.index[term]) for term in self.terms]
+        indptr = np.zeros(len(self.terms) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(doc_ids) for doc_ids, _ in columns])
+        indices = np.concatenate([np.asarray(doc_ids, dtype=np.int32) - 1 for doc_ids, _ in columns] or [[]])
+        data = np.concatenate([np.asarray(tfs, dtype=np.float64) for _, tfs in columns] or [[]])
+        self.tf = sparse.csr_matrix((data, indices, indptr), shape=(len(self.terms), n_columns))
+        # Row and column of every stored entry, for vectorized weighting.
+        self.rows = np.repeat(np.arange(len(self.terms)), np.diff(indptr))
+        self.cols = self.tf.indices
+        df = np.array([index.doc_freqs[term] for term in self.terms], dtype=np.float64)
+        self.idf = np.log10(self.n_docs / df) if len(df) else df
+        self.doc_lengths = np.zeros(n_columns)
+        self.doc_norms = np.zeros(n_columns)
+        for doc_id, length in index.doc_lengths.items():
+            self.doc_lengths[doc_id - 1] = length
+        for doc_id, norm in index.doc_norms.items():
+            self.doc_norms[doc_id - 1] = norm
+        self.mean_doc_length = index.mean_doc_length
+        self.weights = {}
+
+    def with_data(self, data):
+        """ Return a matrix with the sparsity pattern of tf and the given
+        values for its stored entries. """
+        return sparse.csr_matrix((data, self.tf.indices, self.tf.indptr), shape=self.tf.shape)
+
+    def weight_matrix(self, scorer):
+        """ Return the weight matrix of scorer, computing it on first use. """
+        if scorer.key() not in self.weights:
+            self.weights[scorer.key()] = scorer.weight_matrix(self)
+        return self.weights[scorer.key()]
+
+    def query_matrix(self, query_vectors, scorer):
+        """
+        Return a sparse matrix with one row per query vector and one column per
+        term, holding the query side weights of scorer (see
+        ScoringFunction.query_weight). Terms missing from the index are
+        ignored, as in Index.query_to_vector.
+        """
+        rows, cols, data = [], [], []
+        for i, query_vector in enumerate(query_vectors):
+            for term, weight in query_vector.items():
+                if term in self.term_ids:
+                    rows.append(i)
+                    cols.append(self.term_ids[term])
+                    data.append(scorer.query_weight(weight))
+        return sparse.csr_matrix((data, (rows, cols)), shape=(len(query_vectors), len(self.terms)))
+
+    def score(self, query_vectors, scorer):
+        """
+        Score every document against a batch of query vectors with a single
+        sparse product. Returns a CSR matrix with one row per query and one
+        column per document; documents scoring exactly 0 are not stored.
+        """
+        return self.query_matrix(query_vectors, scorer).dot(self.weight_matrix(scorer)).tocsr()
+
+    def search(self, query_vectors, scorer, k=None):
+        """
+        Return, for each query vector, the list of matching document ids in the
+        order used by main.search: descending score rounded to 6 decimal
+        places, then ascending document id. If k is given, only the top k
+        documents of each query are returned.
+        >>> import index, score
+        >>> idx = index.Index(['a a b c', 'c d e', 'c e f', 'a', 'e e f'])
+        >>> m = TermDocMatrix(idx)
+        >>> m.search([idx.query_to_vector(['a', 'e', 'f']), idx.query_to_vector(['d'])], score.BM25(), 3)
+        [[5, 3, 1], [2]]
+        """
+        scores = self.score(query_vectors, scorer)
+        results = []
+        for i in range(scores.shape[0]):
+            row = slice(scores.indptr[i], scores.indptr[i + 1])
+            docs = scores.indices[row]
+            order = np.lexsort((docs, -np.round(scores.data[row], 6)))[:k]
+            results.append([int(doc) + 1 for doc in docs[order]])
+        return results
@@ -3,7 +3,30 @@
 import abc
 import math
 
+import numpy as np
+
+import shared  # puts IIT/common, with the shared modules, on sys.path
 import index
+import postings
+
+# 1 + log10(tf) for tf = 0, 1, 2, ... (NaN for 0), computed with math.log
+# and extended as larger frequencies are seen (see tf_weights).
+TF_WEIGHTS = np.array([np.nan])
+
+
+def tf_weights(tfs):
+    """
+    Return 1 + log10(tf) for a numpy array of term frequencies, which are
+    whole numbers. The values are looked up in TF_WEIGHTS, so they are
+    those of math.log, used for single postings, to the last bit.
+    >>> tf_weights(np.array([1., 10., 100.]))
+    array([1., 2., 3.])
+    """
+    global TF_WEIGHTS
+    size = int(tfs.max()) + 1 if len(tfs) else 0
+    if size > len(TF_WEIGHTS):
+        TF_WEIGHTS = np.array([np.nan] + [1. + math.log(tf, 10) for tf in range(1, 2 * size)])
+    return TF_WEIGHTS[tfs.astype(np.intp)]
 
 
 def idf(term, index):
@@ -24,9 +47,7 @@ def idf(term, index):
     >>> idf('e', idx) # doctest:+ELLIPSIS
     0.176...
     """
-    if index.doc_freqs[term] == 0 or len(index.documents) == 0:
-        return 0
-    return math.log(len(index.documents) *1. / index.doc_freqs[term],10)
+    return index.idf(term)
 
 class ScoringFunction:
     """ An Abstract Base Class for ranking documents by relevance to a
@@ -43,6 +64,119 @@ class ScoringFunction:
         """
         return
 
+    @abc.abstractmethod
+    def term_scorer(self, term, weight, index):
+        """
+        Return a function mapping a (doc_id, tf) posting of term to that
+        term's contribution to the document score, so that the score of a
+        document is the sum of the contributions of the query terms it
+        contains.
+        Params:
+          term.....A query term present in the index.
+          weight...The weight of term in the query vector.
+          index....Index object.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def term_scores(self, term, weight, index):
+        """
+        Return the document ids of the postings of term and the contribution
+        of term to each of their scores (see term_scorer), as two numpy
+        arrays computed over the whole postings list.
+        """
+        raise NotImplementedError
+
+    def accumulate(self, query_vector, index):
+        """ Return the dict from doc_id to score of a query, summing the
+        term_scores of its terms in the accumulator of the index. """
+        index = index.pin()
+        scores = index.accumulator()
+        for term, weight in query_vector.items():
+            scores.add(*self.term_scores(term, weight, index))
+        return scores.pop()
+
+    @abc.abstractmethod
+    def weight_matrix(self, matrix):
+        """
+        Return the document side weights of this scorer for every entry of a
+        matrix.TermDocMatrix, as a sparse matrix with the same shape, computed
+        with vectorized operations over the stored term frequencies.
+        """
+        raise NotImplementedError
+
+    def query_weight(self, weight):
+        """ Return the query side factor of a term with the given query
+        vector weight. The default ignores the weight, as RSV and BM25 do. """
+        return 1.
+
+    def key(self):
+        """ Return a hashable value identifying this scorer and its
+        parameters, e.g. to cache values that depend on them. """
+        return (self.__class__.__name__, tuple(sorted(self.__dict__.items())))
+
+    def max_score(self, term, weight, index):
+        """
+        Return the largest contribution term can make to any document score.
+        The value is computed once per scorer, term and weight and cached in
+        index.max_scores.
+        """
+        cache_key = (self.key(), term, weight)
+        if cache_key not in index.max_scores:
+            index.max_scores[cache_key] = float(self.term_scores(term, weight, index)[1].max())
+        return index.max_scores[cache_key]
+
+    def top_k(self, query_vector, index, k):
+        """
+        Return the k highest scoring (doc_id, score) pairs, in the order used by
+        main.search: descending score rounded to 6 decimal places, then
+        ascending document id.
+        The postings are traversed document at a time, as in daat, using the
+        MaxScore strategy (see postings.maxscore), with the maximum
+        contribution of each query term (see max_score) as its bound.
+        The scorers and bounds are computed from one snapshot of the index
+        (see Index.pin), whatever updates are made meanwhile.
+        Params:
+          query_vector...dict mapping query term to weight.
+          index..........Index object.
+          k..............Number of results to return.
+        >>> idx = index.Index(['a a b c', 'c d e', 'c e f', 'a', 'e e f'])
+        >>> query = idx.query_to_vector(['a', 'e', 'f'])
+        >>> BM25().top_k(query, idx, 2)  # doctest:+ELLIPSIS
+        [(5, 0.683...), (3, 0.608...)]
+        >>> [doc_id for doc_id, _ in Cosine().top_k(query, idx, 10)]
+        [5, 3, 4, 1, 2]
+        """
+        index = index.pin()
+        terms = sorted((self.max_score(term, weight, index), term, weight)
+                       for term, weight in query_vector.items())
+        return postings.maxscore([postings.Cursor(index.index[term]) for _, term, _ in terms],
+                                 [self.term_scorer(term, weight, index) for _, term, weight in terms],
+                                 [bound for bound, _, _ in terms], k)
+
+    def daat(self, query_vector, index, k=None):
+        """
+        Return the k highest scoring (doc_id, score) pairs, or every match if
+        k is None, in the order of top_k. The query is evaluated document at
+        a time (see postings.daat): where score accumulates a score for every
+        document of the union of the postings lists, the memory used here
+        grows only with k and the number of query terms. Unlike top_k, every
+        posting is visited.
+        Params:
+          query_vector...dict mapping query term to weight.
+          index..........Index object.
+          k..............Number of results to return, or None for all.
+        >>> idx = index.Index(['a a b c', 'c d e', 'c e f', 'a', 'e e f'])
+        >>> query = idx.query_to_vector(['a', 'e', 'f'])
+        >>> BM25().daat(query, idx, 2) == BM25().top_k(query, idx, 2)
+        True
+        >>> [doc_id for doc_id, _ in Cosine().daat(query, idx)]
+        [5, 3, 4, 1, 2]
+        """
+        index = index.pin()
+        return postings.daat([postings.Cursor(index.index[term]) for term in query_vector],
+                             [self.term_scorer(term, weight, index) for term, weight in query_vector.items()], k)
+
 
 class RSV(ScoringFunction):
     """
@@ -57,21 +191,18 @@ class RSV(ScoringFunction):
     """
 
     def score(self, query_vector, index):
-        rsv = {}
-        doc_id = 0
-        for doc in index.documents:
-            for query in query_vector:
-                if query in index.documents[doc_id]:
-                    tmp_rsv = math.log(len(index.documents) * 1. / index.doc_freqs[query], 10)
-                    if (doc_id+1) in rsv.keys():
-                        rsv[doc_id + 1] += tmp_rsv
-                    else:
-                        rsv[doc_id + 1] = tmp_rsv
-            doc_id += 1
-        return rsv
+        return self.accumulate(query_vector, index)
 
+    def term_scores(self, term, weight, index):
+        doc_ids, _ = index.columns(term)
+        return doc_ids, np.full(len(doc_ids), idf(term, index))
 
+    def term_scorer(self, term, weight, index):
+        term_idf = idf(term, index)
+        return lambda doc_id, tf: term_idf
 
+    def weight_matrix(self, matrix):
+        return matrix.with_data(matrix.idf[matrix.rows])
 
     def __repr__(self):
         return 'RSV'
@@ -91,21 +222,22 @@ class BM25(ScoringFunction):
         self.b = b
 
     def score(self, query_vector, index):
-        bm25 = {}
-        doc_id = 0
-        for doc in index.documents:
-            for query in query_vector:
-                if query in index.documents[doc_id]:
-                    tf_i = index.documents[doc_id].count(query)
-                    tmp_bm = math.log(len(index.documents) * 1. / index.doc_freqs[query], 10) * (self.k + 1) * tf_i / (
-                    self.k * (1 - self.b + self.b * len(index.documents[doc_id])/index.mean_doc_length) + tf_i)
-                    if (doc_id + 1) in bm25.keys():
-                        bm25[doc_id + 1] += tmp_bm
-                    else:
-                        bm25[doc_id + 1] = tmp_bm
-            doc_id += 1
-        return bm25
+        return self.accumulate(query_vector, index)
+
+    def term_scores(self, term, weight, index):
+        doc_ids, tfs = index.columns(term)
+        norms = np.frombuffer(index.bm25_norms(self.k, self.b))
+        return doc_ids, idf(term, index) * (self.k + 1) * tfs / (norms[doc_ids] + tfs)
 
+    def term_scorer(self, term, weight, index):
+        scale = idf(term, index) * (self.k + 1)
+        norms = index.bm25_norms(self.k, self.b)
+        return lambda doc_id, tf: scale * tf / (norms[doc_id] + tf)
+
+    def weight_matrix(self, matrix):
+        tf = matrix.tf.data
+        norm = self.k * (1 - self.b + self.b * matrix.doc_lengths / matrix.mean_doc_length)
+        return matrix.with_data(matrix.idf[matrix.rows] * (self.k + 1) * tf / (norm[matrix.cols] + tf))
 
     def __repr__(self):
         return 'BM25 k=%d b=%.2f' % (self.k, self.b)
@@ -115,25 +247,130 @@ class Cosine(ScoringFunction):
     """
     See lecture notes for definition of Cosine similarity.  Be sure to use the
     precomputed document norms (in index), rather than recomputing them for
-    each query.
+    each query. A document whose norm is 0, because each of its terms
+    occurs in every document, scores 0.
     >>> idx = index.Index(['a a b c', 'c d e', 'c e f']) # doctest:+ELLIPSIS
     >>> cos = Cosine() # doctest:+ELLIPSIS
     >>> cos.score({'a': 1.}, idx)[1]  # doctest:+ELLIPSIS
     0.792857...
+    >>> idx = index.Index(['a b', 'a c', 'b d'])
+    >>> idx.delete_documents([2, 3])
+    >>> cos.score({'a': 1.}, idx), cos.daat({'a': 1.}, idx), cos.top_k({'a': 1.}, idx, 1)
+    ({1: 0.0}, [(1, 0.0)], [(1, 0.0)])
     """
     def score(self, query_vector, index):
-        cos = {}
+        index = index.pin()
+        cos = index.accumulator()
         for word in query_vector:
-            for tempList in index.index[word]:
-                tmp_val = query_vector[word] * (1. + math.log(tempList[1],10)) * (idf(word, index))
-                if tempList[0] in cos:
-                    cos[tempList[0]] += tmp_val
-                else:
-                    cos[tempList[0]] = tmp_val
+            doc_ids, tfs = index.columns(word)
+            cos.add(doc_ids, query_vector[word] * tf_weights(tfs) * idf(word, index))
+        return cos.pop(index.cosine_norms())
+
+    def term_scores(self, term, weight, index):
+        doc_ids, tfs = index.columns(term)
+        return doc_ids, weight * idf(term, index) * tf_weights(tfs) / index.cosine_norms()[doc_ids]
+
+    def term_scorer(self, term, weight, index):
+        term_weight = weight * idf(term, index)
+        doc_norms = index.doc_norms
+
+        def scorer(doc_id, tf):
+            norm = doc_norms[doc_id]
+            return term_weight * (1. + math.log(tf, 10)) / norm if norm else 0.
+        return scorer
 
-        for doc_id in cos.keys():
-            cos[doc_id] /= index.doc_norms[doc_id]
-        return cos
+    def weight_matrix(self, matrix):
+        norms = np.where(matrix.doc_norms > 0, matrix.doc_norms, 1.)
+        return matrix.with_data((1. + np.log10(matrix.tf.data)) * matrix.idf[matrix.rows] / norms[matrix.cols])
+
+    def query_weight(self, weight):
+        return weight
 
     def __repr__(self):
         return 'Cosine'
+
+
+class ProximityBoost(ScoringFunction):
+    """
+    Rank with scorer, then boost documents where the query terms occur close
+    together. The score of a document containing n > 1 of the query terms,
+    at best within a window spanning s positions (see postings.min_span),
+    is multiplied by 1 + weight * (n - 1) / s: by 1 + weight when they form
+    a phrase, and by less the farther apart they are. Needs an index built
+    with positional=True.
+    >>> idx = index.Index(['new york times', 'york is new', 'new and old york', 'old times'], positional=True)
+    >>> boost = ProximityBoost(RSV())
+    >>> query = idx.query_to_vector(['new', 'york'])
+    >>> [(doc_id, round(score, 6)) for doc_id, score in sorted(boost.score(query, idx).items())]
+    [(1, 0.499755), (2, 0.374816), (3, 0.33317)]
+    >>> query = idx.query_to_vector(['times', 'york'])
+    >>> boost.top_k(query, idx, 2)  # doctest:+ELLIPSIS
+    [(1, 0.851...), (4, 0.301...)]
+    >>> boost.daat(query, idx) == boost.top_k(query, idx, 4)
+    True
+    """
+
+    def __init__(self, scorer, weight=1.):
+        self.scorer = scorer
+        self.weight = weight
+
+    def score(self, query_vector, index):
+        index = index.pin()
+        scores = self.scorer.score(query_vector, index)
+        for doc_id in scores:
+            scores[doc_id] *= self.boost(doc_id, query_vector, index)
+        return scores
+
+    def boost(self, doc_id, query_vector, index):
+        """ Return the factor by which the score of doc_id is boosted. """
+        if index.positions is None:
+            raise ValueError('ProximityBoost needs an index built with positional=True')
+        position_lists = [positions for positions in (index.positions[term].positions(doc_id)
+                                                      for term in query_vector) if positions]
+        if len(position_lists) < 2:
+            return 1.
+        return 1 + self.weight * (len(position_lists) - 1) / postings.min_span(position_lists)
+
+    def top_k(self, query_vector, index, k):
+        """ Return the k best (doc_id, score) pairs of score, in the order of
+        ScoringFunction.top_k (see rerank). """
+        index = index.pin()
+        return self.rerank(self.scorer.score(query_vector, index).items(), query_vector, index, k)
+
+    def daat(self, query_vector, index, k=None):
+        """ Like top_k, but with the matches of scorer found document at a
+        time (see ScoringFunction.daat), and all of them if k is None. """
+        index = index.pin()
+        return self.rerank(self.scorer.daat(query_vector, index), query_vector, index, k)
+
+    def weight_matrix(self, matrix):
+        """
+        Boosts depend on the positions of the query terms in each document,
+        which a weight matrix cannot hold, so ProximityBoost cannot be used
+        with a matrix.TermDocMatrix.
+        >>> ProximityBoost(RSV()).weight_matrix(None)
+        Traceback (most recent call last):
+        ...
+        TypeError: RSV+proximity 1.00 is not supported by the matrix engine
+        """
+        raise TypeError('%s is not supported by the matrix engine' % self)
+
+    def rerank(self, matches, query_vector, index, k):
+        """ Return the k best of the (doc_id, score) pairs of scorer in
+        matches once boosted. Documents are boosted by decreasing score of
+        scorer, until even the largest boost, 1 + weight, cannot bring the
+        next one into the top k. """
+        if k is not None and k <= 0:
+            return []
+        best = postings.TopK(k)
+        for doc_id, score in sorted(matches, key=lambda item: -item[1]):
+            if best.threshold is not None and round(score * (1 + self.weight), 6) < best.threshold:
+                break
+            best.push(doc_id, score * self.boost(doc_id, query_vector, index))
+        return best.results()
+
+    def key(self):
+        return (self.__class__.__name__, self.scorer.key(), self.weight)
+
+    def __repr__(self):
+        return '%s+proximity %.2f' % (self.scorer, self.weight)
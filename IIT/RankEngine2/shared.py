@@ -0,0 +1,10 @@
+""" The modules shared by the engines (postings, analysis, cache, dictionary
+and readers) live in IIT/common. Importing this module puts that directory
+on sys.path, so they are imported by name, like the modules of this one.
+"""
+import os
+import sys
+
+COMMON = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+if COMMON not in sys.path:
+    sys.path.append(COMMON)
@@ -0,0 +1,150 @@
+""" Single-pass in-memory indexing (SPIMI) for collections larger than memory.
+Documents are streamed one at a time. Their postings are collected in a
+dictionary until an estimated memory budget is reached; the block is then
+written to disk with its terms sorted, and a new block is started. Once every
+document has been added, the blocks are merged with a k-way merge straight
+into an index segment, in the layout written by Index.save, which
+Index.load memory-maps. Only one block, the per-document statistics and the
+term dictionary are ever held in memory.
+Block files are text, one term per line: the term, a tab, then the
+"doc_id tf" pairs of its postings, separated by spaces.
+"""
+from array import array
+from collections import Counter
+import heapq
+import itertools
+import math
+import os
+
+import shared  # puts IIT/common, with the shared modules, on sys.path
+import analysis
+import index
+import postings
+
+# Rough sizes of a posting (document id and tf in an array) and of a new
+# term (dict entry, string and arrays), used to estimate the size of a block.
+POSTING_BYTES = 8
+TERM_BYTES = 200
+
+
+def read_block(f, block_number):
+    """ Yield (encoded term, block_number, line) for each line of an open
+    block file, the sort key used to merge blocks. """
+    for line in f:
+        yield line.split('\t', 1)[0].encode('utf-8'), block_number, line
+
+
+class SPIMIIndexer(object):
+    """
+    Build an index segment with blocks of at most memory_budget bytes
+    (estimated) written to block_dir. Documents are turned into terms by
+    analyzer (see analysis.Analyzer), which is saved with the segment.
+    >>> import tempfile
+    >>> docs = ['a b c a', 'b c', 'd e', 'a e e']
+    >>> indexer = SPIMIIndexer(tempfile.mkdtemp(), memory_budget=500)
+    >>> idx = indexer.build(docs, os.path.join(indexer.block_dir, 'index.seg'))
+    >>> indexer.n_blocks
+    3
+    >>> list(idx.index['a']), list(idx.index['e'])
+    ([(1, 2.0), (4, 1.0)], [(3, 1.0), (4, 2.0)])
+    >>> expected = index.Index(docs)
+    >>> all(round(idx.doc_norms[d], 9) == round(expected.doc_norms[d], 9) for d in expected.doc_norms)
+    True
+    """
+
+    def __init__(self, block_dir, memory_budget=64 * 1024 * 1024, analyzer=None):
+        self.block_dir = block_dir
+        self.analyzer = analyzer or analysis.Analyzer()
+        self.memory_budget = memory_budget
+        self.block = {}
+        self.block_bytes = 0
+        self.blocks = []
+        self.n_blocks = 0
+        self.n_docs = 0
+        self.doc_lengths = array('d', [float('nan')])
+
+    def add(self, tokens):
+        """ Add the next document, given as a list of tokens. Documents are
+        numbered from 1 in the order they are added. """
+        self.n_docs += 1
+        counts = Counter(tokens)
+        for term, tf in counts.items():
+            if term not in self.block:
+                self.block[term] = array('i')
+                self.block_bytes += TERM_BYTES
+            self.block[term].extend((self.n_docs, tf))
+            self.block_bytes += POSTING_BYTES
+        self.doc_lengths.append(len(tokens) * 1. if counts else float('nan'))
+        if self.block_bytes >= self.memory_budget:
+            self.flush()
+
+    def flush(self):
+        """ Write the current block to disk, sorted by term, and empty it. """
+        path = os.path.join(self.block_dir, 'spimi_block%d.txt' % self.n_blocks)
+        with open(path, 'w', encoding='utf-8') as f:
+            for term in sorted(self.block, key=lambda t: t.encode('utf-8')):
+                f.write('%s\t%s\n' % (term, ' '.join(map(str, self.block[term]))))
+        self.blocks.append(path)
+        self.n_blocks += 1
+        self.block = {}
+        self.block_bytes = 0
+
+    def merge(self, path):
+        """
+        Merge all blocks into an index segment written to path, and return
+        the memory-mapped Index. Blocks hold increasing document ids, so the
+        postings of a term are the concatenation of its lines in block order.
+        Document norms are accumulated as each term is merged, since its
+        document frequency is known at that point.
+        """
+        if self.block:
+            self.flush()
+        files = [open(block, encoding='utf-8') for block in self.blocks]
+        lines = heapq.merge(*[read_block(f, i) for i, f in enumerate(files)])
+        terms = []
+        doc_freqs = array('d')
+        starts = array('q', [0])
+        norms = array('d', [0.]) * (self.n_docs + 1)
+        doc_ids_path = os.path.join(self.block_dir, 'doc_ids.tmp')
+        tfs_path = os.path.join(self.block_dir, 'tfs.tmp')
+        with open(doc_ids_path, 'wb') as doc_ids_file, open(tfs_path, 'wb') as tfs_file:
+            for key, group in itertools.groupby(lines, key=lambda entry: entry[0]):
+                values = [int(v) for _, _, line in group for v in line.split('\t', 1)[1].split()]
+                doc_ids = array('i', values[0::2])
+                tfs = array('f', values[1::2])
+                idf = math.log(self.n_docs * 1. / len(doc_ids), 10)
+                for doc_id, tf in zip(doc_ids, tfs):
+                    norms[doc_id] += ((1 + math.log(tf, 10)) * idf) ** 2
+                doc_ids.tofile(doc_ids_file)
+                tfs.tofile(tfs_file)
+                terms.append(key.decode('utf-8'))
+                doc_freqs.append(len(doc_ids))
+                starts.append(starts[-1] + len(doc_ids))
+        for f in files:
+            f.close()
+        lengths = [length for length in self.doc_lengths if not math.isnan(length)]
+        doc_norms = array('d', [math.sqrt(norm) if not math.isnan(length) else float('nan')
+                                for norm, length in zip(norms, self.doc_lengths)])
+        _, blob, offsets = postings.pack_terms(terms)
+        postings.write_segment(path, {'n_docs': self.n_docs,
+                                      'mean_doc_length': sum(lengths) / len(lengths) if lengths else 0.,
+                                      'analyzer': self.analyzer.config()}, [
+            ('terms', blob),
+            ('term_offsets', offsets),
+            ('doc_freqs', doc_freqs),
+            ('postings_starts', starts),
+            ('doc_ids', postings.FileSection('i', doc_ids_path)),
+            ('tfs', postings.FileSection('f', tfs_path)),
+            ('doc_lengths', self.doc_lengths),
+            ('doc_norms', doc_norms)])
+        for block in self.blocks + [doc_ids_path, tfs_path]:
+            os.remove(block)
+        self.blocks = []
+        return index.Index.load(path)
+
+    def build(self, docs, path):
+        """ Tokenize and add each document of the iterable docs, then merge
+        the blocks into a segment at path. Returns the loaded Index. """
+        for tokens in self.analyzer.analyze_batch(docs):
+            self.add(tokens)
+        return self.merge(path)
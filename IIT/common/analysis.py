@@ -0,0 +1,160 @@
+""" Text analysis: the pipeline turning a document into the terms that are
+indexed, tokenize -> lowercase -> stopwords -> stem.
+Tokenizing with a regular expression is the dominant cost of indexing, so an
+Analyzer first maps separator characters to spaces with str.translate and
+splits the text on whitespace, both in C. Each word is then analyzed once: its
+tokens (found by the regular expression, within the word only, since tokens
+never span a separator), lowercased, filtered and stemmed, are memoised per
+surface form, and the following occurrences of the word cost a dict lookup.
+Terms are interned as they are first seen: every occurrence of a term is the
+same string object, and each term has an integer id (see term_ids), in order
+of first occurrence.
+"""
+import re
+import string
+
+# The tokens of the rank engines: words, keeping hyphens and apostrophes
+# inside them.
+WORD = r"\w+(?:[-']\w+)*"
+# ASCII punctuation that is never part of a WORD token.
+PUNCTUATION = ''.join(c for c in string.punctuation if c not in "-'_")
+
+
+def s_stem(term):
+    """
+    The S stemmer (Harman, 1991): conflate plurals with their singular.
+    >>> [s_stem(t) for t in ['queries', 'does', 'shoes', 'cats', 'corpus', 'glass', 'is']]
+    ['query', 'doe', 'shoe', 'cat', 'corpus', 'glass', 'is']
+    """
+    if len(term) <= 3:
+        return term
+    if term.endswith('ies') and not term.endswith(('eies', 'aies')):
+        return term[:-3] + 'y'
+    if term.endswith('es') and not term.endswith(('aes', 'ees', 'oes')):
+        return term[:-1]
+    if term.endswith('s') and not term.endswith(('us', 'ss')):
+        return term[:-1]
+    return term
+
+
+def do_stem(term):
+    """
+    Collapse 'did' and 'does' into the term 'do'.
+    >>> [do_stem(t) for t in ['did', 'does', "doesn't", 'splendid']]
+    ['do', 'do', "doesn't", 'splendid']
+    """
+    return 'do' if term in ('did', 'does') else term
+
+
+# Stemmers by name, the name being what a saved index records.
+STEMMERS = {'s': s_stem, 'do': do_stem}
+
+
+def read_stopwords(lines):
+    """
+    Return the set of stopwords listed in lines, one per line (e.g.
+    TIME.STP), lowercased; blank lines are skipped.
+    >>> sorted(read_stopwords(['A', '', 'About ']))
+    ['a', 'about']
+    """
+    return frozenset(line.strip().lower() for line in lines if line.strip())
+
+
+class Analyzer(object):
+    """
+    Turn text into terms: the tokens matching pattern, lowercased if
+    lowercase is true, without stopwords, stemmed by the stemmer of that name
+    (see STEMMERS). separators are characters that are never part of a token;
+    any other character may be, and words are checked against pattern, so
+    separators only make analysis faster. The configuration is what is
+    pickled and saved (see config), not the memoised words.
+    >>> analyzer = Analyzer(stopwords=['the'], stemmer='s')
+    >>> analyzer.analyze("The cats' first-class Cats, the_end.")
+    ['cat', 'first-class', 'cat', 'the_end']
+    >>> analyzer.analyze_ids('cats and dogs')
+    [0, 3, 4]
+    >>> analyzer.terms[3], analyzer.term_ids['dog']
+    ('and', 4)
+    """
+
+    def __init__(self, pattern=WORD, separators=PUNCTUATION, lowercase=True, stopwords=(), stemmer=None):
+        self.pattern = pattern
+        self.separators = separators
+        self.lowercase = lowercase
+        self.stopwords = frozenset(stopwords)
+        self.stemmer = stemmer
+        self.stem = STEMMERS[stemmer] if stemmer else None
+        self.findall = re.compile(pattern).findall
+        self.table = str.maketrans(dict.fromkeys(separators, ' '))
+        self.words = {}
+        self.word_ids = {}
+        self.term_ids = {}
+        self.terms = []
+
+    def config(self):
+        """ Return the parameters of the analyzer, as a JSON serializable
+        dict: Analyzer(**config) analyzes text the same way. """
+        return {'pattern': self.pattern, 'separators': self.separators, 'lowercase': self.lowercase,
+                'stopwords': sorted(self.stopwords), 'stemmer': self.stemmer}
+
+    def __reduce__(self):
+        return (Analyzer, (self.pattern, self.separators, self.lowercase, self.stopwords, self.stemmer))
+
+    def __repr__(self):
+        return 'Analyzer(%r, %d stopwords, stemmer=%r)' % (self.pattern, len(self.stopwords), self.stemmer)
+
+    def intern(self, term):
+        """ Return the id of term, giving it the next id if it is new. """
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            term_id = self.term_ids[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def analyze_word(self, word):
+        """ Return the terms of a word (a string without whitespace or
+        separators) as a tuple of interned strings. """
+        terms = []
+        for token in self.findall(word):
+            if self.lowercase:
+                token = token.lower()
+            if token in self.stopwords:
+                continue
+            if self.stem:
+                token = self.stem(token)
+            terms.append(self.terms[self.intern(token)])
+        return tuple(terms)
+
+    def analyze(self, text):
+        """ Return the list of terms of text. """
+        words = self.words
+        terms = []
+        extend = terms.extend
+        for word in text.translate(self.table).split():
+            word_terms = words.get(word)
+            if word_terms is None:
+                word_terms = words[word] = self.analyze_word(word)
+            extend(word_terms)
+        return terms
+
+    def analyze_ids(self, text):
+        """ Return the list of the ids of the terms of text. """
+        word_ids = self.word_ids
+        ids = []
+        extend = ids.extend
+        for word in text.translate(self.table).split():
+            ids_of_word = word_ids.get(word)
+            if ids_of_word is None:
+                word_terms = self.words.get(word)
+                if word_terms is None:
+                    word_terms = self.words[word] = self.analyze_word(word)
+                ids_of_word = word_ids[word] = tuple(self.term_ids[term] for term in word_terms)
+            extend(ids_of_word)
+        return ids
+
+    def analyze_batch(self, texts, ids=False):
+        """ Yield the terms (or their ids, if ids is true) of each text of
+        the iterable texts, one list per text. """
+        analyze = self.analyze_ids if ids else self.analyze
+        for text in texts:
+            yield analyze(text)
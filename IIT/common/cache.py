@@ -0,0 +1,120 @@
+""" A cache of query results with least recently used eviction.
+Results are keyed by the normalized query (see query_key) and by whatever
+else they depend on, e.g. the scorer and its parameters and the number of
+results. Entries expire after a time to live, if one is set, and the least
+recently used entries are evicted once the cache holds more than max_entries
+results or more than max_bytes (estimated). Every entry belongs to a version
+of the index: looking up a newer version empties the cache, so that updates
+to the index never serve stale results.
+"""
+from collections import OrderedDict
+import sys
+import time
+
+
+def query_key(tokens, *parts):
+    """
+    Return a cache key for a query given as tokens, plus any other values
+    the results depend on. Query vectors only depend on the set of query
+    terms, so the order and repetitions of the tokens are ignored.
+    >>> query_key(['b', 'a', 'b'], 'BM25', 10) == query_key(['a', 'b'], 'BM25', 10)
+    True
+    """
+    return (tuple(sorted(set(tokens))),) + parts
+
+
+def sizeof(value):
+    """
+    Return an estimate of the bytes held by a list or tuple of results:
+    the container and each result (but not objects shared with the index,
+    such as small integers).
+    >>> sizeof((1, 2)) > sizeof(())
+    True
+    """
+    return sys.getsizeof(value) + sum(sys.getsizeof(item) for item in value)
+
+
+class ResultCache(object):
+    """
+    A least recently used cache of query results, with hit and miss counts.
+    >>> clock = [0.]
+    >>> cache = ResultCache(max_entries=2, ttl=60, clock=lambda: clock[0])
+    >>> cache.put('a', [1, 2], version=0)
+    >>> cache.put('b', [3], version=0)
+    >>> cache.get('a', version=0)
+    (1, 2)
+    >>> cache.put('c', [4], version=0)
+    >>> cache.get('b', version=0) is None, sorted(cache.entries)
+    (True, ['a', 'c'])
+    >>> clock[0] = 61.
+    >>> cache.get('a', version=0) is None
+    True
+    >>> cache.put('c', [4], version=0)
+    >>> cache.get('c', version=1) is None, len(cache.entries)
+    (True, 0)
+    >>> cache.hits, cache.misses
+    (1, 3)
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024, ttl=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version=None):
+        """ Return the results cached for key as a tuple, or None. Entries
+        cached for another version of the index are dropped first. """
+        self.check_version(version)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= self.clock():
+            self.remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, key, results, version=None):
+        """ Cache results (any sequence) for key, then evict the least
+        recently used entries until the cache is within its limits. """
+        self.check_version(version)
+        if key in self.entries:
+            self.remove(key)
+        results = tuple(results)
+        nbytes = sizeof(results) + sys.getsizeof(key)
+        if nbytes > self.max_bytes:
+            return
+        expires = self.clock() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (expires, nbytes, results)
+        self.nbytes += nbytes
+        while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        """ Drop the entry of key. """
+        self.nbytes -= self.entries.pop(key)[1]
+
+    def check_version(self, version):
+        """ Empty the cache if version is not the version it holds results
+        for. """
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def clear(self):
+        """ Drop every entry; the hit and miss counts are kept. """
+        self.entries.clear()
+        self.nbytes = 0
+
+    def hit_rate(self):
+        """ Return the fraction of lookups answered from the cache. """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
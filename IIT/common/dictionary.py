@@ -0,0 +1,341 @@
+""" Compact sorted term dictionaries, with prefix and wildcard lookup.
+A FrontCodedDictionary keeps its terms sorted by their UTF-8 encoding, in
+blocks of BLOCK_SIZE terms. The first term of a block is stored in full, and
+every other term as the length of the prefix it shares with the previous
+term followed by the rest of its bytes, so a vocabulary takes a few bytes
+per term instead of a string object and a dict entry. A term is found by a
+binary search over the first terms of the blocks, then a scan of one block.
+
+The position of a term in sorted order is its term id. Engines keep the
+per-term values (document frequencies, postings, ...) in lists or arrays
+indexed by term id, and the dictionary maps terms to them.
+
+Since terms are sorted, the terms starting with a prefix have consecutive
+ids (see prefix_range). Other wildcard patterns are expanded with a
+KGramIndex, which also finds the terms close to a misspelled one (see
+fuzzy_matches). These functions work with any sorted table of terms that has
+the lower_bound, term and __len__ methods of FrontCodedDictionary, such as
+postings.TermTable.
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Mapping
+import os
+import re
+import time
+
+import postings
+
+BLOCK_SIZE = 16
+KGRAM_SIZE = 3
+
+
+class FrontCodedDictionary(Mapping):
+    """
+    A read-only mapping from terms to value(term id), where term ids are
+    positions in the sorted vocabulary. Without a value function, terms map
+    to their term ids.
+    >>> terms = FrontCodedDictionary(['cat', 'car', 'cart', 'dog'])
+    >>> terms['cart'], terms.term(0), 'cow' in terms, list(terms)
+    (1, 'car', False, ['car', 'cart', 'cat', 'dog'])
+    >>> doc_freqs = terms.with_value([3, 1, 5, 2].__getitem__)
+    >>> doc_freqs['cat'], dict(doc_freqs) == {'car': 3, 'cart': 1, 'cat': 5, 'dog': 2}
+    (5, True)
+    """
+
+    def __init__(self, terms, value=None):
+        encoded = sorted(set(term.encode('utf-8') for term in terms))
+        blob = bytearray()
+        self.block_offsets = array('q')
+        self.length = len(encoded)
+        previous = b''
+        for i, term in enumerate(encoded):
+            if i % BLOCK_SIZE == 0:
+                self.block_offsets.append(len(blob))
+                shared = 0
+            else:
+                shared = len(os.path.commonprefix([previous, term]))
+            postings.encode_vbyte([shared, len(term) - shared], blob)
+            blob.extend(term[shared:])
+            previous = term
+        self.blob = bytes(blob)
+        self.value = value if value is not None else int
+        self.cache = None
+
+    def with_value(self, value):
+        """ Return a dictionary over the same terms, sharing their storage,
+        that maps each term to value(term id). """
+        dictionary = FrontCodedDictionary([])
+        dictionary.__dict__.update(self.__dict__)
+        dictionary.value = value
+        return dictionary
+
+    @property
+    def nbytes(self):
+        return len(self.blob) + len(self.block_offsets) * self.block_offsets.itemsize
+
+    def block_head(self, block):
+        """ Return the encoded first term of a block, without decoding the
+        rest of the block. """
+        offset = self.block_offsets[block] + 1  # Skip the shared length, 0.
+        if self.blob[offset] >= 128:
+            return self.blob[offset + 1:offset + self.blob[offset] - 127]
+        (length,), offset = postings.decode_vbyte(self.blob, offset, 1)
+        return self.blob[offset:offset + length]
+
+    def decode_block(self, block):
+        """ Return the list of encoded terms of a block. The last decoded
+        block is cached. """
+        if self.cache is not None and self.cache[0] == block:
+            return self.cache[1]
+        end = self.block_offsets[block + 1] if block + 1 < len(self.block_offsets) else len(self.blob)
+        offset = self.block_offsets[block]
+        terms = []
+        previous = b''
+        blob = self.blob
+        while offset < end:
+            if blob[offset] >= 128 and blob[offset + 1] >= 128:
+                shared, length = blob[offset] - 128, blob[offset + 1] - 128
+                offset += 2
+            else:
+                (shared, length), offset = postings.decode_vbyte(blob, offset, 2)
+            previous = previous[:shared] + blob[offset:offset + length]
+            offset += length
+            terms.append(previous)
+        self.cache = (block, terms)
+        return terms
+
+    def lower_bound(self, key):
+        """ Return the id of the first term whose UTF-8 encoding is not less
+        than the bytes key (len(self) if there is none). """
+        low, high = 0, len(self.block_offsets)
+        while low < high:
+            mid = (low + high) // 2
+            if self.block_head(mid) <= key:
+                low = mid + 1
+            else:
+                high = mid
+        if low == 0:
+            return 0
+        return (low - 1) * BLOCK_SIZE + bisect_left(self.decode_block(low - 1), key)
+
+    def term(self, term_id):
+        return self.decode_block(term_id // BLOCK_SIZE)[term_id % BLOCK_SIZE].decode('utf-8')
+
+    def term_id(self, term):
+        """ Return the position of term in sorted order, or None. """
+        key = term.encode('utf-8')
+        term_id = self.lower_bound(key)
+        if term_id < len(self) and self.decode_block(term_id // BLOCK_SIZE)[term_id % BLOCK_SIZE] == key:
+            return term_id
+        return None
+
+    def __getitem__(self, term):
+        term_id = self.term_id(term)
+        if term_id is None:
+            raise KeyError(term)
+        return self.value(term_id)
+
+    def __contains__(self, term):
+        return self.term_id(term) is not None
+
+    def __iter__(self):
+        for block in range(len(self.block_offsets)):
+            for term in self.decode_block(block):
+                yield term.decode('utf-8')
+
+    def __len__(self):
+        return self.length
+
+
+def compact(mapping, terms=None, typecode=None):
+    """
+    Return a FrontCodedDictionary with the keys and values of a dict. The
+    values are kept in a list, or in an array of the given type code. Pass
+    the terms of a previous call to share them between mappings with the
+    same keys.
+    >>> doc_freqs = compact({'b': 2, 'a': 7}, typecode='q')
+    >>> doc_freqs['a'], doc_freqs.value.__self__
+    (7, array('q', [7, 2]))
+    """
+    if terms is None:
+        terms = FrontCodedDictionary(mapping)
+    values = [mapping[term] for term in terms]
+    if typecode is not None:
+        values = array(typecode, values)
+    return terms.with_value(values.__getitem__)
+
+
+def prefix_range(table, prefix):
+    """
+    Return the range of ids of the terms of a sorted table that start with
+    prefix.
+    >>> terms = FrontCodedDictionary(['cat', 'car', 'cart', 'dog'])
+    >>> [terms.term(i) for i in prefix_range(terms, 'car')]
+    ['car', 'cart']
+    """
+    key = prefix.encode('utf-8')
+    # 0xff never occurs in UTF-8, so it sorts after every continuation.
+    return range(table.lower_bound(key), table.lower_bound(key + b'\xff'))
+
+
+def kgrams(term, k=KGRAM_SIZE):
+    """
+    Return the k-grams of a term, marked with $ at both ends.
+    >>> kgrams('cat')
+    ['$ca', 'cat', 'at$']
+    """
+    marked = '$' + term + '$'
+    return [marked[i:i + k] for i in range(len(marked) - k + 1)]
+
+
+class KGramIndex(object):
+    """
+    An index from the k-grams of the terms of a sorted table to the ids of
+    the terms that contain them, with the length of every term.
+    >>> terms = FrontCodedDictionary(['cat', 'car', 'cart', 'dog'])
+    >>> [terms.term(i) for i in KGramIndex(terms).lookup(['car', 'rt$'])]
+    ['cart']
+    """
+
+    def __init__(self, table, k=KGRAM_SIZE):
+        self.k = k
+        self.index = {}
+        self.lengths = array('i')
+        for term_id, term in enumerate(table):
+            self.lengths.append(len(term))
+            for gram in set(kgrams(term, k)):
+                if gram not in self.index:
+                    self.index[gram] = array('i')
+                self.index[gram].append(term_id)
+
+    def lookup(self, grams):
+        """ Return the sorted ids of the terms containing every k-gram in
+        grams. """
+        candidates = None
+        for gram in sorted(grams, key=lambda g: len(self.index.get(g, ()))):
+            term_ids = self.index.get(gram, ())
+            candidates = set(term_ids) if candidates is None else candidates.intersection(term_ids)
+            if not candidates:
+                break
+        return sorted(candidates or [])
+
+
+def expand_wildcard(table, pattern, kgram_index=None):
+    """
+    Return the terms of a sorted table matching pattern, where * stands for
+    any sequence of characters. The terms are narrowed down to the range of
+    the prefix before the first *, and to the terms containing the k-grams
+    of the other parts of the pattern if kgram_index is given (otherwise
+    that range is scanned), then checked against the whole pattern.
+    >>> terms = FrontCodedDictionary(['cat', 'car', 'cart', 'dog', 'scar'])
+    >>> expand_wildcard(terms, 'ca*'), expand_wildcard(terms, '*ar*', KGramIndex(terms))
+    (['car', 'cart', 'cat'], ['car', 'cart', 'scar'])
+    >>> expand_wildcard(terms, 'c*t', KGramIndex(terms)), expand_wildcard(terms, 'cow')
+    (['cart', 'cat'], [])
+    """
+    if '*' not in pattern:
+        return [pattern] if pattern in table else []
+    parts = pattern.split('*')
+    candidates = prefix_range(table, parts[0])
+    if kgram_index is not None:
+        k = kgram_index.k
+        grams = [part[i:i + k] for part in ('$' + pattern + '$').split('*')
+                 for i in range(len(part) - k + 1)]
+        if grams:
+            candidates = [term_id for term_id in kgram_index.lookup(grams)
+                          if candidates.start <= term_id < candidates.stop]
+    regex = re.compile('.*'.join(re.escape(part) for part in parts), re.DOTALL)
+    return [term for term in (table.term(term_id) for term_id in candidates) if regex.fullmatch(term)]
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Return the Levenshtein distance between two strings if it is at most
+    max_distance, and max_distance + 1 otherwise. Only the cells within
+    max_distance of the diagonal are computed, and the computation stops as
+    soon as a whole row exceeds max_distance.
+    >>> edit_distance('kitten', 'sitting', 3), edit_distance('kitten', 'sitting', 2)
+    (3, 3)
+    >>> edit_distance('nuclear', 'nucelar', 2), edit_distance('a', 'abcd', 1)
+    (2, 2)
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    if len(a) > len(b):
+        a, b = b, a
+    beyond = max_distance + 1
+    previous = [j if j <= max_distance else beyond for j in range(len(b) + 1)]
+    for i, char in enumerate(a, 1):
+        current = [beyond] * (len(b) + 1)
+        if i <= max_distance:
+            current[0] = i
+        low = max(1, i - max_distance)
+        high = min(len(b), i + max_distance)
+        for j in range(low, high + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != b[j - 1]))
+        if min(current[low - 1:high + 1]) > max_distance:
+            return beyond
+        previous = current
+    return min(previous[len(b)], beyond)
+
+
+def fuzzy_matches(table, kgram_index, term, max_distance=2, budget=None):
+    """
+    Return the terms of a sorted table closest to term, if any are within
+    max_distance edits, as a list of (distance, term) pairs. Candidates are
+    the terms sharing k-grams with term, checked with edit_distance in
+    decreasing order of shared k-grams. An edit changes at most k k-grams,
+    so a candidate sharing c of the n k-grams of term is at least
+    (n - c) / k edits away: the search stops once that bound exceeds the
+    best distance found, and candidates whose length differs too much are
+    skipped. If budget (in seconds) runs out the closest terms found so far
+    are returned. Terms sharing no k-gram with term are never found.
+    >>> terms = FrontCodedDictionary(['nuclear', 'unclear', 'nucleus', 'clear', 'test'])
+    >>> fuzzy_matches(terms, KGramIndex(terms), 'nucelar')
+    [(2, 'nuclear')]
+    >>> fuzzy_matches(terms, KGramIndex(terms), 'nucleaz')
+    [(1, 'nuclear')]
+    """
+    start = time.perf_counter()
+    grams = set(kgrams(term, kgram_index.k))
+    shared = Counter()
+    for gram in grams:
+        shared.update(kgram_index.index.get(gram, ()))
+    by_count = [[] for _ in range(len(grams) + 1)]
+    min_count = len(grams) - kgram_index.k * max_distance
+    for term_id, count in shared.items():
+        if count >= min_count:
+            by_count[count].append(term_id)
+    best = max_distance
+    matches = []
+    checked = 0
+    for count in range(len(grams), 0, -1):
+        if len(grams) - count > kgram_index.k * best:
+            break
+        if budget is not None and checked and time.perf_counter() - start > budget:
+            break
+        for term_id in by_count[count]:
+            if abs(kgram_index.lengths[term_id] - len(term)) > best:
+                continue
+            checked += 1
+            candidate = table.term(term_id)
+            distance = edit_distance(term, candidate, best)
+            if distance <= best:
+                best = distance
+                matches.append((distance, candidate))
+    return sorted(match for match in matches if match[0] == best)
+
+
+def split_wildcards(query):
+    """
+    Separate the words of a query containing * from the rest of the query.
+    Returns:
+      A tuple (query without those words, list of lowercase patterns).
+    >>> split_wildcards('Pres* of the *states')
+    ('of the', ['pres*', '*states'])
+    """
+    words = query.split()
+    patterns = [word.lower() for word in words if '*' in word]
+    return ' '.join(word for word in words if '*' not in word), patterns
@@ -0,0 +1,1002 @@
+""" Compact postings lists.
+A postings list built as a Python list of [doc_id, weight] pairs costs over
+100 bytes per entry. Once an index is built, its lists can be frozen into
+Postings objects, which keep the document ids and weights in two parallel
+typed arrays (4 bytes per document id, 4 or 8 bytes per weight) while still
+behaving like a read-only sequence of (doc_id, weight) pairs, so code written
+against the list form runs unchanged. Any of these lists can be traversed
+document at a time with a Cursor, and the ranked searches of the engines
+merge their cursors with daat and maxscore, keeping the best documents in a
+TopK.
+
+Lists can also be compressed into CompressedPostings, which store the gaps
+between document ids with variable-byte codes in blocks of BLOCK_SIZE
+postings, with the last document id of every block kept aside so that a
+cursor can skip whole blocks without decoding them.
+
+Term positions are kept apart from the postings, in PositionalPostings,
+whose positions are variable-byte coded gaps decoded one document at a time,
+only by the queries that need them: phrases (see phrase_starts) and
+proximity (see min_span).
+
+Indexes built by a pool of processes are split into partitions of their
+terms (see term_partition), each merged by one worker (see merge_counts).
+
+Frozen indexes can also be saved as a binary segment (see write_segment)
+and memory-mapped back (see read_segment), so a process can start searching
+without re-reading the corpus, and several processes can share the pages
+of the same segment.
+"""
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+import heapq
+from itertools import accumulate
+import json
+import math
+import mmap
+import os
+import shutil
+import struct
+import zlib
+
+SEGMENT_MAGIC = b'IRSEG001'
+
+# Version of the segment layout, stored in the header of every segment.
+# Bump it whenever write_segment, or the sections an engine saves, change,
+# so that segments written before are rebuilt (see segment_is_current).
+SEGMENT_VERSION = 2
+
+# Number of postings per block of a CompressedPostings, and number of levels
+# of its quantized weights.
+BLOCK_SIZE = 128
+WEIGHT_LEVELS = 255
+
+
+class Postings(object):
+    """
+    An immutable postings list stored as parallel arrays.
+    weight_type is an array type code: 'f' (4 bytes) is exact for term
+    frequencies, 'd' (8 bytes) keeps tf-idf weights at full precision.
+    >>> p = Postings([[1, 2.0], [4, 1.0], [9, 3.0]], 'f')
+    >>> len(p), p[1], p[-1][0]
+    (3, (4, 1.0), 9)
+    >>> [doc_id for doc_id, tf in p]
+    [1, 4, 9]
+    >>> p
+    Postings([(1, 2.0), (4, 1.0), (9, 3.0)])
+    """
+    __slots__ = ('doc_ids', 'weights')
+
+    def __init__(self, pairs, weight_type='d'):
+        self.doc_ids = array('i', [pair[0] for pair in pairs])
+        self.weights = array(weight_type, [pair[1] for pair in pairs])
+
+    @classmethod
+    def from_arrays(cls, doc_ids, weights):
+        """ Wrap existing parallel sequences (e.g. arrays or memoryview
+        slices of a segment) without copying them. """
+        postings = cls.__new__(cls)
+        postings.doc_ids = doc_ids
+        postings.weights = weights
+        return postings
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __getitem__(self, i):
+        return self.doc_ids[i], self.weights[i]
+
+    def __iter__(self):
+        return zip(self.doc_ids, self.weights)
+
+    def __repr__(self):
+        return 'Postings(%r)' % list(self)
+
+
+def freeze_index(index, weight_type='d'):
+    """
+    Convert every postings list of an index (a dict from term to a list of
+    [doc_id, weight] pairs) into a Postings object.
+    >>> frozen = freeze_index({'a': [[0, .5], [10, .25]], 'b': [[5, .1]]})
+    >>> frozen['a'][1]
+    (10, 0.25)
+    """
+    return dict((term, Postings(pairs, weight_type)) for term, pairs in index.items())
+
+
+def term_partition(term, n):
+    """
+    Return the partition of term among n, computed from a CRC of its UTF-8
+    bytes, which, unlike hash(), is the same in every process.
+    >>> term_partition('nuclear', 4) == term_partition('nuclear', 4), term_partition('a', 1)
+    (True, 0)
+    """
+    return zlib.crc32(term.encode('utf-8')) % n
+
+
+def split_by_term(counts, n):
+    """
+    Split a tuple of dicts with the same terms as keys, such as the document
+    frequencies and postings of count_terms, into n such tuples, one per
+    term partition (see term_partition).
+    >>> split_by_term(({'a': 1, 'd': 2}, {'a': [[0, 1.]], 'd': [[0, 2.]]}), 2)
+    [({'d': 2}, {'d': [[0, 2.0]]}), ({'a': 1}, {'a': [[0, 1.0]]})]
+    """
+    parts = [tuple({} for _ in counts) for _ in range(n)]
+    for term in counts[0]:
+        for part, mapping in zip(parts[term_partition(term, n)], counts):
+            part[term] = mapping[term]
+    return parts
+
+
+def merge_counts(pieces):
+    """
+    Merge (doc_freqs, index) pairs counted over consecutive ranges of
+    documents, in document order: document frequencies are added up and
+    postings lists concatenated, so they stay sorted by document id.
+    >>> merge_counts([({'a': 1}, {'a': [[0, 1.]]}), ({'a': 1, 'b': 1}, {'a': [[3, 2.]], 'b': [[4, 1.]]})])
+    ({'a': 2, 'b': 1}, {'a': [[0, 1.0], [3, 2.0]], 'b': [[4, 1.0]]})
+    """
+    doc_freqs = {}
+    index = {}
+    for piece_freqs, piece_index in pieces:
+        for term, df in piece_freqs.items():
+            doc_freqs[term] = doc_freqs.get(term, 0) + df
+        for term, pairs in piece_index.items():
+            if term in index:
+                index[term].extend(pairs)
+            else:
+                index[term] = pairs
+    return doc_freqs, index
+
+
+def columns(pairs):
+    """
+    Return the document ids and the weights of a postings list as two
+    sequences. The arrays of a Postings object are returned without copying.
+    >>> columns([[1, 2.0], [4, 1.0]])
+    ([1, 4], [2.0, 1.0])
+    """
+    if isinstance(pairs, Postings):
+        return pairs.doc_ids, pairs.weights
+    if isinstance(pairs, CompressedPostings):
+        doc_ids, weights = array('i'), array('d')
+        for block in range(len(pairs.block_last)):
+            block_doc_ids, block_weights = pairs.decode_block(block)
+            doc_ids.extend(block_doc_ids)
+            weights.extend(block_weights)
+        return doc_ids, weights
+    return [pair[0] for pair in pairs], [pair[1] for pair in pairs]
+
+
+class Cursor(object):
+    """
+    A forward cursor over a postings list of (doc_id, weight) pairs, for
+    document-at-a-time traversal. doc_id is the document id of the current
+    posting, or None once the list is exhausted. next moves to the following
+    posting; advance moves to the first posting at or after a document id by
+    binary search, so the postings it skips are never visited. Over a
+    CompressedPostings, the cursor reads the block decoded by a BlockCursor,
+    and moves to another block with it, so the blocks it skips are never
+    decoded.
+    >>> cursor = Cursor(Postings([[1, 2.0], [4, 1.0], [9, 3.0]]))
+    >>> cursor.doc_id, cursor.weight(), cursor.next(), cursor.advance(5), cursor.weight()
+    (1, 2.0, 4, 9, 3.0)
+    >>> cursor.advance(9), cursor.next(), cursor.doc_id
+    (9, None, None)
+    >>> cursor = Cursor(CompressedPostings(list(range(0, 1000, 3)), list(range(334))))
+    >>> cursor.doc_id, cursor.next(), cursor.advance(500), cursor.weight(), cursor.next(), cursor.advance(1000)
+    (0, 3, 501, 167.0, 504, None)
+    """
+    __slots__ = ('doc_ids', 'weights', 'position', 'doc_id', 'blocks')
+
+    def __init__(self, pairs):
+        if isinstance(pairs, CompressedPostings):
+            self.blocks = pairs.cursor()
+            self.blocks.advance(0)
+            self.sync()
+            return
+        self.blocks = None
+        self.doc_ids, self.weights = columns(pairs)
+        self.position = 0
+        self.doc_id = self.doc_ids[0] if len(self.doc_ids) else None
+
+    def sync(self):
+        """ Take the decoded block and the position of the BlockCursor. """
+        self.doc_ids, self.weights, self.position = self.blocks.doc_ids, self.blocks.weights, self.blocks.position
+        self.doc_id = self.doc_ids[self.position] if self.doc_ids else None
+
+    def next(self):
+        """ Move to the next posting and return its document id, or None if
+        there is none. """
+        self.position += 1
+        if self.position < len(self.doc_ids):
+            self.doc_id = self.doc_ids[self.position]
+        elif self.blocks is None or self.doc_id is None:
+            self.doc_id = None
+        else:
+            self.blocks.advance(self.doc_id + 1)
+            self.sync()
+        return self.doc_id
+
+    def advance(self, doc_id):
+        """ Move to the first posting whose document id is at least doc_id
+        and return that document id, or None if there is none. The cursor
+        never moves backwards. """
+        if self.doc_id is not None and self.doc_id < doc_id:
+            if self.blocks is not None and self.doc_ids[-1] < doc_id:
+                self.blocks.advance(doc_id)
+                self.sync()
+            else:
+                self.position = bisect_left(self.doc_ids, doc_id, self.position + 1)
+                self.doc_id = self.doc_ids[self.position] if self.position < len(self.doc_ids) else None
+        return self.doc_id
+
+    def weight(self):
+        return self.weights[self.position]
+
+
+class TopK(object):
+    """
+    The k best of the (doc_id, score) pairs pushed into it, or all of them
+    if k is None, in the order of every ranked search: descending score
+    rounded to 6 decimal places, then ascending doc_id. They are kept in a
+    heap of (rounded score, -doc_id, score) entries, whose smallest is the
+    next to go; once k pairs are kept, threshold is its rounded score, the
+    one a document must beat to enter.
+    >>> best = TopK(2)
+    >>> for doc_id, score in [(1, .5), (2, .9), (3, .5000001), (4, .1)]:
+    ...     best.push(doc_id, score)
+    >>> best.threshold, best.results()
+    (0.5, [(2, 0.9), (1, 0.5)])
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        self.threshold = None
+
+    def push(self, doc_id, score):
+        entry = (round(score, 6), -doc_id, score)
+        if self.k is None or len(self.heap) < self.k:
+            heapq.heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+        if len(self.heap) == self.k:
+            self.threshold = self.heap[0][0]
+
+    def results(self):
+        """ Return the kept (doc_id, score) pairs, best first. """
+        return [(-neg_doc_id, score) for _, neg_doc_id, score in sorted(self.heap, reverse=True)]
+
+
+def unchanged(doc_id, score):
+    """ The default finish of daat and maxscore. """
+    return score
+
+
+def daat(cursors, scorers, k=None, finish=unchanged):
+    """
+    Return the k best (doc_id, score) pairs of a query, or all of them if k
+    is None, in the order of TopK (none if k is 0 or less). The query has a Cursor and a scorer per
+    term; the score of a document is finish(doc_id, total), where total is
+    the sum of scorer(doc_id, weight) over the cursors with a posting of
+    the document. The cursors are merged by doc_id through a heap, so each
+    document is scored completely when it is reached, and memory grows only
+    with k and the number of cursors. Every posting is visited.
+    >>> cursors = [Cursor([[1, 1.], [3, 2.]]), Cursor([[2, 1.], [3, 1.]])]
+    >>> daat(cursors, [lambda doc_id, weight: weight, lambda doc_id, weight: 2 * weight])
+    [(3, 4.0), (2, 2.0), (1, 1.0)]
+    >>> daat(cursors, [], 0)
+    []
+    """
+    if k is not None and k <= 0:
+        return []
+    frontier = [(cursor.doc_id, i) for i, cursor in enumerate(cursors) if cursor.doc_id is not None]
+    heapq.heapify(frontier)
+    best = TopK(k)
+    while frontier:
+        doc_id = frontier[0][0]
+        score = 0.
+        while frontier and frontier[0][0] == doc_id:
+            i = frontier[0][1]
+            score += scorers[i](doc_id, cursors[i].weight())
+            if cursors[i].next() is None:
+                heapq.heappop(frontier)
+            else:
+                heapq.heapreplace(frontier, (cursors[i].doc_id, i))
+        best.push(doc_id, finish(doc_id, score))
+    return best.results()
+
+
+def maxscore(cursors, scorers, bounds, k, finish=unchanged):
+    """
+    Return the k best (doc_id, score) pairs of a query scored as in daat,
+    skipping the documents that cannot make the top k with the MaxScore
+    strategy. bounds[i] is the largest amount the postings of cursors[i]
+    can add to any score, and the cursors are given by increasing bound.
+    Once k documents have been found, the terms whose combined bounds
+    cannot beat the k-th best score are non-essential: documents are only
+    generated from the essential terms, and the non-essential postings are
+    merely probed, and only while the document can still enter the top k.
+    >>> cursors = [Cursor([[1, 1.], [3, 2.]]), Cursor([[2, 3.], [3, 3.]])]
+    >>> maxscore(cursors, 2 * [lambda doc_id, weight: weight], [2., 3.], 1)
+    [(3, 5.0)]
+    >>> maxscore(cursors, [], [], 0)
+    []
+    """
+    if k <= 0:
+        return []
+    bounds = list(accumulate(bounds))
+    best = TopK(k)
+    essential = 0
+    while True:
+        if best.threshold is not None:
+            while essential < len(cursors) and round(bounds[essential], 6) <= best.threshold:
+                essential += 1
+        candidates = [cursor.doc_id for cursor in cursors[essential:] if cursor.doc_id is not None]
+        if not candidates:
+            break
+        doc_id = min(candidates)
+        score = 0.
+        for i in range(essential, len(cursors)):
+            if cursors[i].doc_id == doc_id:
+                score += scorers[i](doc_id, cursors[i].weight())
+                cursors[i].next()
+        for i in range(essential - 1, -1, -1):
+            if round(finish(doc_id, score) + bounds[i], 6) <= best.threshold:
+                break
+            if cursors[i].advance(doc_id) == doc_id:
+                score += scorers[i](doc_id, cursors[i].weight())
+        best.push(doc_id, finish(doc_id, score))
+    return best.results()
+
+
+def encode_vbyte(numbers, out):
+    """
+    Append the variable-byte codes of non-negative integers to the bytearray
+    out: 7 bits per byte, low bits first, with the high bit set on the last
+    byte of each number.
+    >>> out = bytearray()
+    >>> encode_vbyte([5, 130], out)
+    >>> list(out)
+    [133, 2, 129]
+    """
+    for n in numbers:
+        while n >= 128:
+            out.append(n & 127)
+            n >>= 7
+        out.append(n | 128)
+
+
+def decode_vbyte(data, offset, count):
+    """
+    Decode count numbers written by encode_vbyte, starting at offset.
+    Returns:
+      A tuple (numbers, offset just after the last one).
+    >>> decode_vbyte(bytes([133, 2, 129]), 0, 2)
+    ([5, 130], 3)
+    """
+    chunk = data[offset:offset + count]
+    if len(chunk) == count and min(chunk, default=128) >= 128:
+        # Every number fits in one byte, as most gaps and frequencies do.
+        return [byte - 128 for byte in chunk], offset + count
+    numbers = []
+    n = shift = 0
+    while count:
+        byte = data[offset]
+        offset += 1
+        if byte < 128:
+            n |= byte << shift
+            shift += 7
+        else:
+            numbers.append(n | (byte - 128) << shift)
+            n = shift = 0
+            count -= 1
+    return numbers, offset
+
+
+class CompressedPostings(object):
+    """
+    An immutable, compressed postings list: a sequence of document ids, or
+    of (doc_id, weight) pairs when weights are given. Document ids are
+    stored as variable-byte gaps, in blocks of BLOCK_SIZE postings that are
+    decoded one at a time (see cursor). Weights are stored as variable-byte
+    integers, which is exact for term frequencies, or, if quantize is true,
+    as one byte each: the fraction of the largest weight of the list, in
+    WEIGHT_LEVELS steps. Quantized weights are off by at most half a step,
+    and the largest weight is exact.
+    >>> p = CompressedPostings([1, 4, 900], [2., 1., 3.])
+    >>> len(p), p[1], p[-1], list(p)
+    (3, (4, 1.0), (900, 3.0), [(1, 2.0), (4, 1.0), (900, 3.0)])
+    >>> list(CompressedPostings([0, 5]))
+    [0, 5]
+    >>> CompressedPostings([1, 2], [0.2, 0.1], quantize=True)
+    CompressedPostings([(1, 0.2), (2, 0.10039215686274511)])
+    """
+    __slots__ = ('length', 'data', 'block_offsets', 'block_last', 'weight_mode', 'scale', 'cache')
+
+    def __init__(self, doc_ids, weights=None, quantize=False):
+        self.length = len(doc_ids)
+        self.data = bytearray()
+        self.block_offsets = array('q')
+        self.block_last = array('i')
+        self.weight_mode = None if weights is None else 'quantized' if quantize else 'int'
+        self.scale = 1.
+        if self.weight_mode == 'quantized' and len(weights) and max(weights) > 0:
+            self.scale = max(weights) / WEIGHT_LEVELS
+        previous = -1
+        for start in range(0, self.length, BLOCK_SIZE):
+            block = doc_ids[start:start + BLOCK_SIZE]
+            self.block_offsets.append(len(self.data))
+            self.block_last.append(block[-1])
+            encode_vbyte([doc_id - prev for doc_id, prev in zip(block, [previous] + list(block[:-1]))], self.data)
+            previous = block[-1]
+            if self.weight_mode == 'int':
+                block_weights = [int(w) for w in weights[start:start + BLOCK_SIZE]]
+                if block_weights != list(weights[start:start + BLOCK_SIZE]):
+                    raise ValueError('weights must be integers unless quantize is true')
+                encode_vbyte(block_weights, self.data)
+            elif self.weight_mode == 'quantized':
+                self.data.extend(max(1, int(round(w / self.scale))) if w > 0 else 0
+                                 for w in weights[start:start + BLOCK_SIZE])
+        self.data = bytes(self.data)
+        self.cache = None
+
+    def decode_block(self, block):
+        """ Return the document ids and the weights (None without weights)
+        of a block. The last decoded block is cached. """
+        if self.cache is not None and self.cache[0] == block:
+            return self.cache[1], self.cache[2]
+        count = min(BLOCK_SIZE, self.length - block * BLOCK_SIZE)
+        gaps, offset = decode_vbyte(self.data, self.block_offsets[block], count)
+        doc_ids = list(accumulate(gaps, initial=self.block_last[block - 1] if block else -1))[1:]
+        weights = None
+        if self.weight_mode == 'int':
+            weights = [float(w) for w in decode_vbyte(self.data, offset, count)[0]]
+        elif self.weight_mode == 'quantized':
+            weights = [q * self.scale for q in self.data[offset:offset + count]]
+        self.cache = (block, doc_ids, weights)
+        return doc_ids, weights
+
+    def cursor(self):
+        return BlockCursor(self)
+
+    @property
+    def nbytes(self):
+        """ The size of the encoded postings and of the block skip entries. """
+        return len(self.data) + len(self.block_offsets) * 8 + len(self.block_last) * 4
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('postings index out of range')
+        doc_ids, weights = self.decode_block(i // BLOCK_SIZE)
+        if weights is None:
+            return doc_ids[i % BLOCK_SIZE]
+        return doc_ids[i % BLOCK_SIZE], weights[i % BLOCK_SIZE]
+
+    def __iter__(self):
+        for block in range(len(self.block_last)):
+            doc_ids, weights = self.decode_block(block)
+            if weights is None:
+                yield from doc_ids
+            else:
+                yield from zip(doc_ids, weights)
+
+    def __repr__(self):
+        return 'CompressedPostings(%r)' % list(self)
+
+
+class BlockCursor(object):
+    """
+    A forward cursor over a CompressedPostings. advance finds the first
+    block that can hold the target from the block skip entries, so the
+    blocks it jumps over are never decoded.
+    >>> cursor = CompressedPostings(list(range(0, 1000, 3)), list(range(334))).cursor()
+    >>> cursor.advance(500), cursor.weight(), cursor.advance(998), cursor.advance(1000)
+    (501, 167.0, 999, None)
+    >>> cursor.advance(1000), cursor.advance(2000)
+    (None, None)
+    """
+
+    def __init__(self, postings):
+        self.postings = postings
+        self.block = -1
+        self.doc_ids = []
+        self.weights = None
+        self.position = 0
+
+    def advance(self, doc_id):
+        """ Move to the first document id at or after doc_id and return it,
+        or None if there is none. """
+        if self.block >= len(self.postings.block_last):
+            return None
+        if not self.doc_ids or self.doc_ids[-1] < doc_id:
+            block = bisect_left(self.postings.block_last, doc_id, self.block + 1)
+            if block == len(self.postings.block_last):
+                self.doc_ids = []
+                self.block = block
+                return None
+            self.block = block
+            self.doc_ids, self.weights = self.postings.decode_block(block)
+            self.position = 0
+        self.position = bisect_left(self.doc_ids, doc_id, self.position)
+        return self.doc_ids[self.position]
+
+    def weight(self):
+        return self.weights[self.position]
+
+
+def compress_index(index, quantize=False):
+    """
+    Convert every postings list of an index (a dict from term to [doc_id,
+    weight] pairs) into a CompressedPostings. Weights must be integers
+    (term frequencies) unless quantize is true.
+    >>> compressed = compress_index({'a': [[0, 2.], [10, 1.]], 'b': [[5, 1.]]})
+    >>> compressed['a'][1]
+    (10, 1.0)
+    """
+    return dict((term, CompressedPostings(*columns(pairs), quantize=quantize))
+                for term, pairs in index.items())
+
+
+class PositionalPostings(object):
+    """
+    The positions of a term in each document of its postings list, in
+    increasing document id order. The positions of each document are stored
+    as variable-byte coded gaps, and only decoded when positions is called.
+    >>> p = PositionalPostings([3, 7], [[0, 4, 130], [2]])
+    >>> len(p), p.positions(3), p.positions(7), p.positions(5)
+    (2, [0, 4, 130], [2], [])
+    >>> list(p)
+    [(3, [0, 4, 130]), (7, [2])]
+    """
+    __slots__ = ('doc_ids', 'counts', 'offsets', 'data')
+
+    def __init__(self, doc_ids, position_lists):
+        self.doc_ids = array('i', doc_ids)
+        self.counts = array('i', [len(positions) for positions in position_lists])
+        self.offsets = array('q')
+        data = bytearray()
+        for positions in position_lists:
+            self.offsets.append(len(data))
+            encode_vbyte([position - previous for position, previous in zip(positions, [0] + list(positions[:-1]))],
+                         data)
+        self.data = bytes(data)
+
+    @classmethod
+    def from_arrays(cls, doc_ids, counts, offsets, data):
+        """ Wrap existing sequences (e.g. memoryview slices of a segment)
+        without copying them; offsets index into data. """
+        postings = cls.__new__(cls)
+        postings.doc_ids = doc_ids
+        postings.counts = counts
+        postings.offsets = offsets
+        postings.data = data
+        return postings
+
+    def positions(self, doc_id):
+        """ Return the sorted positions of the term in doc_id, or an empty
+        list if the document does not contain it. """
+        i = bisect_left(self.doc_ids, doc_id)
+        if i == len(self.doc_ids) or self.doc_ids[i] != doc_id:
+            return []
+        return list(accumulate(decode_vbyte(self.data, self.offsets[i], self.counts[i])[0]))
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        for doc_id in self.doc_ids:
+            yield doc_id, self.positions(doc_id)
+
+
+def positional_index(docs, first_doc_id=0):
+    """
+    Return a dict from each term of docs, given as lists of tokens, to its
+    PositionalPostings. Documents are numbered from first_doc_id.
+    >>> positions = positional_index([['a', 'b', 'a'], ['b']], 1)
+    >>> list(positions['a']), list(positions['b'])
+    ([(1, [0, 2])], [(1, [1]), (2, [0])])
+    """
+    collector = PositionCollector(first_doc_id)
+    for tokens in docs:
+        collector.add(tokens)
+    return collector.index()
+
+
+class PositionCollector(object):
+    """
+    Collect the positions of documents added one at a time, numbered from
+    first_doc_id, so that they can be gathered while the documents stream
+    through another indexer (see tap).
+    >>> collector = PositionCollector(1)
+    >>> list(collector.tap(['a b', 'b'], str.split))
+    ['a b', 'b']
+    >>> list(collector.index()['b'])
+    [(1, [1]), (2, [0])]
+    """
+
+    def __init__(self, first_doc_id=0):
+        self.doc_id = first_doc_id
+        self.doc_ids = {}
+        self.position_lists = {}
+
+    def add(self, tokens):
+        """ Add the next document, given as a list of tokens. """
+        doc_positions = {}
+        for position, token in enumerate(tokens):
+            doc_positions.setdefault(token, []).append(position)
+        for token, positions in doc_positions.items():
+            self.doc_ids.setdefault(token, []).append(self.doc_id)
+            self.position_lists.setdefault(token, []).append(positions)
+        self.doc_id += 1
+
+    def tap(self, docs, tokenize=None):
+        """ Yield each document of docs unchanged, adding it (tokenized by
+        tokenize, if given) as it passes. """
+        for doc in docs:
+            self.add(tokenize(doc) if tokenize else doc)
+            yield doc
+
+    def index(self):
+        """ Return a dict from each term to its PositionalPostings. """
+        return dict((term, PositionalPostings(self.doc_ids[term], self.position_lists[term]))
+                    for term in self.doc_ids)
+
+
+def positional_sections(positions, terms):
+    """ Return the segment sections (see write_segment) holding the
+    PositionalPostings of terms, in order; read them back with
+    positional_table. """
+    starts = array('q', [0])
+    doc_ids = array('i')
+    counts = array('i')
+    offsets = array('q')
+    data = bytearray()
+    for term in terms:
+        term_positions = positions[term]
+        doc_ids.extend(term_positions.doc_ids)
+        counts.extend(term_positions.counts)
+        offsets.extend(offset + len(data) for offset in term_positions.offsets)
+        data.extend(term_positions.data)
+        starts.append(len(doc_ids))
+    return [('positions_starts', starts), ('positions_doc_ids', doc_ids), ('positions_counts', counts),
+            ('positions_offsets', offsets), ('positions_data', array('B', data))]
+
+
+def positional_table(sections):
+    """
+    Return a TermTable mapping each term of a segment read with read_segment
+    to a PositionalPostings over the sections written by
+    positional_sections. Nothing is decoded until positions are asked for.
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'positions.seg')
+    >>> terms, blob, offsets = pack_terms(['b', 'a'])
+    >>> positions = positional_index([['a', 'b', 'a'], ['b']])
+    >>> write_segment(path, {}, [('terms', blob), ('term_offsets', offsets)] + positional_sections(positions, terms))
+    >>> table = positional_table(read_segment(path)[1])
+    >>> table['a'].positions(0), list(table['b'].doc_ids)
+    ([0, 2], [0, 1])
+    """
+    starts = sections['positions_starts']
+    doc_ids = sections['positions_doc_ids']
+    counts = sections['positions_counts']
+    offsets = sections['positions_offsets']
+    data = sections['positions_data']
+    return TermTable(sections['terms'], sections['term_offsets'], lambda term_id: PositionalPostings.from_arrays(
+        doc_ids[starts[term_id]:starts[term_id + 1]], counts[starts[term_id]:starts[term_id + 1]],
+        offsets[starts[term_id]:starts[term_id + 1]], data))
+
+
+def phrase_starts(position_lists):
+    """
+    Return the positions p of a document such that position_lists[i] holds
+    p + i for every i, i.e. the starts of the phrase whose words have these
+    positions. The candidate starts are intersected with each following
+    list, shifted by its offset, in one linear merge per list.
+    >>> phrase_starts([[1, 5, 9], [2, 6, 8], [7, 10]])
+    [5]
+    """
+    starts = list(position_lists[0])
+    for offset, positions in enumerate(position_lists[1:], 1):
+        matched = []
+        j = 0
+        for start in starts:
+            while j < len(positions) and positions[j] < start + offset:
+                j += 1
+            if j == len(positions):
+                break
+            if positions[j] == start + offset:
+                matched.append(start)
+        starts = matched
+        if not starts:
+            break
+    return starts
+
+
+def min_span(position_lists):
+    """
+    Return the smallest distance between the first and the last of a choice
+    of one position from each list, in any order, or None if a list is
+    empty. The lists are merged with a heap holding the current position of
+    each list, always moving the smallest one forward.
+    >>> min_span([[1, 10], [4, 12], [11]])
+    2
+    """
+    if not all(position_lists):
+        return None
+    heap = [(positions[0], i, 0) for i, positions in enumerate(position_lists)]
+    heapq.heapify(heap)
+    high = max(entry[0] for entry in heap)
+    best = high - heap[0][0]
+    while True:
+        low, i, j = heapq.heappop(heap)
+        best = min(best, high - low)
+        if j + 1 == len(position_lists[i]):
+            return best
+        position = position_lists[i][j + 1]
+        high = max(high, position)
+        heapq.heappush(heap, (position, i, j + 1))
+
+
+def _aligned(offset):
+    return (offset + 7) // 8 * 8
+
+
+def write_segment(path, metadata, sections):
+    """
+    Write a binary segment file. The file holds the magic bytes, the length
+    of a JSON header, the header itself (SEGMENT_VERSION, metadata, and the
+    name, type code, offset and length of every section), and then the raw
+    contents of each section, in native byte order, each starting on an
+    8-byte boundary. The segment is written to a temporary file next to
+    path, which then replaces path in one step, so a process opening path
+    meanwhile maps either the previous segment or the complete new one.
+    Params:
+      path.......File name to write.
+      metadata...A JSON serializable dict, returned as is by read_segment.
+      sections...A list of (name, array) pairs; a FileSection can stand in
+                 for an array whose contents are already on disk.
+    """
+    header = {'version': SEGMENT_VERSION, 'metadata': metadata, 'sections': []}
+    offset = 0
+    for name, values in sections:
+        header['sections'].append([name, values.typecode, offset, len(values)])
+        offset = _aligned(offset + len(values) * values.itemsize)
+    header = json.dumps(header).encode('utf-8')
+    start = _aligned(len(SEGMENT_MAGIC) + 8 + len(header))
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(SEGMENT_MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(b'\0' * (start - f.tell()))
+            for name, values in sections:
+                values.tofile(f)
+                f.write(b'\0' * (_aligned(f.tell()) - f.tell()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+class FileSection(object):
+    """
+    A segment section whose values were already written to a raw file with
+    array.tofile, so that write_segment can copy them without loading them
+    into memory.
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'ids')
+    >>> with open(path, 'wb') as f:
+    ...     array('i', [3, 5, 8]).tofile(f)
+    >>> len(FileSection('i', path))
+    3
+    """
+
+    def __init__(self, typecode, path):
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.path = path
+
+    def __len__(self):
+        return os.path.getsize(self.path) // self.itemsize
+
+    def tofile(self, f):
+        with open(self.path, 'rb') as values:
+            shutil.copyfileobj(values, f)
+
+
+def read_segment(path):
+    """
+    Memory-map a segment written by write_segment. Nothing is copied: each
+    section is returned as a memoryview over the mapped file, cast to the
+    type code of the array it was written from, and pages are only read
+    from disk when they are first accessed.
+    A segment written in another version of the layout raises ValueError.
+    Returns:
+      A tuple (metadata, sections), where sections maps names to memoryviews.
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'test.seg')
+    >>> write_segment(path, {'n_docs': 2}, [('ids', array('i', [3, 5])), ('w', array('d', [.5]))])
+    >>> metadata, sections = read_segment(path)
+    >>> metadata, list(sections['ids']), sections['w'][0], os.listdir(os.path.dirname(path))
+    ({'n_docs': 2}, [3, 5], 0.5, ['test.seg'])
+    """
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+        raise ValueError('%s is not an index segment' % path)
+    header_length = struct.unpack_from('<Q', buf, len(SEGMENT_MAGIC))[0]
+    header_start = len(SEGMENT_MAGIC) + 8
+    header = json.loads(buf[header_start:header_start + header_length].decode('utf-8'))
+    if header.get('version') != SEGMENT_VERSION:
+        raise ValueError('%s is a segment of version %s, not %d: rebuild it'
+                         % (path, header.get('version'), SEGMENT_VERSION))
+    start = _aligned(header_start + header_length)
+    view = memoryview(buf)
+    sections = {}
+    for name, typecode, offset, length in header['sections']:
+        size = length * array(typecode).itemsize
+        sections[name] = view[start + offset:start + offset + size].cast(typecode)
+    return header['metadata'], sections
+
+
+def segment_version(path):
+    """ Return the layout version in the header of the segment at path
+    (see write_segment), or None if the file is not a segment or its header
+    has no version. Only the header is read. """
+    with open(path, 'rb') as f:
+        if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+            return None
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        return json.loads(f.read(header_length).decode('utf-8')).get('version')
+
+
+def segment_is_current(path, source):
+    """
+    Return whether the segment at path can be loaded instead of indexing the
+    file source again: it exists, it is not older than source, and it was
+    written in the current SEGMENT_VERSION.
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> source, path = os.path.join(directory, 'docs.txt'), os.path.join(directory, 'index.seg')
+    >>> with open(source, 'w') as f:
+    ...     _ = f.write('a')
+    >>> segment_is_current(path, source)
+    False
+    >>> write_segment(path, {}, [])
+    >>> segment_is_current(path, source)
+    True
+    >>> with open(path, 'r+b') as f:  # Rename the version key.
+    ...     _ = f.seek(len(SEGMENT_MAGIC) + 8)
+    ...     _ = f.write(b'{"x')
+    >>> segment_is_current(path, source)
+    False
+    """
+    if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(source):
+        return False
+    return segment_version(path) == SEGMENT_VERSION
+
+
+def pack_terms(terms):
+    """
+    Sort terms by their UTF-8 encoding and pack them into a byte array, with
+    an array of offsets delimiting each term, for use with TermTable.
+    Returns:
+      A tuple (sorted_terms, blob, offsets).
+    >>> pack_terms(['b', 'ab'])
+    (['ab', 'b'], array('B', [97, 98, 98]), array('q', [0, 2, 3]))
+    """
+    terms = sorted(terms, key=lambda term: term.encode('utf-8'))
+    blob = array('B')
+    offsets = array('q', [0])
+    for term in terms:
+        blob.frombytes(term.encode('utf-8'))
+        offsets.append(len(blob))
+    return terms, blob, offsets
+
+
+class TermTable(Mapping):
+    """
+    A read-only mapping from the terms packed by pack_terms to values,
+    looked up by binary search over the encoded terms, so that opening a
+    segment does not have to build a dict of its whole vocabulary.
+    value is a function from term id (position in sorted order) to value.
+    >>> terms, blob, offsets = pack_terms(['cat', 'ant', 'bee'])
+    >>> table = TermTable(blob, offsets, lambda term_id: term_id * 10)
+    >>> table['cat'], 'dog' in table, list(table.items())
+    (20, False, [('ant', 0), ('bee', 10), ('cat', 20)])
+    """
+
+    def __init__(self, blob, offsets, value):
+        self.blob = blob
+        self.offsets = offsets
+        self.value = value
+
+    def term(self, term_id):
+        return bytes(self.blob[self.offsets[term_id]:self.offsets[term_id + 1]]).decode('utf-8')
+
+    def lower_bound(self, key):
+        """ Return the position of the first term whose UTF-8 encoding is
+        not less than the bytes key. """
+        low, high = 0, len(self)
+        while low < high:
+            mid = (low + high) // 2
+            if bytes(self.blob[self.offsets[mid]:self.offsets[mid + 1]]) < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def term_id(self, term):
+        """ Return the position of term in sorted order, or None. """
+        key = term.encode('utf-8')
+        low = self.lower_bound(key)
+        if low < len(self) and bytes(self.blob[self.offsets[low]:self.offsets[low + 1]]) == key:
+            return low
+        return None
+
+    def __getitem__(self, term):
+        term_id = self.term_id(term)
+        if term_id is None:
+            raise KeyError(term)
+        return self.value(term_id)
+
+    def __contains__(self, term):
+        return self.term_id(term) is not None
+
+    def __iter__(self):
+        return (self.term(term_id) for term_id in range(len(self)))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class DenseMap(Mapping):
+    """
+    A read-only mapping from document id to the value stored at that
+    position of an array of floats, where NaN marks ids that are absent.
+    >>> lengths = DenseMap(array('d', [float('nan'), 4., 3.]))
+    >>> lengths[2], 0 in lengths, dict(lengths)
+    (3.0, False, {1: 4.0, 2: 3.0})
+    """
+
+    def __init__(self, values):
+        self.values = values
+        self.size = None
+
+    def __getitem__(self, i):
+        if 0 <= i < len(self.values) and not math.isnan(self.values[i]):
+            return self.values[i]
+        raise KeyError(i)
+
+    def __iter__(self):
+        return (i for i, value in enumerate(self.values) if not math.isnan(value))
+
+    def __len__(self):
+        if self.size is None:
+            self.size = sum(1 for _ in self)
+        return self.size
+
+
+def dense(values, n_ids):
+    """
+    Return a dict from ids in range(n_ids) to floats as an array in the
+    layout read by DenseMap.
+    >>> dense({1: 4., 2: 3.}, 3)
+    array('d', [nan, 4.0, 3.0])
+    """
+    values_array = array('d', [float('nan')]) * n_ids
+    for i, value in values.items():
+        values_array[i] = value
+    return values_array
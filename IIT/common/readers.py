@@ -0,0 +1,132 @@
+""" Streaming readers for document collections.
+Lines are read one at a time from plain or gzipped files, or straight from a
+member of a tar archive (compressed or not) without extracting it to disk.
+Documents are then assembled from the lines and yielded one at a time, so an
+index can be built while holding a single document in memory. The lines of a
+document are buffered in a list and joined once, rather than concatenated
+line by line, which would copy the document again for every line.
+"""
+import contextlib
+import gzip
+import io
+import itertools
+import tarfile
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+@contextlib.contextmanager
+def open_text(path, member=None, encoding='utf-8'):
+    """
+    Open a text file for reading, as a context manager. If member is given,
+    path is a tar archive and the file is its member of that name, read from
+    the archive. Otherwise, gzipped files are recognized by their first bytes
+    and decompressed as they are read. A file named *.gz that is not gzipped
+    (e.g. an HTML error page saved under that name) raises ValueError rather
+    than being read as text.
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'docs.txt.gz')
+    >>> with open(path, 'w') as f:
+    ...     _ = f.write('<!DOCTYPE html>')
+    >>> with open_text(path) as f:  # doctest:+ELLIPSIS
+    ...     pass
+    Traceback (most recent call last):
+    ...
+    ValueError: .../docs.txt.gz is named .gz but is not gzip-compressed
+    """
+    if member is not None:
+        with tarfile.open(path, mode='r') as archive:
+            extracted = archive.extractfile(member)
+            if extracted is None:
+                raise ValueError('%s is not a file in %s' % (member, path))
+            with io.TextIOWrapper(extracted, encoding=encoding) as f:
+                yield f
+        return
+    with open(path, 'rb') as f:
+        compressed = f.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+    if not compressed and path.endswith('.gz'):
+        raise ValueError('%s is named .gz but is not gzip-compressed' % path)
+    with (gzip.open if compressed else open)(path, 'rt', encoding=encoding) as f:
+        yield f
+
+
+def read_lines(path, member=None, encoding='utf-8'):
+    """
+    Yield the lines of a file (see open_text), stripped of surrounding
+    whitespace.
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'docs.txt')
+    >>> with gzip.open(path + '.gz', 'wt') as f:
+    ...     _ = f.write(' a b \\nc\\n')
+    >>> list(read_lines(path + '.gz'))
+    ['a b', 'c']
+    >>> with open(path, 'w') as f:
+    ...     _ = f.write('d\\n')
+    >>> with tarfile.open(path + '.tar.gz', 'w:gz') as archive:
+    ...     archive.add(path, 'docs.txt')
+    >>> list(read_lines(path + '.tar.gz', 'docs.txt'))
+    ['d']
+    """
+    with open_text(path, member, encoding) as f:
+        for line in f:
+            yield line.strip()
+
+
+def parse_marked(lines, marker, stop='*STOP'):
+    r"""
+    Yield the documents of a TREC-style collection, where each document
+    starts with a line containing marker and the collection ends with a line
+    containing stop. The non-empty lines of a document, stripped, are joined
+    with single spaces; lines outside documents are skipped.
+    >>> lines = '*TEXT 017\n\n THE ALLIES \nAFTER NASSAU\n*TEXT 020\n\n*TEXT 021\nROAD\n*STOP'
+    >>> list(parse_marked(lines.split('\n'), '*TEXT'))
+    ['THE ALLIES AFTER NASSAU', '', 'ROAD']
+    """
+    buffer = None
+    for line in lines:
+        if marker in line or stop in line:
+            if buffer:
+                yield ' '.join(part for part in buffer if part)
+            buffer = [] if marker in line else None
+        elif buffer is not None:
+            buffer.append(line.strip())
+    if buffer:
+        yield ' '.join(part for part in buffer if part)
+
+
+def shards(docs, size, first_doc_id=0):
+    """
+    Yield the documents of the iterable docs in consecutive lists of at most
+    size documents, each paired with the id of its first document.
+    >>> list(shards(iter('abcde'), 2, 1))
+    [(['a', 'b'], 1), (['c', 'd'], 3), (['e'], 5)]
+    """
+    docs = iter(docs)
+    while True:
+        shard = list(itertools.islice(docs, size))
+        if not shard:
+            return
+        yield shard, first_doc_id
+        first_doc_id += len(shard)
+
+
+class CountingIterator(object):
+    """
+    Iterate over an iterable, counting the items drawn in n, e.g. to know
+    the number of documents of a stream once it has been indexed.
+    >>> docs = CountingIterator(x for x in 'abc')
+    >>> list(docs), docs.n
+    (['a', 'b', 'c'], 3)
+    """
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.n = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = next(self.iterator)
+        self.n += 1
+        return item